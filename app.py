@@ -1,13 +1,29 @@
-from flask import Flask, render_template, request, jsonify, send_file, Response
-import pandas as pd
-import requests
+from flask import Flask, render_template, request, jsonify, send_file, Response, g
 import sqlite3
-import io
 import os
 import time
 import json
+import math
+import ipaddress
+import socket
+import click
+import shutil
+import uuid
+from collections import OrderedDict
+import queue
+import random
+import atexit
+import gzip
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
 from dotenv import load_dotenv
 
+from metrics import Registry
+from result_store import ResultWriter, check_format, is_result_file, iter_csv, open_result, result_filename
+import traffic
+
 app = Flask(__name__)
 
 # Load configuration from .env file if present
@@ -23,259 +39,3010 @@ HIGH_TRAFFIC_THRESHOLD = int(os.getenv("HIGH_TRAFFIC_THRESHOLD", "100"))
 SUBNET_IP_THRESHOLD = int(os.getenv("SUBNET_IP_THRESHOLD", "50"))
 SUBNET_VIEW_THRESHOLD = int(os.getenv("SUBNET_VIEW_THRESHOLD", "5000"))
 
+# Cache lifetimes in seconds for successful lookups, ip-api "fail" answers
+# (private and reserved ranges) and transient errors (network, bad responses)
+CACHE_TTL_SUCCESS = int(os.getenv("CACHE_TTL_SUCCESS", str(30 * 86400)))
+CACHE_TTL_FAIL = int(os.getenv("CACHE_TTL_FAIL", str(7 * 86400)))
+CACHE_TTL_ERROR = int(os.getenv("CACHE_TTL_ERROR", "3600"))
+
+# Background refresh of expired entries: seconds between rounds (0 disables) and IPs per round
+REFRESH_INTERVAL = int(os.getenv("REFRESH_INTERVAL", "300"))
+REFRESH_BATCH = int(os.getenv("REFRESH_BATCH", "500"))
+
+# Problem rows /fix-cache re-resolves (and commits) per chunk
+REPAIR_CHUNK = int(os.getenv("REPAIR_CHUNK", "1000"))
+
+# Opt-in reuse of answers across network blocks: prefix length per family (0 disables)
+PREFIX_CACHE_V4_BITS = int(os.getenv("PREFIX_CACHE_V4_BITS", "0"))
+PREFIX_CACHE_V6_BITS = int(os.getenv("PREFIX_CACHE_V6_BITS", "0"))
+# Share of block-answered addresses still resolved exactly, to measure accuracy
+PREFIX_CACHE_VERIFY = float(os.getenv("PREFIX_CACHE_VERIFY", "0.01"))
+
 
 @app.template_filter('timestamp_to_date')
 def timestamp_to_date(timestamp):
     return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
 
 
-# Initialize database
-def init_db():
-    """Create the cache table and add any missing columns."""
-    conn = sqlite3.connect(DB_FILE)
-
-    # Base table with only the primary key to allow incremental upgrades
-    conn.execute("CREATE TABLE IF NOT EXISTS ip_cache (ip TEXT PRIMARY KEY)")
-
-    # List of required columns and their SQLite types
-    required_columns = {
-        "status": "TEXT",
-        "continent": "TEXT",
-        "continentCode": "TEXT",
-        "country": "TEXT",
-        "countryCode": "TEXT",
-        "region": "TEXT",
-        "regionCode": "TEXT",
-        "city": "TEXT",
-        "district": "TEXT",
-        "zip": "TEXT",
-        "lat": "REAL",
-        "lon": "REAL",
-        "timezone": "TEXT",
-        "offset": "INTEGER",
-        "currency": "TEXT",
-        "isp": "TEXT",
-        "org": "TEXT",
-        "as": "TEXT",
-        "asname": "TEXT",
-        "mobile": "INTEGER",
-        "proxy": "INTEGER",
-        "hosting": "INTEGER",
-    }
-
+# SQLite tuning applied to every pooled connection
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": int(os.getenv("SQLITE_CACHE_KB", "65536")) * -1,
+    "mmap_size": int(os.getenv("SQLITE_MMAP_MB", "256")) * 1024 * 1024,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+    # REPLACE only fires the delete triggers that keep the stats tables current with this on
+    "recursive_triggers": "ON",
+}
+
+_local = threading.local()
+
+
+def ip_key(ip):
+    """Binary primary key for ``ip``: a family byte and the 4 or 16 address bytes.
+
+    Keys sort numerically within a family, IPv4 before IPv6.  Anything that
+    is not an address in its canonical spelling (upload junk, upper-case
+    IPv6) is kept verbatim behind a zero byte, so ``ip_text`` always returns
+    exactly the string that was stored.
+    """
+    if ip is None:
+        return None
+    for family, tag in ((socket.AF_INET, b'\x04'), (socket.AF_INET6, b'\x06')):
+        try:
+            packed = socket.inet_pton(family, ip)
+        except (OSError, ValueError):
+            continue
+        if socket.inet_ntop(family, packed) == ip:
+            return tag + packed
+        break
+    return b'\x00' + ip.encode()
+
+
+def ip_text(key):
+    """The address string stored under ``key``."""
+    if key is None:
+        return None
+    if key[0] == 4:
+        return socket.inet_ntop(socket.AF_INET, key[1:])
+    if key[0] == 6:
+        return socket.inet_ntop(socket.AF_INET6, key[1:])
+    return key[1:].decode()
+
+
+def ip_search_ranges(search):
+    """Inclusive key ranges for the addresses an /cache search should match.
+
+    A CIDR block gives its own range.  Otherwise IPv4 keys match when their
+    dotted text starts with ``search`` (``10.1`` covers 10.1.x.x,
+    10.10-19.x.x and 10.100-199.x.x), an exact IPv6 address matches itself
+    and non-address keys match on their verbatim text.
+    """
+    if '/' in search:
+        try:
+            network = ipaddress.ip_network(search, strict=False)
+        except ValueError:
+            return []
+        tag = b'\x04' if network.version == 4 else b'\x06'
+        return [(tag + network.network_address.packed, tag + network.broadcast_address.packed)]
+
+    ranges = []
+    parts = search.split('.')
+    octets = [int(part) for part in parts[:-1] if part.isascii() and part.isdigit() and str(int(part)) == part]
+    last = parts[-1]
+    if len(parts) <= 4 and len(octets) == len(parts) - 1 and all(octet <= 255 for octet in octets) \
+            and (last == '' or (last.isascii() and last.isdigit())):
+        candidates = [value for value in range(256) if str(value).startswith(last)]
+        free = 3 - len(octets)
+        runs = []
+        for value in candidates:
+            if runs and runs[-1][1] == value - 1:
+                runs[-1][1] = value
+            else:
+                runs.append([value, value])
+        for first, final in runs:
+            ranges.append((b'\x04' + bytes(octets + [first] + [0] * free),
+                           b'\x04' + bytes(octets + [final] + [255] * free)))
+
+    key = ip_key(search)
+    if key[0] == 6:
+        ranges.append((key, key))
+    # UTF-8 never contains 0xff, so this bounds every text key with the prefix
+    text = b'\x00' + search.encode()
+    ranges.append((text, text + b'\xff'))
+    return ranges
+
+
+def connect_db(path=None):
+    """Open a new connection to the cache database with the tuned pragmas."""
+    conn = sqlite3.connect(path or DB_FILE)
+    conn.row_factory = sqlite3.Row
+    for pragma, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    # The ip_cache view and any ad-hoc SQL convert keys with these
+    conn.create_function("ip_key", 1, ip_key, deterministic=True)
+    conn.create_function("ip_text", 1, ip_text, deterministic=True)
+    return conn
+
+
+def get_db():
+    """Return this thread's reusable connection, opening it on first use.
+
+    Connections are kept per thread (and per database file) so each lookup
+    reuses an open handle instead of paying for connect/close every time.
+    A new connection first makes sure the schema is current.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.path != DB_FILE:
+        conn = connect_db()
+        init_db(conn)
+        _local.conn, _local.path = conn, DB_FILE
+    return conn
+
+
+# Aggregate tables behind /stats, kept current by triggers on ip_rows
+STATS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS stats_totals (name TEXT PRIMARY KEY, count INTEGER NOT NULL);
+    CREATE TABLE IF NOT EXISTS stats_country (
+        country TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (country));
+    CREATE TABLE IF NOT EXISTS stats_region (
+        region TEXT NOT NULL, country TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (region, country));
+    CREATE TABLE IF NOT EXISTS stats_city (
+        city TEXT NOT NULL, region TEXT NOT NULL, country TEXT NOT NULL, count INTEGER NOT NULL,
+        PRIMARY KEY (city, region, country));
+    CREATE INDEX IF NOT EXISTS stats_country_count ON stats_country (count);
+    CREATE INDEX IF NOT EXISTS stats_region_count ON stats_region (count);
+    CREATE INDEX IF NOT EXISTS stats_city_count ON stats_city (count);
+"""
+
+
+def _stats_delta_sql(ref, delta):
+    """Statements that add ``delta`` for the ip_rows row ``ref`` (NEW or OLD)."""
+    upsert = "ON CONFLICT DO UPDATE SET count = count + excluded.count"
+    country, region, city = (f"(SELECT value FROM cache_strings WHERE id = {ref}.{column}_id)"
+                             for column in ("country", "region", "city"))
+    statements = [
+        f"INSERT INTO stats_totals (name, count) VALUES ('total', {delta}) ON CONFLICT(name) DO UPDATE SET count = count + excluded.count",
+        f"INSERT INTO stats_totals (name, count) SELECT 'unknown', {delta} "
+        f"WHERE {country} = 'Unknown' OR {region} = 'Unknown' OR {city} = 'Unknown' {upsert}",
+        f"INSERT INTO stats_totals (name, count) SELECT 'error', {delta} "
+        f"WHERE {country} = 'Error' OR {region} = 'Error' OR {city} = 'Error' {upsert}",
+        f"INSERT INTO stats_country (country, count) SELECT {country}, {delta} "
+        f"WHERE {country} IS NOT NULL {upsert}",
+        f"INSERT INTO stats_region (region, country, count) SELECT {region}, {country}, {delta} "
+        f"WHERE {region} IS NOT NULL AND {country} IS NOT NULL {upsert}",
+        f"INSERT INTO stats_city (city, region, country, count) SELECT {city}, {region}, {country}, {delta} "
+        f"WHERE {city} IS NOT NULL AND {region} IS NOT NULL AND {country} IS NOT NULL {upsert}",
+    ]
+    if delta < 0:
+        # Drop emptied groups so the tables only hold values that still exist
+        statements += [
+            f"DELETE FROM stats_country WHERE country = {country} AND count <= 0",
+            f"DELETE FROM stats_region WHERE region = {region} AND country = {country} AND count <= 0",
+            f"DELETE FROM stats_city WHERE city = {city} AND region = {region} "
+            f"AND country = {country} AND count <= 0",
+        ]
+    return ";\n".join(statements) + ";"
+
+
+STATS_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS ip_rows_stats_insert AFTER INSERT ON ip_rows BEGIN
+        {_stats_delta_sql("NEW", 1)}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS ip_rows_stats_delete AFTER DELETE ON ip_rows BEGIN
+        {_stats_delta_sql("OLD", -1)}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS ip_rows_stats_update AFTER UPDATE OF country_id, region_id, city_id ON ip_rows BEGIN
+        {_stats_delta_sql("OLD", -1)}
+        {_stats_delta_sql("NEW", 1)}
+    END""",
+]
+
+# The same aggregates computed from the raw table, used to rebuild and verify.
+# Each string has one id, so grouping on the ids groups on the names.
+_label_ids = "(SELECT id FROM cache_strings WHERE value = '{}')"
+STATS_QUERIES = {
+    "stats_totals": f"""
+        SELECT 'total', COUNT(*) FROM ip_rows
+        UNION ALL SELECT 'unknown', COUNT(*) FROM ip_rows
+            WHERE country_id IN {_label_ids.format('Unknown')} OR region_id IN {_label_ids.format('Unknown')}
+            OR city_id IN {_label_ids.format('Unknown')}
+        UNION ALL SELECT 'error', COUNT(*) FROM ip_rows
+            WHERE country_id IN {_label_ids.format('Error')} OR region_id IN {_label_ids.format('Error')}
+            OR city_id IN {_label_ids.format('Error')}
+    """,
+    "stats_country": """
+        SELECT c.value, g.count FROM (
+            SELECT country_id, COUNT(*) AS count FROM ip_rows WHERE country_id IS NOT NULL GROUP BY country_id
+        ) g JOIN cache_strings c ON c.id = g.country_id
+    """,
+    "stats_region": """
+        SELECT r.value, c.value, g.count FROM (
+            SELECT region_id, country_id, COUNT(*) AS count FROM ip_rows
+            WHERE region_id IS NOT NULL AND country_id IS NOT NULL GROUP BY region_id, country_id
+        ) g JOIN cache_strings r ON r.id = g.region_id JOIN cache_strings c ON c.id = g.country_id
+    """,
+    "stats_city": """
+        SELECT t.value, r.value, c.value, g.count FROM (
+            SELECT city_id, region_id, country_id, COUNT(*) AS count FROM ip_rows
+            WHERE city_id IS NOT NULL AND region_id IS NOT NULL AND country_id IS NOT NULL
+            GROUP BY city_id, region_id, country_id
+        ) g JOIN cache_strings t ON t.id = g.city_id JOIN cache_strings r ON r.id = g.region_id
+        JOIN cache_strings c ON c.id = g.country_id
+    """,
+}
+
+
+def rebuild_stats(conn=None):
+    """Recompute every aggregate table from ip_rows in one transaction."""
+    conn = conn or get_db()
+    with conn:
+        for table, query in STATS_QUERIES.items():
+            conn.execute(f"DELETE FROM {table}")
+            conn.execute(f"INSERT INTO {table} {query}")
+
+
+def check_stats(conn=None):
+    """Compare the aggregate tables with ip_rows; returns a list of mismatches."""
+    conn = conn or get_db()
+    mismatches = []
+    for table, query in STATS_QUERIES.items():
+        expected = {tuple(row[:-1]): row[-1] for row in conn.execute(query)}
+        stored = {tuple(row[:-1]): row[-1] for row in conn.execute(f"SELECT * FROM {table}")}
+        for key in expected.keys() | stored.keys():
+            if expected.get(key, 0) != stored.get(key, 0):
+                mismatches.append({"table": table, "key": list(key),
+                                   "expected": expected.get(key, 0), "stored": stored.get(key, 0)})
+    return mismatches
+
+
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """Recompute the /stats aggregate tables from ip_cache."""
+    rebuild_stats()
+    print("Statistics rebuilt")
+
+
+@app.cli.command("check-stats")
+def check_stats_command():
+    """Verify the /stats aggregate tables against ip_cache."""
+    mismatches = check_stats()
+    for mismatch in mismatches:
+        print(json.dumps(mismatch))
+    print(f"{len(mismatches)} mismatches")
+    if mismatches:
+        raise SystemExit(1)
+
+
+def upgrade_legacy_cache(conn):
+    """Add any missing columns to a text-keyed ip_cache table before it is migrated."""
     cursor = conn.execute("PRAGMA table_info(ip_cache)")
     existing_columns = {row[1] for row in cursor.fetchall()}
 
     # Add any missing columns
-    for column, col_type in required_columns.items():
+    for column, col_type in CACHE_COLUMN_TYPES.items():
         if column not in existing_columns:
             conn.execute(f"ALTER TABLE ip_cache ADD COLUMN \"{column}\" {col_type}")
 
+    # Rows cached before expiry tracking: errors are due now, the rest get a full lifetime
+    if "expires_at" not in existing_columns:
+        conn.execute(
+            "UPDATE ip_cache SET expires_at = ? + CASE status WHEN 'success' THEN ? WHEN 'error' THEN 0 ELSE ? END",
+            (time.time(), CACHE_TTL_SUCCESS, CACHE_TTL_FAIL))
+
+
+def migrate_legacy_cache(conn):
+    """Copy rows from a text-keyed ip_cache table into ip_rows, one batch per transaction.
+
+    The copy walks the old table in rowid order and records how far it got
+    in cache_migration, so an interrupted upgrade resumes on the next start
+    and workers starting together share the batches.  The stats triggers
+    are created only once the copy is done, in the same transaction that
+    drops the old table and rebuilds the aggregates, so moved rows are not
+    counted twice.  Returns True in the process that finished the copy.
+    """
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ip_cache_legacy'").fetchone():
+                conn.commit()
+                return False
+            low = conn.execute("SELECT last_rowid FROM cache_migration").fetchone()[0]
+            high = conn.execute(
+                "SELECT max(rowid) FROM (SELECT rowid FROM ip_cache_legacy WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                (low, MIGRATION_BATCH)).fetchone()[0]
+            if high is not None:
+                conn.execute(MIGRATE_STRINGS_SQL, {"low": low, "high": high})
+                conn.execute(MIGRATE_CACHE_SQL, {"low": low, "high": high})
+                conn.execute("UPDATE cache_migration SET last_rowid = ?", (high,))
+                conn.commit()
+                app.logger.info("Migrated cache rows up to rowid %d to binary keys", high)
+                continue
+
+            conn.execute("DROP TABLE ip_cache_legacy")
+            conn.execute("DROP TABLE cache_migration")
+            for statement in STATS_TRIGGERS:
+                conn.execute(statement)
+            rebuild_stats(conn)  # commits the whole step
+            return True
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+# Bump whenever init_db changes the schema, so existing databases run it again
+SCHEMA_VERSION = 2
+
+_schema_lock = threading.Lock()
+
+
+def init_db(conn=None):
+    """Bring the schema up to SCHEMA_VERSION; one PRAGMA read once it is.
+
+    The version lives in SQLite's ``user_version``.  Databases behind it
+    (including every database from before it was tracked) go through
+    ``create_schema``, which is idempotent, and are stamped afterwards.
+    """
+    conn = conn or get_db()
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+    with _schema_lock:
+        if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            create_schema(conn)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.commit()
+
+
+def create_schema(conn):
+    """Create the cache schema, upgrading older layouts in place."""
+    # Older releases kept every column as text in an ip_cache table; park it
+    # under another name and move its rows across in batches below
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ip_cache'").fetchone():
+            upgrade_legacy_cache(conn)
+            conn.execute("ALTER TABLE ip_cache RENAME TO ip_cache_legacy")
+            conn.execute("CREATE TABLE cache_migration (last_rowid INTEGER NOT NULL)")
+            conn.execute("INSERT INTO cache_migration VALUES (0)")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    # Repeated text values live once in cache_strings; ip_rows points at them
+    conn.execute("CREATE TABLE IF NOT EXISTS cache_strings (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE)")
+    conn.execute("CREATE INDEX IF NOT EXISTS cache_strings_nocase ON cache_strings (value COLLATE NOCASE)")
+    conn.execute(CACHE_TABLE_SQL)
+    conn.execute("CREATE INDEX IF NOT EXISTS ip_rows_expires ON ip_rows (expires_at)")
+
+    # Indexes for the /cache filters, with the key for keyset order
+    for column in ("country", "region", "city"):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS ip_rows_{column} ON ip_rows ({column}_id, key)")
+    conn.execute(CACHE_VIEW_SQL)
+
+    # Aggregates for /stats; populate them once when they are first created
+    conn.executescript(STATS_SCHEMA)
+    if migrate_legacy_cache(conn):
+        # Hand the pages of the old layout back to the filesystem
+        try:
+            conn.execute("VACUUM")
+        except sqlite3.OperationalError:
+            app.logger.warning("Could not VACUUM after the cache migration; run it when the database is idle")
+    for statement in STATS_TRIGGERS:
+        conn.execute(statement)
+    if conn.execute("SELECT 1 FROM stats_totals WHERE name = 'total'").fetchone() is None:
+        rebuild_stats(conn)
+
+    # Network blocks answered by a cached address, for the prefix cache
+    conn.execute("CREATE TABLE IF NOT EXISTS ip_prefix (prefix TEXT PRIMARY KEY, key BLOB NOT NULL)")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if "ip" in {row[1] for row in conn.execute("PRAGMA table_info(ip_prefix)")}:
+            conn.execute("CREATE TABLE ip_prefix_keyed (prefix TEXT PRIMARY KEY, key BLOB NOT NULL)")
+            conn.execute("INSERT INTO ip_prefix_keyed SELECT prefix, ip_key(ip) FROM ip_prefix")
+            conn.execute("DROP TABLE ip_prefix")
+            conn.execute("ALTER TABLE ip_prefix_keyed RENAME TO ip_prefix")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    # Upload jobs and their per-file checkpoints
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            events TEXT NOT NULL DEFAULT '[]',
+            progress TEXT,
+            error TEXT,
+            options TEXT NOT NULL DEFAULT '{}',
+            cursor BLOB
+        )
+    """)
+    job_columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+    if "options" not in job_columns:
+        conn.execute("ALTER TABLE jobs ADD COLUMN options TEXT NOT NULL DEFAULT '{}'")
+    # Last ip_rows key a repair job has committed, for resuming it
+    if "cursor" not in job_columns:
+        conn.execute("ALTER TABLE jobs ADD COLUMN cursor BLOB")
+
+    # Rolling per-IP and per-subnet totals of the traffic datasets
+    conn.executescript(traffic.SCHEMA)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS job_files (
+            job_id TEXT NOT NULL,
+            file_idx INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            path TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            rows INTEGER,
+            message TEXT,
+            PRIMARY KEY (job_id, file_idx)
+        )
+    """)
+
     conn.commit()
-    conn.close()
 
 
-init_db()
+# Upstream API location; override to point at a mirror or a local stub
+IP_API_URL = os.getenv("IP_API_URL", "http://ip-api.com").rstrip("/")
+
+# ip-api.com accepts at most 100 addresses per /batch request
+BATCH_SIZE = 100
+
+# Upstream quotas (requests per minute) and concurrent in-flight requests
+IP_API_RATE = int(os.getenv("IP_API_RATE", "45"))
+IP_API_BATCH_RATE = int(os.getenv("IP_API_BATCH_RATE", "15"))
+RESOLVER_WORKERS = int(os.getenv("RESOLVER_WORKERS", "8"))
+
+# Single-IP /lookup: seconds a request waits on the upstream, and distinct IPs allowed in flight
+LOOKUP_DEADLINE = float(os.getenv("LOOKUP_DEADLINE", "5"))
+LOOKUP_MAX_PENDING = int(os.getenv("LOOKUP_MAX_PENDING", "64"))
+
+# Most IPs accepted by one /lookup/batch request
+LOOKUP_BATCH_MAX = int(os.getenv("LOOKUP_BATCH_MAX", "10000"))
+
+# In-memory hot tier in front of SQLite: max entries (0 disables) and TTL in seconds
+HOT_CACHE_SIZE = int(os.getenv("HOT_CACHE_SIZE", "10000"))
+HOT_CACHE_TTL = int(os.getenv("HOT_CACHE_TTL", "300"))
+# Entries loaded into the hot tier when a worker starts (0 disables)
+HOT_CACHE_PRELOAD = int(os.getenv("HOT_CACHE_PRELOAD", "0"))
+
+# Optional offline range dataset (CSV) consulted before the upstream API
+RANGE_DB_FILE = os.getenv("RANGE_DB_FILE", "")
+
+# Rows per chunk when streaming uploaded CSVs
+UPLOAD_CHUNK_ROWS = int(os.getenv("UPLOAD_CHUNK_ROWS", "100000"))
+
+# Background upload jobs: spool directory, worker threads and heartbeat timeout
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "300"))
+# Seconds the spooled files of a cancelled, failed or abandoned upload are kept for a resume
+JOB_SPOOL_RETENTION = int(os.getenv("JOB_SPOOL_RETENTION", str(86400)))
+
+# Seconds the /cache filter lists may lag behind writes made by other workers
+FACET_CACHE_TTL = int(os.getenv("FACET_CACHE_TTL", "60"))
+
+# Format of processed files: csv, or parquet / arrow (both need pyarrow)
+RESULT_FORMAT = os.getenv("RESULT_FORMAT", "csv").lower()
+check_format(RESULT_FORMAT)
+
+# Result viewer: rows per page and classified files kept in memory
+VIEW_PAGE_SIZE = int(os.getenv("VIEW_PAGE_SIZE", "100"))
+RESULT_CACHE_FILES = int(os.getenv("RESULT_CACHE_FILES", "4"))
+
+# Bound parameters per bulk SELECT; older SQLite builds cap this at 999
+SQLITE_MAX_PARAMS = 900
+
+# Prometheus-style instrumentation, served on /metrics when enabled
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "True").lower() == "true"
+metrics = Registry(METRICS_ENABLED)
+CACHE_LOOKUPS = metrics.counter(
+    "iplookup_cache_lookups_total", "Single-IP lookups by the tier that answered them", ["tier"])
+CACHE_LOOKUP_SECONDS = metrics.histogram(
+    "iplookup_cache_lookup_seconds", "Time spent checking the local tiers for one IP")
+UPSTREAM_SECONDS = metrics.histogram(
+    "iplookup_upstream_request_seconds", "ip-api.com request latency", ["endpoint"])
+UPSTREAM_RESPONSES = metrics.counter(
+    "iplookup_upstream_responses_total", "ip-api.com responses by HTTP status", ["endpoint", "code"])
+UPSTREAM_RETRIES = metrics.counter(
+    "iplookup_upstream_retries_total", "ip-api.com requests retried", ["endpoint", "reason"])
+UPSTREAM_FAILURES = metrics.counter(
+    "iplookup_upstream_failures_total", "ip-api.com requests that failed after every retry", ["endpoint"])
+DB_WRITE_SECONDS = metrics.histogram(
+    "iplookup_db_write_seconds", "Cache writer group commit time")
+DB_ROWS_WRITTEN = metrics.counter(
+    "iplookup_db_rows_written_total", "Rows written by the cache writer")
+DB_QUERY_SECONDS = metrics.histogram(
+    "iplookup_db_query_seconds", "SQLite time spent building a page", ["query"])
+UPLOAD_STAGE_SECONDS = metrics.histogram(
+    "iplookup_upload_stage_seconds", "Upload pipeline time per stage and chunk", ["stage"])
+UPLOAD_ROWS = metrics.counter(
+    "iplookup_upload_rows_total", "Rows enriched by upload jobs")
+HTTP_SECONDS = metrics.histogram(
+    "iplookup_http_request_seconds", "Time to produce a response", ["endpoint", "method", "status"])
+
+CACHE_COLUMNS = [
+    "ip", "status", "continent", "continentCode", "country", "countryCode",
+    "region", "regionCode", "city", "district", "zip", "lat", "lon", "timezone",
+    "offset", "currency", "isp", "org", "as", "asname", "mobile", "proxy", "hosting",
+]
+
+# Expiry metadata stored next to every cached row
+CACHE_META_COLUMNS = ["fetched_at", "expires_at"]
+
+# SQLite types of the cached fields
+CACHE_COLUMN_TYPES = {
+    "status": "TEXT",
+    "continent": "TEXT",
+    "continentCode": "TEXT",
+    "country": "TEXT",
+    "countryCode": "TEXT",
+    "region": "TEXT",
+    "regionCode": "TEXT",
+    "city": "TEXT",
+    "district": "TEXT",
+    "zip": "TEXT",
+    "lat": "REAL",
+    "lon": "REAL",
+    "timezone": "TEXT",
+    "offset": "INTEGER",
+    "currency": "TEXT",
+    "isp": "TEXT",
+    "org": "TEXT",
+    "as": "TEXT",
+    "asname": "TEXT",
+    "mobile": "INTEGER",
+    "proxy": "INTEGER",
+    "hosting": "INTEGER",
+    "fetched_at": "REAL",
+    "expires_at": "REAL",
+}
+
+# Low-cardinality text fields; ip_rows stores an id into cache_strings for each
+STRING_COLUMNS = [
+    "continent", "continentCode", "country", "countryCode", "region", "regionCode", "city",
+    "district", "zip", "timezone", "currency", "isp", "org", "as", "asname",
+]
+
+# Physical ip_rows columns: the binary key, then each field or its string id
+ROW_COLUMNS = ["key"] + [f"{column}_id" if column in STRING_COLUMNS else column
+                         for column in CACHE_COLUMNS[1:] + CACHE_META_COLUMNS]
+
+_row_definitions = ', '.join(
+    f'"{column}_id" INTEGER' if column in STRING_COLUMNS else f'"{column}" {CACHE_COLUMN_TYPES[column]}'
+    for column in CACHE_COLUMNS[1:] + CACHE_META_COLUMNS)
+CACHE_TABLE_SQL = f"CREATE TABLE IF NOT EXISTS ip_rows (key BLOB PRIMARY KEY, {_row_definitions}) WITHOUT ROWID"
+
+# ip_cache keeps the original row shape for reads: text ip, strings joined back in
+_view_columns = ', '.join(
+    f's{STRING_COLUMNS.index(column)}.value AS "{column}"' if column in STRING_COLUMNS else f'r."{column}"'
+    for column in CACHE_COLUMNS[1:] + CACHE_META_COLUMNS)
+_view_joins = ' '.join(
+    f'LEFT JOIN cache_strings s{i} ON s{i}.id = r."{column}_id"' for i, column in enumerate(STRING_COLUMNS))
+CACHE_VIEW_SQL = (f"CREATE VIEW IF NOT EXISTS ip_cache AS "
+                  f"SELECT r.key, ip_text(r.key) AS ip, {_view_columns} FROM ip_rows r {_view_joins}")
+
+# Every cached field, in the order lookups return them
+CACHE_SELECT_COLUMNS = ', '.join(f'"{column}"' for column in CACHE_COLUMNS + CACHE_META_COLUMNS)
+
+_insert_columns = ', '.join(f'"{column}"' for column in ROW_COLUMNS)
+_insert_values = ', '.join(f':{column}' for column in ROW_COLUMNS)
+_update_values = ', '.join(f'"{column}" = :{column}' for column in ROW_COLUMNS[1:])
+
+INSERT_CACHE_SQL = f"INSERT OR REPLACE INTO ip_rows ({_insert_columns}) VALUES ({_insert_values})"
+UPDATE_CACHE_SQL = f"UPDATE ip_rows SET {_update_values} WHERE key = :key"
+
+
+def _copy_strings_sql(source, where):
+    """Add the text fields of ``source`` rows matching ``where`` to cache_strings."""
+    return "INSERT OR IGNORE INTO cache_strings (value) SELECT value FROM (" + " UNION ".join(
+        f'SELECT CAST("{column}" AS TEXT) AS value FROM {source} l WHERE {where}'
+        for column in STRING_COLUMNS) + ") WHERE value IS NOT NULL"
+
+
+def _copy_rows_sql(source, where, verb="INSERT OR IGNORE", suffix=""):
+    """Copy text-shaped cache rows from ``source`` into ip_rows, looking their string ids up in SQL."""
+    values = ', '.join(
+        f'(SELECT id FROM cache_strings WHERE value = CAST(l."{column}" AS TEXT))' if column in STRING_COLUMNS
+        else f'l."{column}"' for column in CACHE_COLUMNS[1:] + CACHE_META_COLUMNS)
+    return (f"{verb} INTO ip_rows ({_insert_columns}) SELECT ip_key(l.ip), {values} "
+            f"FROM {source} l WHERE {where} AND l.ip IS NOT NULL {suffix}")
+
+
+# Upgrading a text-keyed ip_cache table: the strings of a rowid range go
+# into the dictionary first, then its rows are copied with their ids looked
+# up in SQL.  Migrated rows never overwrite one that is already in ip_rows.
+_migrate_range = "l.rowid > :low AND l.rowid <= :high"
+MIGRATE_STRINGS_SQL = _copy_strings_sql("ip_cache_legacy", _migrate_range)
+MIGRATE_CACHE_SQL = _copy_rows_sql("ip_cache_legacy", _migrate_range)
+
+# Snapshot imports go through a temp table the same way.  An imported row
+# replaces a cached one when its status is better (success, then fail, then
+# error) or, for the same status, when it was fetched more recently.
+_status_rank = "CASE {}.status WHEN 'success' THEN 2 WHEN 'fail' THEN 1 ELSE 0 END"
+_import_values = ', '.join(f'"{column}" = excluded."{column}"' for column in ROW_COLUMNS[1:])
+_import_newer = (f"{_status_rank.format('excluded')} > {_status_rank.format('ip_rows')} OR "
+                 f"({_status_rank.format('excluded')} = {_status_rank.format('ip_rows')} AND "
+                 f"coalesce(excluded.fetched_at, 0) > coalesce(ip_rows.fetched_at, 0))")
+IMPORT_TABLE_SQL = "CREATE TEMP TABLE IF NOT EXISTS cache_import ({})".format(', '.join(
+    f'"{column}" {CACHE_COLUMN_TYPES.get(column, "TEXT")}' for column in CACHE_COLUMNS + CACHE_META_COLUMNS))
+IMPORT_STRINGS_SQL = _copy_strings_sql("temp.cache_import", "true")
+IMPORT_CACHE_SQL = _copy_rows_sql(
+    "temp.cache_import", "true", verb="INSERT",
+    suffix=f"ON CONFLICT (key) DO UPDATE SET {_import_values} WHERE {_import_newer}")
+
+# A transient error only replaces a row that is an error itself; a good
+# (if stale) row keeps its data and is just scheduled for another try
+INSERT_ERROR_SQL = f"""
+    INSERT OR REPLACE INTO ip_rows ({_insert_columns}) SELECT {_insert_values}
+    WHERE NOT EXISTS (SELECT 1 FROM ip_rows WHERE key = :key AND status != 'error')
+"""
+RETRY_LATER_SQL = "UPDATE ip_rows SET expires_at = :expires_at WHERE key = :key AND status != 'error'"
+
+# Rows copied per transaction when upgrading a text-keyed ip_cache table
+MIGRATION_BATCH = 20000
+
+
+class StringTable:
+    """Append-only dictionary behind the repeated text fields of ip_cache.
+
+    Ids are never reassigned or deleted, so each process keeps a bounded
+    value-to-id map and only asks SQLite about values it has not seen.  New
+    values are committed in their own transaction, so ``intern`` must not be
+    called while the connection has one open.
+    """
+
+    def __init__(self, max_entries=200000):
+        self.ids = {}
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+    def intern(self, conn, values):
+        """Return ``{value: id}`` for ``values``, adding the unknown ones."""
+        values = {value for value in values if value is not None}
+        with self.lock:
+            found = {value: self.ids[value] for value in values if value in self.ids}
+        missing = [value for value in values if value not in found]
+        if not missing:
+            return found
+
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO cache_strings (value) VALUES (?)", [(value,) for value in missing])
+        added = {}
+        for i in range(0, len(missing), SQLITE_MAX_PARAMS):
+            chunk = missing[i:i + SQLITE_MAX_PARAMS]
+            placeholders = ', '.join('?' * len(chunk))
+            for row in conn.execute(f"SELECT value, id FROM cache_strings WHERE value IN ({placeholders})", chunk):
+                added[row[0]] = row[1]
+        with self.lock:
+            if len(self.ids) + len(added) > self.max_entries:
+                self.ids.clear()
+            self.ids.update(added)
+        found.update(added)
+        return found
+
+
+cache_strings = StringTable()
+
+
+_PLAIN_COLUMNS = [column for column in CACHE_COLUMNS[1:] + CACHE_META_COLUMNS if column not in STRING_COLUMNS]
+_STRING_ID_COLUMNS = [(column, f"{column}_id") for column in STRING_COLUMNS]
+
+
+def _as_text(value):
+    return None if value is None else str(value)
+
+
+def encode_results(conn, results):
+    """ip_rows parameters for cache results: binary keys and interned strings."""
+    ids = cache_strings.intern(conn, {_as_text(result.get(column)) for result in results for column in STRING_COLUMNS})
+    rows = []
+    for result in results:
+        row = {column: result.get(column) for column in _PLAIN_COLUMNS}
+        row["key"] = ip_key(result["ip"])
+        for column, id_column in _STRING_ID_COLUMNS:
+            value = result.get(column)
+            row[id_column] = None if value is None else ids[str(value)]
+        rows.append(row)
+    return rows
+
+
+CACHE_TTLS = {"success": CACHE_TTL_SUCCESS, "error": CACHE_TTL_ERROR}
+
+
+def stamp_results(results, now=None):
+    """Copies of ``results`` with ``fetched_at`` and a status-dependent ``expires_at`` set.
+
+    The originals are left alone: the cache writer stamps on its own thread
+    while the same dicts may still be serialised as /lookup responses.
+    """
+    now = time.time() if now is None else now
+    return [dict(result, fetched_at=now, expires_at=now + CACHE_TTLS.get(result.get("status"), CACHE_TTL_FAIL))
+            for result in results]
+
+
+def is_due(row, now=None):
+    """True for cached errors whose retry time has come."""
+    now = time.time() if now is None else now
+    return row["status"] == "error" and (row["expires_at"] or 0) <= now
+
+
+def build_result(ip, data):
+    """Map an ip-api.com response object onto the cache columns."""
+    if data.get("status") != "success":
+        return placeholder_result(ip, data.get("status", "fail"), "Unknown")
+
+    return {
+        "ip": ip,
+        "status": data.get("status"),
+        "continent": data.get("continent", "Unknown"),
+        "continentCode": data.get("continentCode", "Unknown"),
+        "country": data.get("country", "Unknown"),
+        "countryCode": data.get("countryCode", "Unknown"),
+        "region": data.get("regionName", "Unknown"),
+        "regionCode": data.get("region", ""),
+        "city": data.get("city", "Unknown"),
+        "district": data.get("district", ""),
+        "zip": data.get("zip", ""),
+        "lat": data.get("lat"),
+        "lon": data.get("lon"),
+        "timezone": data.get("timezone", ""),
+        "offset": data.get("offset"),
+        "currency": data.get("currency", ""),
+        "isp": data.get("isp", ""),
+        "org": data.get("org", ""),
+        "as": data.get("as", ""),
+        "asname": data.get("asname", ""),
+        "mobile": int(data.get("mobile", 0)),
+        "proxy": int(data.get("proxy", 0)),
+        "hosting": int(data.get("hosting", 0)),
+    }
 
 
-def get_ip_location(ip, use_delay=False):
-    """Retrieve IP information, using the cache when possible."""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.execute('SELECT * FROM ip_cache WHERE ip = ?', (ip,))
-    row = cursor.fetchone()
-    conn.close()
+def placeholder_result(ip, status, label):
+    """Result used when no location is available, e.g. "Unknown" or "Network Error"."""
+    return {
+        "ip": ip,
+        "status": status,
+        "continent": label,
+        "continentCode": label,
+        "country": label,
+        "countryCode": label,
+        "region": label,
+        "regionCode": "",
+        "city": label,
+        "district": "",
+        "zip": "",
+        "lat": None,
+        "lon": None,
+        "timezone": "",
+        "offset": None,
+        "currency": "",
+        "isp": "",
+        "org": "",
+        "as": "",
+        "asname": "",
+        "mobile": 0,
+        "proxy": 0,
+        "hosting": 0,
+    }
 
-    if row:
-        return dict(row)
 
-    if use_delay:
-        time.sleep(0.5)  # Rate limiting
+class CacheWriter:
+    """Background thread that group-commits cache inserts.
+
+    Callers enqueue results and carry on; the writer drains everything that
+    has been queued so far and writes it in a single transaction, so a burst
+    of lookups costs one commit instead of one per IP.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _ensure_started(self):
+        # Started lazily so forked workers get their own writer thread
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="cache-writer", daemon=True)
+                self.thread.start()
+
+    def put(self, results):
+        """Queue results for writing; the returned event is set once committed."""
+        done = threading.Event()
+        self.queue.put((list(results), done))
+        self._ensure_started()
+        return done
+
+    def flush(self):
+        """Block until everything queued so far has been committed."""
+        if self.thread is None or not self.thread.is_alive():
+            # No writer running (nothing queued yet, or interpreter shutdown): write inline
+            self._write(self._drain([]))
+            return
+        self.put([]).wait()
+
+    def _drain(self, items):
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                return items
 
-    # Retry logic with exponential backoff
-    for attempt in range(3):
+    def _write(self, items):
+        rows = stamp_results([row for results, _ in items for row in results])
         try:
-            response = requests.get(f"http://ip-api.com/json/{ip}", timeout=15)
+            if rows:
+                conn = get_db()
+                with DB_WRITE_SECONDS.time():
+                    encoded = encode_results(conn, rows)
+                    errors = [row for row in encoded if row["status"] == "error"]
+                    with conn:
+                        conn.executemany(INSERT_CACHE_SQL, [row for row in encoded if row["status"] != "error"])
+                        conn.executemany(RETRY_LATER_SQL, errors)
+                        conn.executemany(INSERT_ERROR_SQL, errors)
+                        if prefix_cache.enabled:
+                            conn.executemany(PrefixCache.INSERT_SQL, prefix_cache.blocks_for(rows))
+                DB_ROWS_WRITTEN.inc(amount=len(rows))
+                invalidate_facets()
+        except sqlite3.Error:
+            app.logger.exception("Failed to write %d cache rows", len(rows))
+        finally:
+            for _, done in items:
+                done.set()
+
+    def _run(self):
+        while True:
+            self._write(self._drain([self.queue.get()]))
+
+
+cache_writer = CacheWriter()
+atexit.register(cache_writer.flush)
+
+
+def range_result(ip, fields):
+    """Result for an IP answered by the offline range database."""
+    import pandas as pd
+    result = placeholder_result(ip, "success", "Unknown")
+    result.update({key: value for key, value in fields.items() if not pd.isna(value) and value != ""})
+    return result
 
-            if response.status_code == 429:  # Rate limited
-                time.sleep(2 ** attempt)
-                continue
 
-            data = response.json()
-
-            if data.get("status") == "success":
-                result = {
-                    "ip": ip,
-                    "status": data.get("status"),
-                    "continent": data.get("continent", "Unknown"),
-                    "continentCode": data.get("continentCode", "Unknown"),
-                    "country": data.get("country", "Unknown"),
-                    "countryCode": data.get("countryCode", "Unknown"),
-                    "region": data.get("regionName", "Unknown"),
-                    "regionCode": data.get("region", ""),
-                    "city": data.get("city", "Unknown"),
-                    "district": data.get("district", ""),
-                    "zip": data.get("zip", ""),
-                    "lat": data.get("lat"),
-                    "lon": data.get("lon"),
-                    "timezone": data.get("timezone", ""),
-                    "offset": data.get("offset"),
-                    "currency": data.get("currency", ""),
-                    "isp": data.get("isp", ""),
-                    "org": data.get("org", ""),
-                    "as": data.get("as", ""),
-                    "asname": data.get("asname", ""),
-                    "mobile": int(data.get("mobile", 0)),
-                    "proxy": int(data.get("proxy", 0)),
-                    "hosting": int(data.get("hosting", 0)),
-                }
-                break
+def save_results(results):
+    """Queue results for the cache writer's next group commit."""
+    return cache_writer.put(results)
+
+
+def fetch_cached(ips, columns=None):
+    """Return ``{ip: row}`` for every cached IP in ``ips`` using bulk IN queries."""
+    column_sql = ', '.join(f'"{column}"' for column in (columns or CACHE_COLUMNS))
+    found = {}
+
+    conn = get_db()
+    # Stay below SQLite's default limit on bound parameters per statement
+    for i in range(0, len(ips), SQLITE_MAX_PARAMS):
+        chunk = ips[i:i + SQLITE_MAX_PARAMS]
+        placeholders = ', '.join('?' * len(chunk))
+        cursor = conn.execute(f'SELECT {column_sql} FROM ip_cache WHERE key IN ({placeholders})',
+                              [ip_key(ip) for ip in chunk])
+        for row in cursor:
+            found[row['ip']] = dict(row)
+
+    return found
+
+
+class TokenBucket:
+    """Thread-safe token bucket shared by every caller of one upstream endpoint.
+
+    The burst is capped at one second's worth of tokens (at least one), so
+    requests go out evenly spread and no more than ``per_minute`` plus one
+    are sent in any minute, including the first.
+    """
+
+    def __init__(self, per_minute):
+        if per_minute <= 0:
+            raise ValueError(f"Request rate must be positive, got {per_minute}")
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def delay(self):
+        """Seconds until a token is free, ignoring callers already waiting."""
+        with self.lock:
+            now = time.monotonic()
+            tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            return max(self.paused_until - now, (1 - tokens) / self.rate, 0.0)
+
+    def pause(self, seconds):
+        """Hand out no tokens for ``seconds`` and drain what is left."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+class Resolver:
+    """Concurrent ip-api.com client used by /lookup, /upload and /fix-cache.
+
+    Requests share a pooled keep-alive session and a bounded thread pool;
+    the session (and ``requests`` itself) is set up on the first call, so
+    workers that only ever answer from the cache never import it.
+    Each endpoint has its own process-wide token bucket; 429 responses and
+    exhausted ``X-Rl`` quotas pause the bucket for every caller, with an
+    exponential backoff when the upstream does not say how long to wait.
+    """
+
+    MAX_ATTEMPTS = 3
+    MAX_BACKOFF = 60
+
+    def __init__(self, workers, single_rate, batch_rate):
+        self.workers = workers
+        self._session = None
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="resolver")
+        self.single_bucket = TokenBucket(single_rate)
+        self.batch_bucket = TokenBucket(batch_rate)
+        self.backoff = 1
+        self.inflight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+            with self.lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=self.workers)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self._session = session
+        return self._session
+
+    def _throttle(self, bucket, response):
+        """Feed the upstream's quota headers back into ``bucket``."""
+        try:
+            remaining = int(response.headers.get("X-Rl", 1))
+            ttl = int(response.headers.get("X-Ttl", 0))
+        except ValueError:
+            remaining, ttl = 1, 0
+
+        with self.lock:
+            if response.status_code == 429:
+                delay = ttl + 1 if ttl else self.backoff
+                self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
             else:
-                result = {
-                    "ip": ip,
-                    "status": data.get("status", "fail"),
-                    "continent": "Unknown",
-                    "continentCode": "Unknown",
-                    "country": "Unknown",
-                    "countryCode": "Unknown",
-                    "region": "Unknown",
-                    "regionCode": "",
-                    "city": "Unknown",
-                    "district": "",
-                    "zip": "",
-                    "lat": None,
-                    "lon": None,
-                    "timezone": "",
-                    "offset": None,
-                    "currency": "",
-                    "isp": "",
-                    "org": "",
-                    "as": "",
-                    "asname": "",
-                    "mobile": 0,
-                    "proxy": 0,
-                    "hosting": 0,
-                }
-                break
-        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.RequestException):
-            if attempt < 2:
-                time.sleep(2 ** attempt)
+                delay = ttl + 1 if remaining <= 0 else 0
+                self.backoff = 1
+        if delay:
+            bucket.pause(delay)
+
+    def _send(self, bucket, method, url, **kwargs):
+        """Send one request under ``bucket``, retrying 429s and network errors."""
+        import requests
+
+        endpoint = "batch" if bucket is self.batch_bucket else "json"
+        for attempt in range(self.MAX_ATTEMPTS):
+            bucket.acquire()
+            with self.lock:
+                self.inflight += 1
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException:
+                UPSTREAM_SECONDS.observe(time.perf_counter() - started, endpoint)
+                if attempt < self.MAX_ATTEMPTS - 1:
+                    UPSTREAM_RETRIES.inc(endpoint, "network")
+                    time.sleep(2 ** attempt)
+                    continue
+                UPSTREAM_FAILURES.inc(endpoint)
+                raise
+            finally:
+                with self.lock:
+                    self.inflight -= 1
+
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, endpoint)
+            UPSTREAM_RESPONSES.inc(endpoint, str(response.status_code))
+            self._throttle(bucket, response)
+            if response.status_code != 429:
+                return response
+            UPSTREAM_RETRIES.inc(endpoint, "rate_limited")
+
+        UPSTREAM_FAILURES.inc(endpoint)
+        raise requests.exceptions.RetryError(f"Rate limited by {url}")
+
+    def lookup(self, ip):
+        """Resolve a single IP through the /json endpoint."""
+        import requests
+
+        try:
+            response = self._send(self.single_bucket, "GET", f"{IP_API_URL}/json/{ip}", timeout=15)
+            # Upstream outages are transient errors, not "fail" answers to cache for long
+            response.raise_for_status()
+            return build_result(ip, response.json())
+        except requests.exceptions.RequestException:
+            return placeholder_result(ip, "error", "Network Error")
+        except Exception:
+            return placeholder_result(ip, "error", "Error")
+
+    def lookup_batch(self, ips):
+        """Resolve up to BATCH_SIZE IPs with one POST to the /batch endpoint.
+
+        Results come back in the same order as ``ips``; addresses missing
+        from the response are returned as error placeholders.
+        """
+        import requests
+
+        try:
+            response = self._send(self.batch_bucket, "POST", f"{IP_API_URL}/batch", json=list(ips), timeout=30)
+            response.raise_for_status()
+            answers = {item.get("query"): item for item in response.json()}
+        except requests.exceptions.RequestException:
+            return [placeholder_result(ip, "error", "Network Error") for ip in ips]
+        except Exception:
+            answers = {}
+
+        return [
+            build_result(ip, answers[ip]) if ip in answers
+            else placeholder_result(ip, "error", "Error")
+            for ip in ips
+        ]
+
+    def map_batches(self, ips):
+        """Resolve ``ips`` in concurrent batches, yielding each batch as it completes."""
+        futures = [
+            self.executor.submit(self.lookup_batch, ips[i:i + BATCH_SIZE])
+            for i in range(0, len(ips), BATCH_SIZE)
+        ]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # Stop queued batches when the consumer goes away, e.g. a client disconnect
+            for future in futures:
+                future.cancel()
+
+
+resolver = Resolver(RESOLVER_WORKERS, IP_API_RATE, IP_API_BATCH_RATE)
+
+
+class HotCache:
+    """Bounded LRU of recently looked-up IPs, kept in front of ip_cache.
+
+    Entries are stored as ``(expires_at, values)`` tuples with the values in
+    CACHE_COLUMNS order, which is far smaller than the result dicts.  The
+    cache never holds more than ``max_entries`` and drops entries older than
+    ``ttl`` seconds on access.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, ip):
+        """Return the cached result for ``ip`` or None."""
+        with self.lock:
+            entry = self.entries.get(ip)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[ip]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(ip)
+            self.hits += 1
+        return dict(zip(CACHE_COLUMNS, entry[1]))
+
+    def put(self, result, key=None):
+        if self.max_entries <= 0:
+            return
+        values = tuple(result.get(column) for column in CACHE_COLUMNS)
+        key = values[0] if key is None else key
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, values)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, ips=None):
+        """Drop the given IPs, or everything when ``ips`` is None."""
+        with self.lock:
+            if ips is None:
+                self.entries.clear()
+                return
+            for ip in ips:
+                self.entries.pop(ip, None)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": round(self.hits / lookups * 100, 1) if lookups else 0,
+            }
+
+
+hot_cache = HotCache(HOT_CACHE_SIZE, HOT_CACHE_TTL)
+
+# The range data (and the pandas/numpy it needs) is only loaded when configured
+if RANGE_DB_FILE:
+    from range_db import RangeDatabase
+    range_db = RangeDatabase.load(RANGE_DB_FILE, CACHE_COLUMNS[2:])
+else:
+    range_db = None
+
+
+class PrefixCache:
+    """Serves an address from a cached answer for another address in its block.
+
+    ip-api.com answers rarely differ inside a /24, so with a prefix length
+    configured every successful lookup also stands in for the rest of its
+    block.  Blocks are keyed by their masked network (``1.2.3.0/24``): with
+    one length per address family, containment is a single dict or primary
+    key probe.  ``ip_prefix`` maps each block to the ip_cache row it came
+    from, so reused answers expire and refresh with that row; a bounded
+    in-memory tier sits in front of it like the hot cache.
+    """
+
+    INSERT_SQL = "INSERT OR REPLACE INTO ip_prefix (prefix, key) VALUES (?, ?)"
+    COLUMNS = ', '.join(f'c."{column}"' for column in CACHE_COLUMNS + CACHE_META_COLUMNS)
+
+    def __init__(self, v4_bits, v6_bits, max_entries, ttl):
+        self.bits = {4: v4_bits, 6: v6_bits}
+        self.enabled = bool(v4_bits or v6_bits)
+        self.memory = HotCache(max_entries, ttl)
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.checked = 0
+        self.agreed = 0
+
+    def block(self, ip):
+        """The network block ``ip`` belongs to, or None when it has no policy."""
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        bits = self.bits[address.version]
+        if not bits or address.is_private or address.is_reserved:
+            return None
+        return str(ipaddress.ip_network(f"{address}/{bits}", strict=False))
+
+    def blocks_for(self, results):
+        """``(prefix, ip)`` rows for the successful results in ``results``."""
+        rows = []
+        for result in results:
+            prefix = self.block(result["ip"]) if result["status"] == "success" else None
+            if prefix:
+                rows.append((prefix, ip_key(result["ip"])))
+                self.memory.put(result, key=prefix)
+        return rows
+
+    def derive(self, source, ip, prefix, shared=False):
+        """``source``'s answer restated for ``ip``; ``shared`` counts a same-run reuse."""
+        if shared:
+            with self.lock:
+                self.shared += 1
+        result = dict(source)
+        result.update(ip=ip, prefix=prefix)
+        return result
+
+    def get_many(self, ips):
+        """Return ``{ip: result}`` for every address whose block has a live answer."""
+        found = {}
+        pending = {}
+        for ip in ips:
+            prefix = self.block(ip)
+            if prefix is None:
                 continue
-            result = {
-                "ip": ip,
-                "status": "error",
-                "continent": "Network Error",
-                "continentCode": "Network Error",
-                "country": "Network Error",
-                "countryCode": "Network Error",
-                "region": "Network Error",
-                "regionCode": "",
-                "city": "Network Error",
-                "district": "",
-                "zip": "",
-                "lat": None,
-                "lon": None,
-                "timezone": "",
-                "offset": None,
-                "currency": "",
-                "isp": "",
-                "org": "",
-                "as": "",
-                "asname": "",
-                "mobile": 0,
-                "proxy": 0,
-                "hosting": 0,
+            source = self.memory.get(prefix)
+            if source is not None:
+                found[ip] = self.derive(source, ip, prefix)
+            else:
+                pending.setdefault(prefix, []).append(ip)
+        memory_hits = len(found)
+
+        conn = get_db()
+        prefixes = list(pending)
+        for i in range(0, len(prefixes), SQLITE_MAX_PARAMS):
+            chunk = prefixes[i:i + SQLITE_MAX_PARAMS]
+            placeholders = ', '.join('?' * len(chunk))
+            cursor = conn.execute(
+                f"SELECT p.prefix, {self.COLUMNS} FROM ip_prefix p JOIN ip_cache c ON c.key = p.key "
+                f"WHERE p.prefix IN ({placeholders}) AND c.status = 'success' AND c.expires_at > ?",
+                chunk + [time.time()])
+            for row in cursor:
+                source = dict(row)
+                prefix = source.pop("prefix")
+                self.memory.put(source, key=prefix)
+                for ip in pending[prefix]:
+                    found[ip] = self.derive(source, ip, prefix)
+
+        with self.lock:
+            self.memory_hits += memory_hits
+            self.db_hits += len(found) - memory_hits
+            self.misses += sum(1 for ip in ips if ip not in found)
+        return found
+
+    def get(self, ip):
+        return self.get_many([ip]).get(ip)
+
+    def verify(self, expected, actual):
+        """Record whether an exact lookup agreed with the block's answer."""
+        if actual["status"] != "success":
+            return
+        fields = ("country", "region", "city")
+        with self.lock:
+            self.checked += 1
+            self.agreed += all(expected[f] == actual[f] for f in fields)
+
+    def group(self, ips):
+        """Split ``ips`` into ``{key: [ips]}`` sharing a block; unblocked addresses stand alone."""
+        groups = {}
+        for ip in ips:
+            groups.setdefault(self.block(ip) or ip, []).append(ip)
+        return groups
+
+    def invalidate(self, ips=None):
+        if ips is None:
+            self.memory.invalidate()
+        else:
+            self.memory.invalidate([prefix for prefix in map(self.block, ips) if prefix])
+
+    def stats(self):
+        with self.lock:
+            hits = self.memory_hits + self.db_hits
+            lookups = hits + self.misses
+            stats = {
+                "enabled": self.enabled,
+                "v4_bits": self.bits[4],
+                "v6_bits": self.bits[6],
+                "memory_hits": self.memory_hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups * 100, 1) if lookups else 0,
+                "shared": self.shared,
+                "verified": self.checked,
+                "verified_match": round(self.agreed / self.checked * 100, 1) if self.checked else None,
             }
-        except Exception:
-            result = {
-                "ip": ip,
-                "status": "error",
-                "continent": "Error",
-                "continentCode": "Error",
-                "country": "Error",
-                "countryCode": "Error",
-                "region": "Error",
-                "regionCode": "",
-                "city": "Error",
-                "district": "",
-                "zip": "",
-                "lat": None,
-                "lon": None,
-                "timezone": "",
-                "offset": None,
-                "currency": "",
-                "isp": "",
-                "org": "",
-                "as": "",
-                "asname": "",
-                "mobile": 0,
-                "proxy": 0,
-                "hosting": 0,
+        stats["blocks"] = get_db().execute("SELECT COUNT(*) FROM ip_prefix").fetchone()[0]
+        return stats
+
+
+prefix_cache = PrefixCache(PREFIX_CACHE_V4_BITS, PREFIX_CACHE_V6_BITS, HOT_CACHE_SIZE, HOT_CACHE_TTL)
+
+
+def prefix_accuracy(bits, sample=100000):
+    """How often cached IPv4 neighbours agree, for tuning PREFIX_CACHE_V4_BITS.
+
+    Takes up to ``sample`` successful exact lookups from ip_cache, groups
+    them into blocks of each prefix length in ``bits`` and compares every
+    address with the first one cached in its block, which is the answer the
+    prefix cache would have served.  Raises ValueError unless every length
+    is between 1 and 32 and ``sample`` is positive.
+    """
+    import numpy as np
+    import pandas as pd
+    from range_db import ipv4_to_int
+
+    if not all(1 <= length <= 32 for length in bits):
+        raise ValueError("bits must be IPv4 prefix lengths between 1 and 32")
+    if sample <= 0:
+        raise ValueError("sample must be a positive number of lookups")
+
+    df = pd.read_sql_query(
+        "SELECT ip, country, region, city FROM ip_cache WHERE status = 'success' ORDER BY RANDOM() LIMIT ?",
+        get_db(), params=(sample,))
+    numbers = ipv4_to_int(df['ip'].values)
+    df = df[numbers.notna().values]
+    numbers = numbers.dropna().astype(np.int64)
+
+    report = []
+    for length in bits:
+        blocks = numbers.values >> (32 - length)
+        first = df.groupby(blocks)[['country', 'region', 'city']].transform('first')
+        compared = pd.Series(blocks).duplicated().values
+        same_country = (df['country'].values == first['country'].values)[compared]
+        same_city = (df[['country', 'region', 'city']].values == first.values).all(axis=1)[compared]
+        report.append({
+            "bits": length,
+            "sampled": len(df),
+            "compared": int(compared.sum()),
+            "blocks": int(len(np.unique(blocks))),
+            "country_match": round(same_country.mean() * 100, 2) if compared.any() else None,
+            "city_match": round(same_city.mean() * 100, 2) if compared.any() else None,
+        })
+    return report
+
+
+@app.cli.command("prefix-accuracy")
+@click.option("--bits", "-b", multiple=True, type=click.IntRange(1, 32),
+              help="IPv4 prefix lengths to evaluate (repeatable)")
+@click.option("--sample", default=100000, type=click.IntRange(min=1), help="Cached lookups to sample")
+def prefix_accuracy_command(bits, sample):
+    """Check how well cached neighbours predict each other per prefix length."""
+    for row in prefix_accuracy(bits or [PREFIX_CACHE_V4_BITS or 24], sample):
+        print(json.dumps(row))
+
+
+def cached_location(ip):
+    """Answer ``ip`` from the memory, SQLite, range and prefix tiers, or return None."""
+    with CACHE_LOOKUP_SECONDS.time():
+        tier, result = _local_tiers(ip)
+    CACHE_LOOKUPS.inc(tier)
+    return result
+
+
+def _local_tiers(ip):
+    """Return ``(tier, result)`` from the first local tier that knows ``ip``.
+
+    An expired success or fail row is still returned, and a refresh of it
+    is started (unless one is already running), so rows that keep getting
+    read never go stale for long, with or without the refresh scheduler.
+    """
+    result = hot_cache.get(ip)
+    if result:
+        return "memory", result
+
+    cursor = get_db().execute(f'SELECT {CACHE_SELECT_COLUMNS} FROM ip_cache WHERE key = ?', (ip_key(ip),))
+    row = cursor.fetchone()
+
+    if row and not is_due(row):
+        result = dict(row)
+        if (row["expires_at"] or 0) <= time.time():
+            # Expired but still an answer: serve it and re-resolve it in the background
+            lookups.submit(ip, fetch_location, ip)
+        else:
+            hot_cache.put(result)
+        return "sqlite", result
+
+    # Offline ranges are cheap to re-resolve, so they are not written to ip_cache
+    fields = range_db.lookup(ip) if range_db is not None else None
+    if fields is not None:
+        result = range_result(ip, fields)
+        hot_cache.put(result)
+        return "range", result
+
+    # Answers borrowed from a neighbour stay out of ip_cache; they follow the source row
+    result = prefix_cache.get(ip) if prefix_cache.enabled else None
+    if result is not None:
+        hot_cache.put(result)
+        return "prefix", result
+
+    return "miss", None
+
+
+def fetch_location(ip):
+    """Resolve ``ip`` upstream and cache the answer."""
+    result = resolver.lookup(ip)
+
+    # Save full response to cache; errors are retried, so keep them out of the hot tier
+    save_results([result])
+    if result["status"] != "error":
+        hot_cache.put(result)
+
+    return result
+
+
+def get_ip_location(ip):
+    """Retrieve IP information, using the in-memory and SQLite caches when possible."""
+    return cached_location(ip) or fetch_location(ip)
+
+
+class SingleFlight:
+    """Runs at most one call per key; concurrent callers share its future.
+
+    Calls run on their own small pool, so a caller can stop waiting at its
+    deadline without cancelling the work others (or the cache) still want.
+    Once ``max_pending`` distinct keys are in flight new keys are refused.
+    """
+
+    def __init__(self, workers, max_pending):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lookup")
+        self.max_pending = max_pending
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.started = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def pending(self, key):
+        with self.lock:
+            return key in self.calls
+
+    def submit(self, key, fn, *args):
+        """Return the future for ``key``, starting ``fn`` if none is running; None when full."""
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            if len(self.calls) >= self.max_pending:
+                self.rejected += 1
+                return None
+            future = self.executor.submit(fn, *args)
+            self.calls[key] = future
+            self.started += 1
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def _forget(self, key, future):
+        with self.lock:
+            if self.calls.get(key) is future:
+                del self.calls[key]
+
+    def timed_out(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": len(self.calls),
+                "max_pending": self.max_pending,
+                "started": self.started,
+                "coalesced": self.coalesced,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+            }
+
+
+lookups = SingleFlight(RESOLVER_WORKERS, LOOKUP_MAX_PENDING)
+
+
+def resolve_uncached(ips):
+    """Resolve cache misses in batches, yielding each batch as it completes.
+
+    Every batch is handed to the cache writer straight away so an
+    interrupted run keeps the work already done.
+    """
+    for results in resolver.map_batches(ips):
+        save_results(results)
+        yield results
+
+
+def resolve_by_block(ips):
+    """Like resolve_uncached, but sends one address per prefix block upstream.
+
+    The rest of a block shares that address's answer when it succeeded and
+    is resolved on its own otherwise.  Shared answers are yielded with their
+    block but not written to ip_cache.  A PREFIX_CACHE_VERIFY share of them
+    is resolved exactly anyway and compared, which keeps the prefix cache's
+    accuracy measurable.
+    """
+    if not prefix_cache.enabled:
+        yield from resolve_uncached(ips)
+        return
+
+    groups = prefix_cache.group(ips)
+    leaders = {members[0]: key for key, members in groups.items()}
+    leftovers = []
+    expected = {}
+    for results in resolve_uncached(list(leaders)):
+        batch = list(results)
+        for result in results:
+            key = leaders[result["ip"]]
+            followers = groups[key][1:]
+            if result["status"] != "success" or key == result["ip"]:
+                leftovers += followers
+                continue
+            for ip in followers:
+                if random.random() < PREFIX_CACHE_VERIFY:
+                    expected[ip] = result
+                    leftovers.append(ip)
+                else:
+                    batch.append(prefix_cache.derive(result, ip, key, shared=True))
+        yield batch
+
+    for results in resolve_uncached(leftovers):
+        for result in results:
+            if result["ip"] in expected:
+                prefix_cache.verify(expected[result["ip"]], result)
+        yield results
+
+
+def lookup_local(ips, columns=None):
+    """Answer ``ips`` in bulk from SQLite, the range data and the prefix cache.
+
+    Returns ``(locations, misses, sources)``: results by IP (at least
+    ``columns`` plus ip and status), the IPs left for the upstream and how
+    many answers each tier gave.  Cached errors that are due count as misses.
+    """
+    import pandas as pd
+
+    extra = ['ip', 'status', 'expires_at']
+    locations = fetch_cached(ips, columns=extra + [c for c in columns if c not in extra] if columns else None)
+    now = time.time()
+    misses = [ip for ip in ips if ip not in locations or is_due(locations[ip], now)]
+    sources = {'cache': len(ips) - len(misses), 'range': 0, 'prefix': 0}
+
+    # The offline range data answers what it covers; only the rest goes upstream
+    if range_db is not None and misses:
+        matches = range_db.lookup_series(misses)
+        covered = matches.notna().any(axis=1).values
+        for ip, fields in zip(pd.Series(misses)[covered], matches[covered].to_dict(orient='records')):
+            locations[ip] = range_result(ip, fields)
+        sources['range'] = int(covered.sum())
+        misses = [ip for ip in misses if ip not in locations or is_due(locations[ip], now)]
+
+    # Then answers already cached for another address in the same block
+    if prefix_cache.enabled and misses:
+        matches = prefix_cache.get_many(misses)
+        locations.update(matches)
+        sources['prefix'] = len(matches)
+        misses = [ip for ip in misses if ip not in matches]
+
+    return locations, misses, sources
+
+
+class RefreshScheduler:
+    """Background thread that re-resolves expired cache entries.
+
+    Every ``interval`` seconds, when no upload job is running and the
+    resolver has nothing in flight, it takes up to ``batch`` rows whose
+    expires_at has passed (errors first, then the stalest) and resolves
+    them through the shared, rate-limited resolver.  What each round did is
+    kept for /refresh-cache and /stats.
+    """
+
+    def __init__(self, interval, batch):
+        self.interval = interval
+        self.batch = batch
+        self.thread = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.runs = 0
+        self.refreshed = 0
+        self.errors = 0
+        self.last_run = None
+        self.last_result = None
+
+    def start(self):
+        # Started lazily so forked workers get their own thread
+        if self.interval <= 0 or (self.thread is not None and self.thread.is_alive()):
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="cache-refresh", daemon=True)
+                self.thread.start()
+
+    def trigger(self):
+        """Run a round now instead of waiting for the next interval."""
+        self.start()
+        self.wake.set()
+
+    def idle(self):
+        return resolver.inflight == 0 and not any(not job.finished for job in active_jobs.values())
+
+    def run_once(self):
+        """Refresh one batch of expired rows; returns a summary or None when busy."""
+        if not self.idle():
+            return None
+
+        cache_writer.flush()
+        ips = [ip_text(row[0]) for row in get_db().execute(
+            "SELECT key FROM ip_rows WHERE expires_at <= ? ORDER BY status = 'error' DESC, expires_at LIMIT ?",
+            (time.time(), self.batch))]
+
+        counts = {}
+        for results in resolve_uncached(ips):
+            for result in results:
+                counts[result["status"]] = counts.get(result["status"], 0) + 1
+        cache_writer.flush()
+        hot_cache.invalidate(ips)
+
+        summary = {"at": time.time(), "ips": len(ips), "statuses": counts}
+        with self.lock:
+            self.runs += 1
+            self.refreshed += len(ips)
+            self.errors += counts.get("error", 0)
+            self.last_run = summary
+            if ips:
+                self.last_result = summary
+        if ips:
+            app.logger.info("Refreshed %d expired cache entries: %s", len(ips), counts)
+        return summary
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.run_once()
+            except Exception:
+                app.logger.exception("Cache refresh failed")
+
+    def stats(self):
+        due = get_db().execute("SELECT COUNT(*) FROM ip_rows WHERE expires_at <= ?", (time.time(),)).fetchone()[0]
+        with self.lock:
+            return {
+                "enabled": self.interval > 0,
+                "interval": self.interval,
+                "batch": self.batch,
+                "due": due,
+                "runs": self.runs,
+                "refreshed": self.refreshed,
+                "errors": self.errors,
+                "last_run": self.last_run,
+                "last_result": self.last_result,
             }
+
+
+refresh_scheduler = RefreshScheduler(REFRESH_INTERVAL, REFRESH_BATCH)
+
+
+def hottest_ips(conn, limit):
+    """Up to ``limit`` cached IPs worth keeping in memory, busiest first.
+
+    The traffic datasets say which addresses get the most views; each
+    dataset's top IPs come off its views index and are merged by total.
+    Without traffic data (or to fill up), the successful rows that expire
+    last are the most recently fetched ones.
+    """
+    views = {}
+    for (dataset,) in conn.execute("SELECT dataset FROM traffic_datasets").fetchall():
+        for ip, count in conn.execute(
+                "SELECT ip, views FROM traffic_ips WHERE dataset = ? ORDER BY views DESC LIMIT ?", (dataset, limit)):
+            views[ip] = views.get(ip, 0) + count
+    ips = sorted(views, key=views.get, reverse=True)[:limit]
+    if len(ips) < limit:
+        seen = set(ips)
+        ips += [ip for ip in (ip_text(row[0]) for row in conn.execute(
+            "SELECT key FROM ip_rows WHERE status = 'success' ORDER BY expires_at DESC LIMIT ?", (limit,)))
+            if ip not in seen][:limit - len(ips)]
+    return ips
+
+
+def preload_hot_cache(limit):
+    """Fill the hot tier with the ``limit`` hottest cached rows; returns how many went in."""
+    if limit <= 0 or hot_cache.max_entries <= 0:
+        return 0
+    started = time.time()
+    ips = hottest_ips(get_db(), min(limit, hot_cache.max_entries))
+    cached = fetch_cached(ips)
+    rows = [cached[ip] for ip in ips if ip in cached and not is_due(cached[ip])]
+    # Coldest first, so the busiest addresses end up at the LRU's fresh end
+    for row in reversed(rows):
+        hot_cache.put(row)
+    app.logger.info("Preloaded %d hot cache entries in %.2fs", len(rows), time.time() - started)
+    return len(rows)
+
+
+_preload = {"started": False, "lock": threading.Lock()}
+
+
+@app.before_request
+def start_background_tasks():
+    refresh_scheduler.start()
+    job_heartbeat.start()
+    if HOT_CACHE_PRELOAD > 0 and not _preload["started"]:
+        with _preload["lock"]:
+            if not _preload["started"]:
+                _preload["started"] = True
+                threading.Thread(target=preload_hot_cache, args=(HOT_CACHE_PRELOAD,),
+                                 name="hot-cache-preload", daemon=True).start()
+
+
+@app.before_request
+def start_request_timer():
+    if metrics.enabled:
+        g.request_started = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        HTTP_SECONDS.observe(time.perf_counter() - started,
+                             request.endpoint or 'unknown', request.method, str(response.status_code))
+    return response
+
+
+def count_rows(path):
+    """Count data rows by scanning for newlines, without parsing the CSV.
+
+    Quoted fields containing newlines are over-counted, which is acceptable
+    for the progress estimate this feeds.
+    """
+    lines = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            lines += chunk.count(b'\n')
+            last = chunk[-1:]
+    if last != b'\n':
+        lines += 1
+    return max(lines - 1, 0)
+
+
+def read_ip_column(path):
+    """Return the distinct client_ip values of a CSV, reading it in chunks."""
+    import pandas as pd
+    ips = {}
+    for chunk in pd.read_csv(path, usecols=['client_ip'], dtype={'client_ip': str}, chunksize=UPLOAD_CHUNK_ROWS):
+        ips.update(dict.fromkeys(chunk['client_ip'].astype(str).unique()))
+    return ips
+
+
+class StageTimings(dict):
+    """Seconds spent per upload stage; each measurement also feeds /metrics."""
+
+    def add(self, stage, seconds):
+        self[stage] = self.get(stage, 0.0) + seconds
+        UPLOAD_STAGE_SECONDS.observe(seconds, stage)
+
+    @contextmanager
+    def stage(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+    def rounded(self):
+        return {stage: round(seconds, 3) for stage, seconds in self.items()}
+
+
+# Friendlier names accepted in field lists (uploads, /lookup/batch, flask enrich)
+FIELD_ALIASES = {"asn": "as", "regionName": "region"}
+
+# Cached fields appended to uploads unless a job asks for others
+ENRICH_FIELDS = ["country", "region", "city"]
+
+# Column types of the non-text fields in enriched files; text fields are categorical
+FIELD_DTYPES = {"lat": "float64", "lon": "float64", "offset": "Int64",
+                "mobile": "boolean", "proxy": "boolean", "hosting": "boolean"}
+
+
+def parse_fields(fields):
+    """Validate a list (or comma-separated string) of cached field names.
+
+    Accepts the aliases in FIELD_ALIASES; returns None when ``fields`` is
+    empty and raises ValueError on unknown names or any other shape.
+    """
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    if not fields:
+        return None
+    if not isinstance(fields, list) or not all(isinstance(f, str) for f in fields):
+        raise ValueError("fields must be a comma-separated string or a list of field names")
+    fields = [FIELD_ALIASES.get(f.strip(), f.strip()) for f in fields if f.strip()]
+    unknown = [f for f in fields if f not in CACHE_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return list(dict.fromkeys(fields)) or None
+
+
+def location_frame(locations, fields=ENRICH_FIELDS):
+    """The ``{ip: result}`` answers of a lookup as the frame enrich_csv joins on.
+
+    The frame is indexed by client_ip; pandas builds the index's hash table
+    on the first join and reuses it for every later chunk and file, so
+    build the frame once per upload.  Text fields become categoricals and
+    the numeric and boolean ones get nullable types, so columnar results
+    store them compactly and typed.
+    """
+    import pandas as pd
+
+    fields = [field for field in fields if field != 'ip']
+    df = pd.DataFrame.from_records(list(locations.values()), columns=['ip'] + fields)
+    for field in fields:
+        if field in FIELD_DTYPES:
+            df[field] = pd.to_numeric(df[field], errors='coerce').astype(FIELD_DTYPES[field])
+        else:
+            df[field] = df[field].astype('string').astype('category')
+    return df.rename(columns={'ip': 'client_ip'}).set_index('client_ip')
+
+
+def join_locations(df, location_df):
+    """``df`` with the location_frame columns for each row's client_ip appended."""
+    import pandas as pd
+
+    located = location_df.reindex(df['client_ip'].values)
+    located.index = df.index
+    return pd.concat([df, located], axis=1)
+
+
+def enrich_csv(path, output_path, location_df, timings=None, aggregate=False, views=None):
+    """Stream ``path`` chunk by chunk, join locations on and append to ``output_path``.
+
+    Output is written in RESULT_FORMAT to a ``.part`` file that is renamed
+    into place when done, so a half-written file never shows up under
+    /results.  Yields the number of rows written after each chunk, and adds
+    the parse, join and write time to ``timings`` (plus the aggregate time
+    when aggregating, or the time spent counting ``views`` as traffic).
+
+    With ``aggregate``, only client_ip (and ip_count, when present) is read
+    and the rows are collapsed to one per IP with the summed ``ip_count``,
+    so the join and the write only see distinct IPs.  Progress is then the
+    number of input rows read.  Passing a list as ``views`` collects the
+    per-IP view counts in it (as a single Series once the file is done).
+    """
+    import pandas as pd
+
+    timings = StageTimings() if timings is None else timings
+    partial_path = output_path + '.part'
+    fields = list(location_df.columns)
+    usecols = (lambda column: column in ('client_ip', 'ip_count')) if aggregate else None
+    try:
+        with ResultWriter(partial_path, RESULT_FORMAT) as writer:
+            # Columns are read as text so every chunk has the same types; an
+            # optional column empty in the first chunk would otherwise be float
+            chunks = iter(pd.read_csv(path, usecols=usecols, dtype=str, chunksize=UPLOAD_CHUNK_ROWS))
+            counts = [] if views is None else views
+            read = 0
+            while True:
+                with timings.stage('parse'):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                chunk['client_ip'] = chunk['client_ip'].astype(str)
+                if 'ip_count' in chunk.columns:
+                    chunk['ip_count'] = pd.to_numeric(chunk['ip_count'], errors='coerce')
+                if aggregate or views is not None:
+                    with timings.stage('aggregate' if aggregate else 'traffic'):
+                        counts.append(traffic.ip_views(chunk))
+                        if len(counts) >= 8:
+                            counts[:] = [pd.concat(counts).groupby(level=0, sort=False).sum()]
+                if aggregate:
+                    read += len(chunk)
+                    UPLOAD_ROWS.inc(amount=len(chunk))
+                    yield read
+                    continue
+                with timings.stage('join'):
+                    chunk = chunk.drop(columns=fields, errors='ignore')
+                    chunk = join_locations(chunk, location_df)
+                with timings.stage('write'):
+                    writer.write(chunk)
+                UPLOAD_ROWS.inc(amount=len(chunk))
+                yield writer.rows
+
+            if aggregate or views is not None:
+                with timings.stage('aggregate' if aggregate else 'traffic'):
+                    counts[:] = [pd.concat(counts).groupby(level=0, sort=False).sum() if counts
+                                 else pd.Series(dtype='int64')]
+            if aggregate:
+                with timings.stage('join'):
+                    df = counts[0].astype('int64').rename('ip_count').rename_axis('client_ip').reset_index()
+                    df = join_locations(df, location_df)
+                with timings.stage('write'):
+                    writer.write(df)
+        os.replace(partial_path, output_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+JOB_TERMINAL_EVENTS = ('complete', 'cancelled', 'failed')
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """Live progress of a background job (an upload or a cache repair) running in this process.
+
+    Milestone events (start, per-file results, completion) are kept in
+    order; progress events only keep the latest one.  Every client watching
+    the job waits on the same condition, so extra watchers cost nothing but
+    the wake-up.  State is mirrored to the ``jobs`` table so other workers
+    and later requests can read it.
+    """
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self.events = []
+        self.progress = None
+        self.version = 0
+        self.finished = False
+        self.persisted_at = 0.0
+        self.cond = threading.Condition()
+
+    def publish(self, event):
+        now = time.time()
+        conn = get_db()
+        if event['type'] in ('progress', 'resolving'):
+            # Progress is frequent; persist it (and the heartbeat) at most once a second
+            if now - self.persisted_at >= 1:
+                with conn:
+                    conn.execute('UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?',
+                                 (json.dumps(event), now, self.id))
+                self.persisted_at = now
+        else:
+            with conn:
+                conn.execute('UPDATE jobs SET events = ?, updated_at = ? WHERE id = ?',
+                             (json.dumps(self.events + [event]), now, self.id))
+
+        with self.cond:
+            if event['type'] in ('progress', 'resolving'):
+                self.progress = event
+            else:
+                self.events.append(event)
+            self.finished = event['type'] in JOB_TERMINAL_EVENTS
+            self.version += 1
+            self.cond.notify_all()
+
+    def wait(self, version, timeout):
+        """Block until something newer than ``version`` is published, or ``timeout``."""
+        with self.cond:
+            if self.version == version and not self.finished:
+                self.cond.wait(timeout)
+            return self.version, list(self.events), self.progress, self.finished
+
+
+active_jobs = {}
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+
+
+def create_job(files, options=None):
+    """Persist a new job and spool its files under UPLOAD_DIR.
+
+    ``options`` holds the job's settings.  Uploads have ``fields`` (cached
+    fields to append) and ``aggregate`` (collapse rows to one per IP); a
+    cache repair has ``kind`` set to ``repair`` and its ``filters``.
+    """
+    job_id = uuid.uuid4().hex
+    job_dir = os.path.join(UPLOAD_DIR, job_id)
+
+    rows = []
+    for idx, file in enumerate(files):
+        if file.filename.endswith('.csv'):
+            path = os.path.join(job_dir, f'{idx}.csv')
+            try:
+                os.makedirs(job_dir, exist_ok=True)
+                file.save(path)
+            except Exception:
+                path = None
+            rows.append((job_id, len(rows), file.filename, path))
+
+    now = time.time()
+    conn = get_db()
+    with conn:
+        conn.execute("INSERT INTO jobs (id, status, created_at, updated_at, options) VALUES (?, 'queued', ?, ?, ?)",
+                     (job_id, now, now, json.dumps(options or {})))
+        conn.executemany('INSERT INTO job_files (job_id, file_idx, filename, path) VALUES (?, ?, ?, ?)', rows)
+    return job_id
+
+
+def get_job(job_id):
+    """Return the job's status row and files as a dict, or None."""
+    conn = get_db()
+    row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if row is None:
+        return None
+
+    job = dict(row)
+    job['events'] = json.loads(job['events'])
+    job['progress'] = json.loads(job['progress']) if job['progress'] else None
+    job['options'] = json.loads(job['options'])
+    job['cursor'] = ip_text(job['cursor'])
+    job['files'] = [dict(f) for f in conn.execute(
+        'SELECT file_idx, filename, status, rows, message FROM job_files WHERE job_id = ? ORDER BY file_idx',
+        (job_id,))]
+    # A queued/running job whose heartbeat stopped belongs to a worker that died
+    job['stale'] = (job['status'] in ('queued', 'running') and job_id not in active_jobs
+                    and time.time() - job['updated_at'] > JOB_STALE_SECONDS)
+    # Unfinished uploads need their spooled files, which JobHeartbeat.sweep removes eventually
+    spooled = (all(f['status'] == 'done' for f in job['files'])
+               or os.path.isdir(os.path.join(UPLOAD_DIR, job_id)))
+    job['resumable'] = (job['stale'] or job['status'] in ('failed', 'cancelled')) and spooled
+    return job
+
+
+def start_job(job_id):
+    """Hand a queued job to the worker pool."""
+    active_jobs[job_id] = Job(job_id)
+    job_heartbeat.start()
+    job_executor.submit(run_job, job_id)
+
+
+def run_job(job_id):
+    job = active_jobs[job_id]
+    conn = get_db()
+    with conn:
+        conn.execute("UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ?", (time.time(), job_id))
+    options = json.loads(conn.execute('SELECT options FROM jobs WHERE id = ?', (job_id,)).fetchone()[0])
+
+    status, final_event, error = 'completed', {'type': 'complete'}, None
+    events = JOB_PIPELINES[options.get('kind', 'upload')](job_id)
+    try:
+        for event in events:
+            if event['type'] == 'complete':
+                final_event = event
+                break
+            job.publish(event)
+            if conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]:
+                raise JobCancelled()
+        shutil.rmtree(os.path.join(UPLOAD_DIR, job_id), ignore_errors=True)
+    except JobCancelled:
+        status, final_event, error = 'cancelled', {'type': 'cancelled', 'message': 'Job cancelled'}, None
+    except Exception as e:
+        app.logger.exception("Job %s failed", job_id)
+        status, final_event, error = 'failed', {'type': 'failed', 'message': str(e)}, str(e)
+    finally:
+        events.close()
+
+    # Store the final status before telling watchers, so a follow-up poll agrees with the stream
+    with conn:
+        conn.execute('UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?',
+                     (status, error, time.time(), job_id))
+    job.publish(final_event)
+    active_jobs.pop(job_id, None)
+
+
+class JobHeartbeat:
+    """Background thread that keeps this process's jobs alive and sweeps old spools.
+
+    ``updated_at`` is a job's heartbeat, and events alone do not keep it
+    fresh: scanning a large upload or waiting out a rate limit can publish
+    nothing for longer than JOB_STALE_SECONDS.  Every ``interval`` seconds
+    this bumps the heartbeat of each queued or running job in active_jobs.
+    Each round also deletes the spooled files of uploads that stopped
+    (cancelled, failed, or abandoned by a dead worker) more than
+    ``retention`` seconds ago; those jobs can no longer be resumed.
+    """
+
+    def __init__(self, interval, retention):
+        self.interval = interval
+        self.retention = retention
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        # Started lazily so forked workers get their own thread
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="job-heartbeat", daemon=True)
+                self.thread.start()
+
+    def beat(self, now=None):
+        now = time.time() if now is None else now
+        ids = list(active_jobs)
+        if ids:
+            conn = get_db()
+            with conn:
+                conn.executemany("UPDATE jobs SET updated_at = ? WHERE id = ? AND status IN ('queued', 'running')",
+                                 [(now, job_id) for job_id in ids])
+
+    def sweep(self, now=None):
+        """Remove spooled uploads past their retention; returns how many went."""
+        if not os.path.isdir(UPLOAD_DIR):
+            return 0
+        cutoff = (time.time() if now is None else now) - self.retention
+        conn = get_db()
+        removed = 0
+        for name in os.listdir(UPLOAD_DIR):
+            path = os.path.join(UPLOAD_DIR, name)
+            if name in active_jobs or not os.path.isdir(path):
+                continue
+            row = conn.execute('SELECT status, updated_at FROM jobs WHERE id = ?', (name,)).fetchone()
+            stopped_at = os.path.getmtime(path) if row is None else row['updated_at']
+            if stopped_at < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        return removed
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.beat()
+                self.sweep()
+            except Exception:
+                app.logger.exception("Job heartbeat failed")
+
+
+job_heartbeat = JobHeartbeat(max(JOB_STALE_SECONDS // 5, 1), JOB_SPOOL_RETENTION)
+
+
+def checkpoint_file(job_id, file_idx, status, rows=None, message=None):
+    """Record a finished file so a resumed job skips it."""
+    conn = get_db()
+    with conn:
+        conn.execute('UPDATE job_files SET status = ?, rows = ?, message = ? WHERE job_id = ? AND file_idx = ?',
+                     (status, rows, message, job_id, file_idx))
+
+
+def process_upload(job_id):
+    """Run the enrichment pipeline for a job, yielding progress events.
+
+    Files already checkpointed by an earlier run are reported and skipped.
+    """
+    import pandas as pd
+
+    os.makedirs('results', exist_ok=True)
+
+    conn = get_db()
+    options = json.loads(conn.execute('SELECT options FROM jobs WHERE id = ?', (job_id,)).fetchone()[0])
+    fields = options.get('fields') or ENRICH_FIELDS
+    aggregate = bool(options.get('aggregate'))
+    dataset = options.get('dataset')
+
+    file_data = [dict(row) for row in conn.execute(
+        'SELECT file_idx, filename, path, status, rows, message FROM job_files WHERE job_id = ? ORDER BY file_idx',
+        (job_id,))]
+    pending = [f for f in file_data if f['status'] == 'pending']
+
+    total_files = len(file_data)
+    total_ips = sum(f['rows'] or 0 for f in file_data if f['status'] == 'done')
+    processed_ips = total_ips
+    start_time = time.time()
+    timings = StageTimings()
+
+    # Collect the distinct IPs across all files, reading only the client_ip column
+    unique_ips = {}
+    for file_info in pending:
+        if not file_info['path']:
+            continue
+        try:
+            with timings.stage('scan'):
+                columns = pd.read_csv(file_info['path'], nrows=0).columns
+                if 'client_ip' in columns:
+                    unique_ips.update(read_ip_column(file_info['path']))
+                    file_info['rows'] = count_rows(file_info['path'])
+                    total_ips += file_info['rows']
+            file_info['columns'] = columns
+        except Exception as e:
+            file_info['error'] = str(e)
+
+    # Local tiers first; only the misses go to the network
+    with timings.stage('cache'):
+        locations, misses, sources = lookup_local(list(unique_ips), fields)
+
+    yield {
+        'type': 'start',
+        'job_id': job_id,
+        'total_files': total_files,
+        'total_ips': total_ips,
+        'unique_ips': len(unique_ips),
+        'range_ips': sources['range'],
+        'prefix_ips': sources['prefix'],
+        'uncached_ips': len(misses)
+    }
+
+    for file_info in file_data:
+        if file_info['status'] == 'done':
+            yield {'type': 'file_complete', 'filename': file_info['filename'], 'status': 'success',
+                   'message': f"{file_info['message']} (already processed)"}
+
+    resolved = 0
+    waited_from = time.perf_counter()
+    for batch in resolve_by_block(misses):
+        timings.add('upstream', time.perf_counter() - waited_from)
+        for result in batch:
+            locations[result['ip']] = result
+        resolved += len(batch)
+        elapsed = time.time() - start_time
+        rate = resolved / elapsed if elapsed > 0 else 0
+        eta = (len(misses) - resolved) / rate if rate > 0 else 0
+
+        yield {
+            'type': 'resolving',
+            'resolved': resolved,
+            'uncached': len(misses),
+            'eta_seconds': round(eta),
+            'timings': timings.rounded()
+        }
+        waited_from = time.perf_counter()
+
+    location_df = location_frame(locations, fields)
+
+    for file_info in pending:
+        file_idx = file_info['file_idx']
+        if not file_info['path']:
+            checkpoint_file(job_id, file_idx, 'error', message='Failed to read file')
+            yield {'type': 'file_error', 'filename': file_info['filename'], 'message': 'Failed to read file'}
+            continue
+
+        try:
+            if file_info.get('error'):
+                raise ValueError(file_info['error'])
+
+            if 'client_ip' not in file_info['columns']:
+                checkpoint_file(job_id, file_idx, 'error', message='Missing client_ip column')
+                yield {'type': 'file_error', 'filename': file_info['filename'], 'message': 'Missing client_ip column'}
+                continue
+
+            file_ips = 0
+            file_started = time.time()
+            output_filename = result_filename(file_info['filename'], RESULT_FORMAT)
+            output_path = os.path.join('results', output_filename)
+
+            views = [] if dataset else None
+            for written in enrich_csv(file_info['path'], output_path, location_df, timings, aggregate, views):
+                processed_ips += written - file_ips
+                file_ips = written
+                elapsed = time.time() - start_time
+                rate = processed_ips / elapsed if elapsed > 0 else 0
+                eta = (total_ips - processed_ips) / rate if rate > 0 else 0
+                file_elapsed = time.time() - file_started
+
+                yield {
+                    'type': 'progress',
+                    'file_idx': file_idx + 1,
+                    'total_files': total_files,
+                    'current_file': file_info['filename'],
+                    'file_progress': file_ips,
+                    'file_total': max(file_info['rows'], file_ips),
+                    'total_progress': processed_ips,
+                    'total_ips': total_ips,
+                    'percentage': min(round((processed_ips / total_ips) * 100, 1), 100) if total_ips > 0 else 0,
+                    'eta_seconds': round(eta),
+                    'rows_per_second': round(file_ips / file_elapsed) if file_elapsed > 0 else 0,
+                    'timings': timings.rounded()
+                }
+
+            # The file was rewritten, so it no longer shows any earlier dataset's totals
+            traffic.forget_result(conn, output_filename)
+            if dataset:
+                with timings.stage('traffic'):
+                    traffic.merge_batch(conn, dataset, f"{job_id}/{file_idx}", views[0], result=output_filename)
+            checkpoint_file(job_id, file_idx, 'done', rows=file_ips, message=f'Processed {file_ips} IPs')
+            yield {'type': 'file_complete', 'filename': file_info['filename'], 'status': 'success', 'message': f'Processed {file_ips} IPs'}
+
+        except Exception as e:
+            checkpoint_file(job_id, file_idx, 'error', message=str(e))
+            yield {'type': 'file_complete', 'filename': file_info['filename'], 'status': 'error', 'message': str(e)}
+
+    yield {'type': 'complete', 'timings': timings.rounded()}
+
+
+# Rows a repair visits: transient errors and placeholder locations
+_repair_labels = "(SELECT id FROM cache_strings WHERE value IN ('Unknown', 'Error'))"
+REPAIR_CONDITION = (f"(status = 'error' OR country_id IN {_repair_labels} "
+                    f"OR region_id IN {_repair_labels} OR city_id IN {_repair_labels})")
+
+
+def parse_repair_filters(args, now=None):
+    """Validated repair filters from request ``args``; raises ValueError.
+
+    ``status`` keeps rows with that status, ``country`` rows with that exact
+    country and ``older_than_days`` rows fetched at least that long ago.
+    The age is fixed to a ``fetched_before`` time here, so a resumed repair
+    still selects the same rows.
+    """
+    if not isinstance(args, dict):
+        raise ValueError('Expected a JSON object of filters')
+    filters = {}
+    status = (args.get('status') or '').strip()
+    if status:
+        if status not in ('success', 'fail', 'error'):
+            raise ValueError(f'Unknown status: {status}')
+        filters['status'] = status
+    country = (args.get('country') or '').strip()
+    if country:
+        filters['country'] = country
+    days = args.get('older_than_days')
+    if days not in (None, ''):
+        try:
+            days = float(days)
+        except (TypeError, ValueError):
+            raise ValueError('older_than_days must be a number')
+        if not days >= 0:
+            raise ValueError('older_than_days must be a number')
+        filters['older_than_days'] = days
+        filters['fetched_before'] = (time.time() if now is None else now) - days * 86400
+    return filters
+
+
+def repair_where(filters):
+    """SQL condition and parameters for the ip_rows a repair with ``filters`` visits."""
+    clauses, params = [REPAIR_CONDITION], {}
+    if 'status' in filters:
+        clauses.append("status = :status")
+        params['status'] = filters['status']
+    if 'country' in filters:
+        clauses.append("country_id = (SELECT id FROM cache_strings WHERE value = :country)")
+        params['country'] = filters['country']
+    if 'fetched_before' in filters:
+        clauses.append("coalesce(fetched_at, 0) < :fetched_before")
+        params['fetched_before'] = filters['fetched_before']
+    return ' AND '.join(clauses), params
+
+
+def repairs(result, status):
+    """Whether a fresh answer should replace a problem row whose status is ``status``."""
+    if result['status'] == 'success':
+        return any(result[field] != 'Unknown' for field in ('country', 'region', 'city'))
+    # A definite "fail" (private or reserved range) still beats a transient error
+    return result['status'] == 'fail' and status == 'error'
+
+
+def process_repair(job_id):
+    """Re-resolve problem cache rows for a repair job, yielding progress events.
+
+    Walks ip_rows in key order from the job's cursor, REPAIR_CHUNK matching
+    rows at a time.  Each chunk goes through the shared resolver (concurrent
+    batches under its rate limits), and what improved is written in the
+    same transaction that advances the cursor, so a cancelled or
+    interrupted repair resumes after its last committed chunk.
+    """
+    cache_writer.flush()
+    conn = get_db()
+    row = conn.execute('SELECT options, cursor FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    filters = json.loads(row['options']).get('filters', {})
+    cursor = row['cursor'] or b''
+    where, params = repair_where(filters)
+    total = conn.execute(f"SELECT COUNT(*) FROM ip_rows WHERE key > :after AND {where}",
+                         dict(params, after=cursor)).fetchone()[0]
+    yield {'type': 'start', 'job_id': job_id, 'kind': 'repair', 'filters': filters, 'total_ips': total,
+           'resumed': bool(cursor)}
+
+    checked = fixed = 0
+    start_time = time.time()
+    while True:
+        rows = conn.execute(f"SELECT key, status FROM ip_rows WHERE key > :after AND {where} ORDER BY key LIMIT :limit",
+                            dict(params, after=cursor, limit=REPAIR_CHUNK)).fetchall()
+        if not rows:
             break
+        statuses = {ip_text(key): status for key, status in rows}
+
+        updates = []
+        resolved = 0
+        for batch in resolver.map_batches(list(statuses)):
+            updates += [result for result in batch if repairs(result, statuses[result['ip']])]
+            resolved += len(batch)
+            elapsed = time.time() - start_time
+            rate = (checked + resolved) / elapsed if elapsed > 0 else 0
+            yield {
+                'type': 'progress',
+                'checked': checked + resolved,
+                'fixed': fixed,
+                'total_ips': total,
+                'percentage': min(round((checked + resolved) / total * 100, 1), 100) if total else 100,
+                'eta_seconds': round((total - checked - resolved) / rate) if rate > 0 else 0,
+                'rows_per_second': round(rate),
+            }
 
-    # Save full response to cache
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute(
-        """
-        INSERT OR REPLACE INTO ip_cache (
-            ip, status, continent, continentCode, country, countryCode,
-            region, regionCode, city, district, zip, lat, lon, timezone,
-            offset, currency, isp, org, "as", asname, mobile, proxy, hosting
-        ) VALUES (
-            :ip, :status, :continent, :continentCode, :country, :countryCode,
-            :region, :regionCode, :city, :district, :zip, :lat, :lon, :timezone,
-            :offset, :currency, :isp, :org, :as, :asname, :mobile, :proxy, :hosting
+        # Strings are interned (and committed) before the chunk's own transaction
+        updates = stamp_results(updates)
+        encoded = encode_results(conn, updates)
+        cursor = rows[-1][0]
+        with conn:
+            conn.executemany(UPDATE_CACHE_SQL, encoded)
+            if prefix_cache.enabled:
+                conn.executemany(PrefixCache.INSERT_SQL, prefix_cache.blocks_for(updates))
+            conn.execute('UPDATE jobs SET cursor = ?, updated_at = ? WHERE id = ?', (cursor, time.time(), job_id))
+        hot_cache.invalidate(result['ip'] for result in updates)
+        invalidate_facets()
+        checked += len(rows)
+        fixed += len(updates)
+
+    yield {'type': 'complete', 'checked': checked, 'fixed': fixed, 'total_ips': total}
+
+
+# Pipelines behind each kind of job, as generators of progress events
+JOB_PIPELINES = {'upload': process_upload, 'repair': process_repair}
+
+
+def scan_file(path):
+    """Pool task for ``flask enrich``: the IPs of ``path`` the local tiers miss, and its row count."""
+    import pandas as pd
+
+    if 'client_ip' not in pd.read_csv(path, nrows=0).columns:
+        raise ValueError('Missing client_ip column')
+    _, misses, _ = lookup_local(list(read_ip_column(path)), ['status'])
+    return misses, count_rows(path)
+
+
+def enrich_file(path, output_path, progress, fields=ENRICH_FIELDS, aggregate=False, dataset=None):
+    """Pool task for ``flask enrich``: join cached ``fields`` onto ``path``.
+
+    Runs once the parent has resolved every miss, so the cache answers all
+    of the file's IPs.  Rows done are reported on the ``progress`` queue.
+    With a ``dataset``, the file's views are merged into its traffic totals,
+    once per file content (path, size and modification time).
+    """
+    locations, _, _ = lookup_local(list(read_ip_column(path)), fields)
+    stat = os.stat(path)
+    views = [] if dataset else None
+    written = 0
+    for rows in enrich_csv(path, output_path, location_frame(locations, fields), aggregate=aggregate, views=views):
+        progress.put(rows - written)
+        written = rows
+    traffic.forget_result(get_db(), os.path.basename(output_path))
+    if dataset:
+        batch = f"file:{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        traffic.merge_batch(get_db(), dataset, batch, views[0], result=os.path.basename(output_path))
+    return written
+
+
+def collect_csv_paths(paths):
+    """Expand directories in ``paths`` to the CSV files directly inside them."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.csv'))
+        else:
+            files.append(path)
+    return files
+
+
+@app.cli.command("enrich")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True, allow_dash=True))
+@click.option("--workers", "-j", default=os.cpu_count() or 1, help="Processes parsing and writing files")
+@click.option("--name", default="stdin.csv", help="File name to give input read from stdin (-)")
+@click.option("--fields", "-f", help="Comma-separated cached fields to append (default: country,region,city)")
+@click.option("--aggregate", is_flag=True, help="Collapse rows to one per IP with an ip_count column")
+@click.option("--dataset", help="Add each file's views to this traffic dataset's rolling totals")
+@click.option("--skip-existing", is_flag=True, help="Leave files whose result already exists alone")
+def enrich_command(paths, workers, name, fields, aggregate, dataset, skip_existing):
+    """Enrich CSV files, directories of them or stdin (-) into results/.
+
+    Uses the same cache, resolver and output format as the upload page.
+    Files are scanned and written in a process pool; every cache miss is
+    resolved once in this process so the upstream quota is shared.
+    """
+    from tqdm import tqdm
+
+    try:
+        fields = parse_fields(fields) or ENRICH_FIELDS
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--fields')
+    os.makedirs('results', exist_ok=True)
+    spooled = None
+    inputs = []
+    for path in collect_csv_paths(paths):
+        if path == '-':
+            # Read twice (IPs, then rows), so stdin is spooled to disk first
+            os.makedirs(UPLOAD_DIR, exist_ok=True)
+            spooled = os.path.join(UPLOAD_DIR, f'stdin-{uuid.uuid4().hex}.csv')
+            with open(spooled, 'wb') as f:
+                shutil.copyfileobj(click.get_binary_stream('stdin'), f)
+            path, filename = spooled, name
+        else:
+            filename = os.path.basename(path)
+        output_path = os.path.join('results', result_filename(filename, RESULT_FORMAT))
+        if skip_existing and os.path.exists(output_path):
+            click.echo(f"{filename}: skipped, {output_path} exists", err=True)
+            continue
+        inputs.append((filename, path, output_path))
+
+    started = time.time()
+    totals = {'files': 0, 'failed': 0, 'rows': 0, 'upstream': 0}
+    # Spawned rather than forked: this process holds SQLite connections and resolver threads
+    context = multiprocessing.get_context('spawn')
+    try:
+        with context.Manager() as manager, \
+                ProcessPoolExecutor(max(min(workers, len(inputs)), 1), mp_context=context) as pool:
+            misses = {}
+            rows = {}
+            scans = {pool.submit(scan_file, path): (filename, path, output_path)
+                     for filename, path, output_path in inputs}
+            for future in tqdm(as_completed(scans), total=len(scans), desc='scan', unit='file'):
+                filename, path, output_path = scans[future]
+                try:
+                    file_misses, rows[path] = future.result()
+                    misses.update(dict.fromkeys(file_misses))
+                except Exception as e:
+                    totals['failed'] += 1
+                    tqdm.write(f"{filename}: {e}")
+
+            totals['upstream'] = len(misses)
+            with tqdm(total=len(misses), desc='resolve', unit='ip') as bar:
+                for batch in resolve_by_block(list(misses)):
+                    bar.update(len(batch))
+            cache_writer.flush()
+
+            progress = manager.Queue()
+            jobs = {pool.submit(enrich_file, path, output_path, progress, fields, aggregate, dataset):
+                    (filename, output_path)
+                    for filename, path, output_path in inputs if path in rows}
+            with tqdm(total=sum(rows.values()), desc='enrich', unit='row') as bar:
+                pending = set(jobs)
+                while pending:
+                    done, pending = wait(pending, timeout=0.2)
+                    while not progress.empty():
+                        bar.update(progress.get())
+                    for future in done:
+                        filename, output_path = jobs[future]
+                        try:
+                            totals['rows'] += future.result()
+                            totals['files'] += 1
+                            tqdm.write(f"{filename}: {output_path}")
+                        except Exception as e:
+                            totals['failed'] += 1
+                            tqdm.write(f"{filename}: {e}")
+    finally:
+        if spooled and os.path.exists(spooled):
+            os.remove(spooled)
+
+    totals['seconds'] = round(time.time() - started, 1)
+    click.echo(json.dumps(totals))
+    if totals['failed']:
+        raise SystemExit(1)
+
+
+SNAPSHOT_COLUMNS = CACHE_COLUMNS + CACHE_META_COLUMNS
+
+
+@contextmanager
+def open_snapshot(path, mode):
+    """Binary stream for a snapshot ``path``; ``-`` is stdin/stdout and ``.gz`` is gzipped."""
+    if path == '-':
+        f = click.get_binary_stream('stdin' if mode == 'rb' else 'stdout')
+        close = False
+    else:
+        f = open(path, mode)
+        close = True
+    try:
+        if path.endswith('.gz') or (mode == 'rb' and f.peek(2)[:2] == b'\x1f\x8b'):
+            with gzip.GzipFile(fileobj=f, mode=mode) as stream:
+                yield stream
+        else:
+            yield f
+    finally:
+        if close:
+            f.close()
+
+
+def snapshot_schema():
+    """Arrow schema for Parquet snapshots: the text fields dictionary encoded."""
+    import pyarrow as pa
+    types = {"TEXT": pa.string(), "REAL": pa.float64(), "INTEGER": pa.int64()}
+    return pa.schema(
+        [pa.field(column, pa.dictionary(pa.int32(), pa.string()) if column in STRING_COLUMNS or column == "status"
+                  else types[CACHE_COLUMN_TYPES.get(column, "TEXT")]) for column in SNAPSHOT_COLUMNS])
+
+
+def export_cache(path, statuses=None, since=None, batch_size=10000):
+    """Stream ip_cache rows to ``path`` as Parquet or (gzipped) NDJSON; returns the row count."""
+    where, params = ["true"], []
+    if statuses:
+        where.append(f"status IN ({', '.join('?' * len(statuses))})")
+        params += statuses
+    if since is not None:
+        where.append("fetched_at >= ?")
+        params.append(since)
+    cursor = get_db().execute(
+        f"SELECT {CACHE_SELECT_COLUMNS} FROM ip_cache WHERE {' AND '.join(where)}", params)
+
+    count = 0
+    if path.endswith('.parquet'):
+        check_format('parquet')
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = snapshot_schema()
+        with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+            while rows := cursor.fetchmany(batch_size):
+                columns = list(zip(*rows))
+                writer.write_batch(pa.RecordBatch.from_arrays(
+                    [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+                count += len(rows)
+        return count
+
+    with open_snapshot(path, 'wb') as f:
+        while rows := cursor.fetchmany(batch_size):
+            f.write(''.join(json.dumps(dict(zip(SNAPSHOT_COLUMNS, row))) + '\n' for row in rows).encode())
+            count += len(rows)
+    return count
+
+
+def read_snapshot(path, batch_size=10000):
+    """Yield lists of row dicts from a Parquet or (gzipped) NDJSON snapshot."""
+    if path.endswith('.parquet'):
+        check_format('parquet')
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield batch.to_pylist()
+        return
+
+    with open_snapshot(path, 'rb') as f:
+        batch = []
+        for line in f:
+            if line.strip():
+                batch.append(json.loads(line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def snapshot_row(record, now):
+    """Import parameters for one snapshot record, stamping rows exported without expiry times."""
+    ip = record.get("ip")
+    if not isinstance(ip, str) or not ip or record.get("status") is None:
+        return None
+    if record.get("fetched_at") is None:
+        record["fetched_at"] = now
+    if record.get("expires_at") is None:
+        record["expires_at"] = record["fetched_at"] + CACHE_TTLS.get(record["status"], CACHE_TTL_FAIL)
+    return tuple(record.get(column) for column in SNAPSHOT_COLUMNS)
+
+
+def import_cache(path, batch_size=10000):
+    """Merge a snapshot into the cache in one transaction.
+
+    Each batch goes into a temp table with one executemany, then two
+    set-based statements intern its strings and upsert it into ip_rows.  A
+    row only replaces a cached one with a worse status, or the same status
+    fetched earlier.  Returns ``{read, written, skipped, invalid}``.
+    """
+    conn = get_db()
+    conn.execute(IMPORT_TABLE_SQL)
+    insert = f"INSERT INTO temp.cache_import VALUES ({', '.join('?' * len(SNAPSHOT_COLUMNS))})"
+    totals = {"read": 0, "written": 0, "skipped": 0, "invalid": 0}
+    now = time.time()
+    cache_writer.flush()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for records in read_snapshot(path, batch_size):
+            rows = [row for row in (snapshot_row(record, now) for record in records) if row is not None]
+            totals["read"] += len(records)
+            totals["invalid"] += len(records) - len(rows)
+            conn.execute("DELETE FROM temp.cache_import")
+            conn.executemany(insert, rows)
+            conn.execute(IMPORT_STRINGS_SQL)
+            totals["written"] += conn.execute(IMPORT_CACHE_SQL).rowcount
+            if prefix_cache.enabled:
+                conn.executemany(PrefixCache.INSERT_SQL, prefix_cache.blocks_for(
+                    [dict(zip(SNAPSHOT_COLUMNS, row)) for row in rows if row[1] == "success"]))
+        conn.execute("DELETE FROM temp.cache_import")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    totals["skipped"] = totals["read"] - totals["invalid"] - totals["written"]
+    hot_cache.invalidate()
+    prefix_cache.invalidate()
+    invalidate_facets()
+    return totals
+
+
+@app.cli.command("export-cache")
+@click.argument("path", type=click.Path(allow_dash=True))
+@click.option("--status", "statuses", multiple=True, type=click.Choice(["success", "fail", "error"]),
+              help="Only export rows with this status (repeatable)")
+@click.option("--since", type=click.DateTime(), help="Only export rows fetched at or after this date")
+def export_cache_command(path, statuses, since):
+    """Write the cache to a snapshot: PATH.parquet, PATH.ndjson[.gz] or - for stdout."""
+    started = time.time()
+    try:
+        count = export_cache(path, list(statuses), since.timestamp() if since else None)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps({"rows": count, "seconds": round(time.time() - started, 1)}), err=path == '-')
+
+
+@app.cli.command("import-cache")
+@click.argument("path", type=click.Path(exists=True, allow_dash=True))
+@click.option("--batch-size", default=10000, help="Rows per executemany batch")
+def import_cache_command(path, batch_size):
+    """Merge a snapshot written by export-cache (or - for NDJSON on stdin) into the cache."""
+    started = time.time()
+    try:
+        totals = import_cache(path, batch_size)
+    except (RuntimeError, ValueError) as e:
+        raise click.ClickException(str(e))
+    totals["seconds"] = round(time.time() - started, 1)
+    click.echo(json.dumps(totals))
+
+
+def follow_job(job_id, keepalive=15):
+    """Yield a job's events as SSE lines until it finishes.
+
+    Jobs running in this process are followed through their in-memory
+    condition; anything else (finished, or owned by another worker) is
+    polled from the ``jobs`` table.
+    """
+    version = -1
+    sent = 0
+    last_progress = None
+
+    while True:
+        job = active_jobs.get(job_id)
+        if job is not None:
+            new_version, events, progress, finished = job.wait(version, keepalive)
+            changed = new_version != version
+            version = new_version
+        else:
+            state = get_job(job_id)
+            if state is None:
+                yield f"data: {json.dumps({'type': 'error', 'message': 'Job not found'})}\n\n"
+                return
+            events, progress = state['events'], state['progress']
+            finished = state['status'] not in ('queued', 'running') or state['stale']
+            changed = len(events) > sent or progress != last_progress or finished
+            if not changed:
+                time.sleep(1)
+
+        if not changed:
+            yield ": keepalive\n\n"
+            continue
+
+        terminal = []
+        for event in events[sent:]:
+            if event['type'] in JOB_TERMINAL_EVENTS:
+                terminal.append(event)
+            else:
+                yield f"data: {json.dumps(event)}\n\n"
+        sent = len(events)
+
+        if progress is not None and progress != last_progress:
+            last_progress = progress
+            yield f"data: {json.dumps(progress)}\n\n"
+
+        for event in terminal:
+            yield f"data: {json.dumps(event)}\n\n"
+        if finished:
+            return
+
+
+# Search results are only counted up to this many rows
+SEARCH_COUNT_LIMIT = 10000
+
+_facets = {}
+
+
+def cache_facets():
+    """Distinct countries, regions and cities for the /cache filters.
+
+    Read from the stats aggregate tables and memoized until this process
+    writes to the cache, or FACET_CACHE_TTL seconds pass for writes made by
+    other workers.
+    """
+    facets = _facets.get('value')
+    if facets is None or _facets['expires'] < time.monotonic():
+        conn = get_db()
+        facets = (
+            [row[0] for row in conn.execute("SELECT country FROM stats_country WHERE country != '' ORDER BY country")],
+            [row[0] for row in conn.execute("SELECT DISTINCT region FROM stats_region WHERE region != '' ORDER BY region")],
+            [row[0] for row in conn.execute("SELECT DISTINCT city FROM stats_city WHERE city != '' ORDER BY city")],
         )
-        """,
-        result,
+        _facets.update(value=facets, expires=time.monotonic() + FACET_CACHE_TTL)
+    return facets
+
+
+def invalidate_facets():
+    _facets.pop('value', None)
+
+
+def count_cache_rows(conn, search, filters, where_clauses, params):
+    """Return ``(total, capped)`` for the /cache listing.
+
+    Filter-only listings are counted from the stats aggregate tables.
+    Searches are counted directly but stop at SEARCH_COUNT_LIMIT rows, in
+    which case ``capped`` is True.
+    """
+    if search:
+        count = conn.execute(
+            f"SELECT COUNT(*) FROM (SELECT 1 FROM ip_rows WHERE {' AND '.join(where_clauses)} LIMIT ?)",
+            params + [SEARCH_COUNT_LIMIT + 1]).fetchone()[0]
+        return min(count, SEARCH_COUNT_LIMIT), count > SEARCH_COUNT_LIMIT
+
+    active = {column: value for column, value in filters.items() if value}
+    if not active:
+        row = conn.execute("SELECT count FROM stats_totals WHERE name = 'total'").fetchone()
+        return (row[0] if row else 0), False
+
+    table = 'stats_city' if 'city' in active else 'stats_region' if 'region' in active else 'stats_country'
+    where_sql = ' AND '.join(f'{column} = ? COLLATE NOCASE' for column in active)
+    count = conn.execute(f'SELECT COALESCE(SUM(count), 0) FROM {table} WHERE {where_sql}',
+                         list(active.values())).fetchone()[0]
+    return count, False
+
+
+def classify_results(df):
+    """Label each row of an aggregated result as likely_fake or likely_real.
+
+    Adds a ``dynamic_classification`` column in place and returns
+    ``(dynamic_counts, classification_rules)`` for the summary table.
+    IPv4 addresses are grouped into /24s by masking their integer value;
+    anything else falls back to its first three dot-separated parts.
+    """
+    import numpy as np
+    import pandas as pd
+    from range_db import ipv4_to_int
+
+    numbers = ipv4_to_int(df['client_ip'].values)
+    is_v4 = numbers.notna().values
+
+    subnet = pd.Series(np.zeros(len(df), dtype=np.int64), index=df.index)
+    subnet[is_v4] = numbers[is_v4].astype(np.int64).values >> 8
+    if not is_v4.all():
+        # A bare "a.b.c" prefix still shares the key of its /24; anything else is
+        # factorized into negative codes so it never clashes with a real subnet
+        other = df['client_ip'][~is_v4].astype(str).str.split('.').str[:3].str.join('.')
+        prefix = ipv4_to_int(other + '.0')
+        keys = -1 - pd.factorize(other)[0]
+        keys[prefix.notna().values] = prefix.dropna().astype(np.int64).values >> 8
+        subnet[~is_v4] = keys
+
+    subnet_stats = pd.DataFrame({'subnet': subnet, 'client_ip': df['client_ip'], 'ip_count': df['ip_count']}) \
+        .groupby('subnet').agg(ip_count=('client_ip', 'count'), total_views=('ip_count', 'sum'))
+    suspicious_subnets = subnet_stats.index[
+        (subnet_stats['ip_count'] > SUBNET_IP_THRESHOLD) &
+        (subnet_stats['total_views'] > SUBNET_VIEW_THRESHOLD)
+    ]
+
+    df['dynamic_classification'] = np.select(
+        [df['ip_count'] >= HIGH_TRAFFIC_THRESHOLD, subnet.isin(suspicious_subnets)],
+        ['likely_fake', 'likely_fake'],
+        default='likely_real',
     )
-    conn.commit()
-    conn.close()
 
-    return result
+    summary = df.groupby('dynamic_classification')['ip_count'].agg(['count', 'sum']).reset_index()
+    summary.columns = ['classification', 'ip_address_count', 'total_views']
+    dynamic_counts = {
+        row.classification: {'ip_address_count': int(row.ip_address_count), 'total_views': int(row.total_views)}
+        for row in summary.itertuples()
+    }
 
+    return dynamic_counts, classification_rules(classification_thresholds())
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+
+def classification_thresholds(overrides=None):
+    """The classification thresholds, with any of them overridden from ``overrides`` (e.g. request.args)."""
+    overrides = overrides or {}
+    return {
+        "high_traffic": int(overrides.get("high_traffic", HIGH_TRAFFIC_THRESHOLD)),
+        "subnet_ips": int(overrides.get("subnet_ips", SUBNET_IP_THRESHOLD)),
+        "subnet_views": int(overrides.get("subnet_views", SUBNET_VIEW_THRESHOLD)),
+    }
 
 
-@app.route('/stats')
-def view_stats():
-    conn = sqlite3.connect(DB_FILE)
+def classification_rules(thresholds):
+    return [
+        f"Likely fake if IP count >= {thresholds['high_traffic']}",
+        f"Likely fake if subnet has > {thresholds['subnet_ips']} IPs and > {thresholds['subnet_views']} total views",
+        "Otherwise likely real",
+    ]
+
 
-    # Get total records
-    total_cursor = conn.execute('SELECT COUNT(*) FROM ip_cache')
-    total_ips = total_cursor.fetchone()[0]
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
 
-    # Top countries
-    country_cursor = conn.execute(
-        'SELECT country, COUNT(*) as count FROM ip_cache WHERE country != "Unknown" GROUP BY country ORDER BY count DESC LIMIT 10')
-    top_countries = country_cursor.fetchall()
 
-    # Top regions
-    region_cursor = conn.execute(
-        'SELECT region, country, COUNT(*) as count FROM ip_cache WHERE region != "Unknown" GROUP BY region, country ORDER BY count DESC LIMIT 10')
-    top_regions = region_cursor.fetchall()
+def load_result(filepath):
+    """Open and classify a results file, memoized on its path, mtime and size.
 
-    # Top cities
-    city_cursor = conn.execute(
-        'SELECT city, region, country, COUNT(*) as count FROM ip_cache WHERE city != "Unknown" GROUP BY city, region, country ORDER BY count DESC LIMIT 10')
-    top_cities = city_cursor.fetchall()
+    Keeps the last RESULT_CACHE_FILES files in memory so paging through a
+    file, or coming back to it, does not re-open and re-classify it.  Only
+    the client_ip and ip_count columns are read for the classification;
+    columnar files decode the rest of a page only when it is shown.  Files
+    merged into a traffic dataset are not classified here at all: their
+    labels and counts come from the dataset's rolling totals.
+    """
+    stat = os.stat(filepath)
+    dataset = traffic.dataset_for_result(get_db(), os.path.basename(filepath))
+    key = (filepath, stat.st_mtime_ns, stat.st_size, dataset)
+    with _result_cache_lock:
+        if key in _result_cache:
+            _result_cache.move_to_end(key)
+            return _result_cache[key]
 
-    # Unknown/Error counts
-    unknown_cursor = conn.execute(
-        'SELECT COUNT(*) FROM ip_cache WHERE country = "Unknown" OR region = "Unknown" OR city = "Unknown"')
-    unknown_count = unknown_cursor.fetchone()[0]
+    source = open_result(filepath)
+    labels = None
+    dynamic_counts = None
+    classification_rules = None
+    if dataset is None and {'client_ip', 'ip_count'}.issubset(source.columns):
+        df = source.read(['client_ip', 'ip_count'])
+        df['client_ip'] = df['client_ip'].astype(str)
+        dynamic_counts, classification_rules = classify_results(df)
+        labels = df['dynamic_classification'].values
+
+    entry = {
+        'source': source,
+        'dataset': dataset if 'client_ip' in source.columns else None,
+        'labels': labels,
+        'total_rows': source.num_rows,
+        'columns': list(source.columns),
+        'dynamic_counts': dynamic_counts,
+        'classification_rules': classification_rules,
+    }
+    with _result_cache_lock:
+        for cached in [k for k in _result_cache if k[0] == filepath]:
+            del _result_cache[cached]
+        _result_cache[key] = entry
+        while len(_result_cache) > RESULT_CACHE_FILES:
+            _result_cache.popitem(last=False)
+    return entry
+
+
+def result_page(entry, page, per_page):
+    """Return ``(records, total_pages)`` for one page of a loaded result."""
+    total_pages = max((entry['total_rows'] + per_page - 1) // per_page, 1)
+    page = min(max(page, 1), total_pages)
+    start = (page - 1) * per_page
+    chunk = entry['source'].rows(start, start + per_page).astype(object)
+    if entry['dataset']:
+        labels = traffic.classify_ips(get_db(), entry['dataset'], chunk['client_ip'], classification_thresholds())
+        chunk['dynamic_classification'] = [labels.get(str(ip), (None,))[0] for ip in chunk['client_ip']]
+    elif entry['labels'] is not None:
+        chunk['dynamic_classification'] = entry['labels'][start:start + len(chunk)]
+    records = chunk.where(chunk.notna(), None).to_dict(orient='records')
+    return records, total_pages
+
+
+def result_classification(entry):
+    """``(dynamic_counts, classification_rules)`` of a loaded result.
+
+    For a file in a traffic dataset these are the dataset's current totals,
+    so they are read on every call rather than memoized with the file.
+    """
+    if entry['dataset']:
+        thresholds = classification_thresholds()
+        dynamic_counts, _ = traffic.summarize(get_db(), entry['dataset'], thresholds, top=0)
+        return dynamic_counts, classification_rules(thresholds)
+    return entry['dynamic_counts'], entry['classification_rules']
+
+
+@app.route('/')
+def index():
+    return render_template('index.html')
 
-    error_cursor = conn.execute(
-        'SELECT COUNT(*) FROM ip_cache WHERE country = "Error" OR region = "Error" OR city = "Error"')
-    error_count = error_cursor.fetchone()[0]
 
-    conn.close()
+@app.route('/stats')
+def view_stats():
+    conn = get_db()
+
+    with DB_QUERY_SECONDS.time('stats'):
+        # Totals and top-N lists come from the trigger-maintained aggregate tables
+        totals = dict(conn.execute('SELECT name, count FROM stats_totals').fetchall())
+        total_ips = totals.get('total', 0)
+        unknown_count = totals.get('unknown', 0)
+        error_count = totals.get('error', 0)
+
+        # Top countries
+        country_cursor = conn.execute(
+            "SELECT country, count FROM stats_country WHERE country != 'Unknown' ORDER BY count DESC LIMIT 10")
+        top_countries = country_cursor.fetchall()
+
+        # Top regions
+        region_cursor = conn.execute(
+            "SELECT region, country, count FROM stats_region WHERE region != 'Unknown' ORDER BY count DESC LIMIT 10")
+        top_regions = region_cursor.fetchall()
+
+        # Top cities
+        city_cursor = conn.execute(
+            "SELECT city, region, country, count FROM stats_city WHERE city != 'Unknown' ORDER BY count DESC LIMIT 10")
+        top_cities = city_cursor.fetchall()
 
     return render_template('stats.html',
+                           hot_cache=hot_cache.stats(),
+                           refresh=refresh_scheduler.stats(),
+                           prefix=prefix_cache.stats(),
                            total_ips=total_ips,
                            top_countries=top_countries,
                            top_regions=top_regions,
@@ -293,57 +3060,78 @@ def view_cache():
     country_filter = request.args.get('country', '').strip()
     region_filter = request.args.get('region', '').strip()
     city_filter = request.args.get('city', '').strip()
+    # Keyset pagination: pages are addressed by the IP they start after / end before
+    after = request.args.get('after', '')
+    before = request.args.get('before', '')
+    last = request.args.get('last') == '1'
 
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
 
     where_clauses = []
     params = []
 
     if search:
-        where_clauses.append('(ip LIKE ? OR country LIKE ? OR region LIKE ? OR city LIKE ?)')
-        term = f'%{search}%'
-        params.extend([term, term, term, term])
-    if country_filter:
-        where_clauses.append('country = ?')
-        params.append(country_filter)
-    if region_filter:
-        where_clauses.append('region = ?')
-        params.append(region_filter)
-    if city_filter:
-        where_clauses.append('city = ?')
-        params.append(city_filter)
-
-    where_sql = 'WHERE ' + ' AND '.join(where_clauses) if where_clauses else ''
-
-    query = f'SELECT ip, country, region, city, lat, lon, isp, timezone FROM ip_cache {where_sql} ORDER BY ip LIMIT ? OFFSET ?'
-    params_with_limit = params + [per_page, (page - 1) * per_page]
-    cursor = conn.execute(query, params_with_limit)
-
-    count_query = f'SELECT COUNT(*) FROM ip_cache {where_sql}'
-    count_cursor = conn.execute(count_query, params)
-    total = count_cursor.fetchone()[0]
+        # Key ranges for the address part, and the NOCASE index on the strings for names
+        escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        ranges = ip_search_ranges(search)
+        names = "(SELECT id FROM cache_strings WHERE value LIKE ? ESCAPE '\\')"
+        where_clauses.append('(' + ' OR '.join(['key BETWEEN ? AND ?'] * len(ranges) + [
+            f'country_id IN {names}', f'region_id IN {names}', f'city_id IN {names}']) + ')')
+        params.extend([bound for pair in ranges for bound in pair] + [escaped] * 3)
+    filters = {'country': country_filter, 'region': region_filter, 'city': city_filter}
+    for column, value in filters.items():
+        if value:
+            # Resolved up front: a single id keeps the (column_id, key) index in key order
+            ids = [row[0] for row in conn.execute(
+                "SELECT id FROM cache_strings WHERE value = ? COLLATE NOCASE", (value,))]
+            where_clauses.append(f"{column}_id IN ({', '.join('?' * len(ids))})")
+            params.extend(ids)
+
+    seek_clauses = list(where_clauses)
+    seek_params = list(params)
+    descending = bool(before) or last
+    if after:
+        seek_clauses.append('key > ?')
+        seek_params.append(ip_key(after))
+    elif before:
+        seek_clauses.append('key < ?')
+        seek_params.append(ip_key(before))
+
+    seek_sql = 'WHERE ' + ' AND '.join(seek_clauses) if seek_clauses else ''
+    order = 'DESC' if descending else 'ASC'
+    # Pick the page from ip_rows alone, then join the strings for just those rows
+    page_keys = f'SELECT key FROM ip_rows {seek_sql} ORDER BY key {order} LIMIT ?'
+    query = (f'SELECT ip, country, region, city, lat, lon, isp, timezone FROM ip_cache '
+             f'WHERE key IN ({page_keys}) ORDER BY key {order}')
+    with DB_QUERY_SECONDS.time('cache_page'):
+        rows = [dict(row) for row in conn.execute(query, seek_params + [per_page + 1]).fetchall()]
+
+    has_more = len(rows) > per_page
+    cache_data = rows[:per_page]
+    if descending:
+        cache_data.reverse()
+        has_prev, has_next = has_more, not last
+    else:
+        has_prev, has_next = bool(after), has_more
+
+    with DB_QUERY_SECONDS.time('cache_count'):
+        total, total_capped = count_cache_rows(conn, search, filters, where_clauses, params)
+    total_pages = max((total + per_page - 1) // per_page, 1)
+    if last:
+        page = total_pages
 
     # Unique values for filters
-    countries = [row[0] for row in conn.execute('SELECT DISTINCT country FROM ip_cache WHERE country != "" ORDER BY country').fetchall()]
-    regions = [row[0] for row in conn.execute('SELECT DISTINCT region FROM ip_cache WHERE region != "" ORDER BY region').fetchall()]
-    cities = [row[0] for row in conn.execute('SELECT DISTINCT city FROM ip_cache WHERE city != "" ORDER BY city').fetchall()]
-
-    cache_data = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-
-    total_pages = (total + per_page - 1) // per_page
-
-    # Calculate page range for pagination
-    start_page = max(1, page - 2)
-    end_page = min(total_pages + 1, page + 3)
-    page_range = range(start_page, end_page)
+    with DB_QUERY_SECONDS.time('cache_facets'):
+        countries, regions, cities = cache_facets()
 
     return render_template('cache.html',
                            cache_data=cache_data,
                            total=total,
+                           total_capped=total_capped,
                            page=page,
                            total_pages=total_pages,
+                           has_prev=has_prev,
+                           has_next=has_next,
                            search=search,
                            country_filter=country_filter,
                            region_filter=region_filter,
@@ -351,8 +3139,7 @@ def view_cache():
                            countries=countries,
                            regions=regions,
                            cities=cities,
-                           per_page=per_page,
-                           page_range=page_range)
+                           per_page=per_page)
 
 
 @app.route('/lookup', methods=['POST'])
@@ -361,8 +3148,122 @@ def lookup_ip():
     if not ip:
         return jsonify({"error": "IP address required"}), 400
 
-    location = get_ip_location(ip)
-    return jsonify(location)
+    # Callers may ask for a shorter deadline, never a longer one
+    try:
+        deadline = float(request.json.get('deadline', LOOKUP_DEADLINE))
+    except (TypeError, ValueError):
+        deadline = math.nan
+    if not deadline > 0:
+        return jsonify({"error": "deadline must be a positive number of seconds"}), 400
+    deadline = min(deadline, LOOKUP_DEADLINE)
+
+    location = cached_location(ip)
+    if location:
+        return jsonify(location)
+
+    # Fail fast instead of queueing behind a drained or paused quota
+    wait = 0 if lookups.pending(ip) else resolver.single_bucket.delay()
+    future = lookups.submit(ip, fetch_location, ip) if wait <= deadline else None
+    if future is None:
+        retry_after = max(math.ceil(wait), 1)
+        return jsonify({"error": "Upstream is busy, retry later", "retry_after": retry_after}), 503, \
+            {"Retry-After": str(retry_after)}
+
+    try:
+        return jsonify(future.result(timeout=deadline))
+    except TimeoutError:
+        # The lookup carries on in the background and lands in the cache
+        lookups.timed_out()
+        return jsonify({"error": "Lookup timed out, retry later", "ip": ip}), 504
+
+
+def parse_batch_request():
+    """Return ``(ips, fields)`` from a /lookup/batch body.
+
+    Accepts a JSON array of IPs, a JSON object with ``ips`` and optional
+    ``fields``, or NDJSON with one IP string or ``{"ip": ...}`` object per
+    line.  ``?fields=country,city`` works with every body type.
+    """
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else None
+
+    if request.mimetype == 'application/json':
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            fields = body.get('fields', fields)
+            body = body.get('ips')
+        if not isinstance(body, list):
+            raise ValueError("Expected a JSON array of IPs or an object with an 'ips' array")
+        items = body
+    else:
+        items = []
+        for number, line in enumerate(request.get_data(as_text=True).splitlines(), 1):
+            if line.strip():
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    raise ValueError(f"Line {number} is not valid JSON")
+
+    ips = []
+    for item in items:
+        ip = item.get('ip') if isinstance(item, dict) else item
+        if not isinstance(ip, str) or not ip.strip():
+            raise ValueError(f"Not an IP address: {json.dumps(item)}")
+        ips.append(ip.strip())
+
+    return ips, parse_fields(fields)
+
+
+def stream_batch(ips, fields):
+    """Yield NDJSON lines for ``ips``: cached answers first, then upstream batches.
+
+    Each distinct IP gets one line with ``ip``, ``status`` and the chosen
+    fields; a final ``{"stats": ...}`` line summarises where answers came from.
+    """
+    started = time.perf_counter()
+    unique = list(dict.fromkeys(ips))
+    columns = ['ip', 'status'] + [c for c in CACHE_COLUMNS[2:] if fields is None or c in fields]
+
+    def lines(results):
+        return ''.join(json.dumps({column: result.get(column) for column in columns}) + '\n' for result in results)
+
+    locations, misses, sources = lookup_local(unique, columns)
+    pending = set(misses)
+    answered = [locations[ip] for ip in unique if ip not in pending]
+    for i in range(0, len(answered), 1000):
+        yield lines(answered[i:i + 1000])
+
+    upstream_started = time.perf_counter()
+    errors = 0
+    for batch in resolve_by_block(misses):
+        errors += sum(1 for result in batch if result['status'] == 'error')
+        yield lines(batch)
+
+    yield json.dumps({"stats": {
+        "requested": len(ips),
+        "unique": len(unique),
+        "cached": sources['cache'],
+        "range": sources['range'],
+        "prefix": sources['prefix'],
+        "upstream": len(misses),
+        "errors": errors,
+        "upstream_seconds": round(time.perf_counter() - upstream_started, 3) if misses else 0,
+        "seconds": round(time.perf_counter() - started, 3),
+    }}) + '\n'
+
+
+@app.route('/lookup/batch', methods=['POST'])
+def lookup_batch():
+    try:
+        ips, fields = parse_batch_request()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not ips:
+        return jsonify({"error": "IP addresses required"}), 400
+    if len(ips) > LOOKUP_BATCH_MAX:
+        return jsonify({"error": f"At most {LOOKUP_BATCH_MAX} IPs per request"}), 413
+
+    return Response(stream_batch(ips, fields), mimetype='application/x-ndjson')
 
 
 @app.route('/upload', methods=['POST'])
@@ -371,88 +3272,83 @@ def upload_csv():
     if not files or files[0].filename == '':
         return Response(f"data: {json.dumps({'type': 'error', 'message': 'No files uploaded'})}\n\n",
                         mimetype='text/event-stream')
+    try:
+        fields = parse_fields(request.form.get('fields'))
+    except ValueError as e:
+        return Response(f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n",
+                        mimetype='text/event-stream')
+    options = {'fields': fields, 'aggregate': request.form.get('aggregate', '').lower() in ('1', 'true', 'on'),
+               'dataset': request.form.get('dataset', '').strip() or None}
 
-    # Read and store file contents upfront
-    file_data = []
-    for file in files:
-        if file.filename.endswith('.csv'):
-            try:
-                content = file.read()
-                file_data.append({'filename': file.filename, 'content': content})
-            except:
-                file_data.append({'filename': file.filename, 'content': None})
+    # The job runs in the background; this response just watches it
+    job_id = create_job(files, options)
+    start_job(job_id)
 
     def generate():
-        os.makedirs('results', exist_ok=True)
-
-        total_files = len(file_data)
-        total_ips = 0
-        processed_ips = 0
-        start_time = time.time()
-
-        # Count total IPs
-        for file_info in file_data:
-            if file_info['content']:
-                try:
-                    df = pd.read_csv(io.StringIO(file_info['content'].decode('utf-8')))
-                    if 'client_ip' in df.columns:
-                        total_ips += len(df)
-                except:
-                    pass
-
-        yield f"data: {json.dumps({'type': 'start', 'total_files': total_files, 'total_ips': total_ips})}\n\n"
-
-        for file_idx, file_info in enumerate(file_data):
-            if not file_info['content']:
-                yield f"data: {json.dumps({'type': 'file_error', 'filename': file_info['filename'], 'message': 'Failed to read file'})}\n\n"
-                continue
-
-            try:
-                df = pd.read_csv(io.StringIO(file_info['content'].decode('utf-8')))
-                if 'client_ip' not in df.columns:
-                    yield f"data: {json.dumps({'type': 'file_error', 'filename': file_info['filename'], 'message': 'Missing client_ip column'})}\n\n"
-                    continue
-
-                file_ips = len(df)
-                locations = []
-
-                for ip_idx, ip in enumerate(df['client_ip']):
-                    location = get_ip_location(str(ip), use_delay=True)
-                    locations.append([location['country'], location['region'], location['city']])
-                    processed_ips += 1
-
-                    if (ip_idx + 1) % 5 == 0 or ip_idx == file_ips - 1:
-                        elapsed = time.time() - start_time
-                        rate = processed_ips / elapsed if elapsed > 0 else 0
-                        eta = (total_ips - processed_ips) / rate if rate > 0 else 0
-
-                        yield f"data: {json.dumps({
-                            'type': 'progress',
-                            'file_idx': file_idx + 1,
-                            'total_files': total_files,
-                            'current_file': file_info['filename'],
-                            'file_progress': ip_idx + 1,
-                            'file_total': file_ips,
-                            'total_progress': processed_ips,
-                            'total_ips': total_ips,
-                            'percentage': round((processed_ips / total_ips) * 100, 1) if total_ips > 0 else 0,
-                            'eta_seconds': round(eta)
-                        })}\n\n"
-
-                df[['country', 'region', 'city']] = locations
-
-                output_filename = f"processed_{file_info['filename']}"
-                output_path = os.path.join('results', output_filename)
-                df.to_csv(output_path, index=False)
-
-                yield f"data: {json.dumps({'type': 'file_complete', 'filename': file_info['filename'], 'status': 'success', 'message': f'Processed {file_ips} IPs'})}\n\n"
+        yield f"data: {json.dumps({'type': 'job', 'job_id': job_id})}\n\n"
+        yield from follow_job(job_id)
 
-            except Exception as e:
-                yield f"data: {json.dumps({'type': 'file_complete', 'filename': file_info['filename'], 'status': 'error', 'message': str(e)})}\n\n"
+    return Response(generate(), mimetype='text/plain')
 
-        yield f"data: {json.dumps({'type': 'complete'})}\n\n"
 
-    return Response(generate(), mimetype='text/plain')
+@app.route('/jobs')
+def list_jobs():
+    rows = get_db().execute(
+        'SELECT id, status, created_at, updated_at, error FROM jobs ORDER BY created_at DESC LIMIT 50').fetchall()
+    return jsonify([dict(row) for row in rows])
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    if get_job(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+    return Response(follow_job(job_id), mimetype='text/event-stream')
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    if job['status'] not in ('queued', 'running'):
+        return jsonify({"error": f"Job is {job['status']}"}), 409
+
+    conn = get_db()
+    with conn:
+        conn.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ?', (job_id,))
+        if job['stale']:
+            conn.execute("UPDATE jobs SET status = 'cancelled' WHERE id = ?", (job_id,))
+    return jsonify({"success": True})
+
+
+@app.route('/jobs/<job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    if not job['resumable']:
+        return jsonify({"error": f"Job is {job['status']}"}), 409
+
+    conn = get_db()
+    with conn:
+        # Only claim the job if nobody (its owner's heartbeat, another resume) touched it since
+        claimed = conn.execute(
+            "UPDATE jobs SET status = 'queued', cancel_requested = 0, events = '[]', progress = NULL, "
+            "error = NULL, updated_at = ? WHERE id = ? AND status = ? AND updated_at = ?",
+            (time.time(), job_id, job['status'], job['updated_at'])).rowcount
+        if not claimed:
+            return jsonify({"error": "Job changed while resuming; check its status"}), 409
+        conn.execute("UPDATE job_files SET status = 'pending' WHERE job_id = ? AND status = 'error'", (job_id,))
+    start_job(job_id)
+    return jsonify({"success": True, "job_id": job_id})
 
 
 @app.route('/results')
@@ -462,7 +3358,7 @@ def list_results():
 
     files = []
     for filename in os.listdir('results'):
-        if filename.endswith('.csv'):
+        if is_result_file(filename):
             filepath = os.path.join('results', filename)
             stat = os.stat(filepath)
             files.append({
@@ -481,63 +3377,128 @@ def view_result(filename):
     if not os.path.exists(filepath):
         return 'File not found', 404
     try:
-        df = pd.read_csv(filepath)
+        entry = load_result(filepath)
     except Exception as e:
         return str(e), 500
-    dynamic_counts = None
-    classification_rules = None
 
-    if {'client_ip', 'ip_count'}.issubset(df.columns):
-        df['subnet_24'] = df['client_ip'].astype(str).apply(lambda x: '.'.join(x.split('.')[:3]))
+    page = int(request.args.get('page', 1))
+    records, total_pages = result_page(entry, page, VIEW_PAGE_SIZE)
+    dynamic_counts, classification_rules = result_classification(entry)
+
+    return render_template(
+        'view.html',
+        filename=filename,
+        records=records,
+        columns=entry['columns'],
+        total_rows=entry['total_rows'],
+        page=min(max(page, 1), total_pages),
+        total_pages=total_pages,
+        dataset=entry['dataset'],
+        dynamic_counts=dynamic_counts,
+        classification_rules=classification_rules
+    )
 
 
-        subnet_stats = df.groupby('subnet_24').agg(
-            ip_count=('client_ip', 'count'),
-            total_views=('ip_count', 'sum')
-        ).reset_index()
+@app.route('/view/<filename>/records')
+def view_result_records(filename):
+    filepath = os.path.join('results', filename)
+    if not os.path.exists(filepath):
+        return jsonify({"error": "File not found"}), 404
+    try:
+        entry = load_result(filepath)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-        suspicious_subnets = subnet_stats[
-            (subnet_stats['ip_count'] > SUBNET_IP_THRESHOLD) &
-            (subnet_stats['total_views'] > SUBNET_VIEW_THRESHOLD)
-        ]['subnet_24'].tolist()
+    page = int(request.args.get('page', 1))
+    per_page = min(int(request.args.get('per_page', VIEW_PAGE_SIZE)), 1000)
+    records, total_pages = result_page(entry, page, per_page)
+    return jsonify({
+        "columns": entry['columns'] + (['dynamic_classification']
+                                       if entry['labels'] is not None or entry['dataset'] else []),
+        "records": records,
+        "page": min(max(page, 1), total_pages),
+        "per_page": per_page,
+        "total_rows": entry['total_rows'],
+        "total_pages": total_pages,
+    })
+
+
+@app.route('/view/<filename>/summary')
+def view_result_summary(filename):
+    filepath = os.path.join('results', filename)
+    if not os.path.exists(filepath):
+        return jsonify({"error": "File not found"}), 404
+    try:
+        entry = load_result(filepath)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-        def classify_dynamic(row):
-            if row['ip_count'] >= HIGH_TRAFFIC_THRESHOLD:
-                return 'likely_fake'
-            if row['subnet_24'] in suspicious_subnets:
-                return 'likely_fake'
-            return 'likely_real'
+    dynamic_counts, classification_rules = result_classification(entry)
+    return jsonify({
+        "total_rows": entry['total_rows'],
+        "dataset": entry['dataset'],
+        "dynamic_counts": dynamic_counts,
+        "classification_rules": classification_rules,
+    })
 
-        df['dynamic_classification'] = df.apply(classify_dynamic, axis=1)
 
-        summary = df.groupby('dynamic_classification')['ip_count'].agg(['count', 'sum']).reset_index()
-        summary.columns = ['classification', 'ip_address_count', 'total_views']
-        dynamic_counts = summary.set_index('classification').to_dict(orient='index')
+@app.route('/traffic')
+def list_traffic():
+    return jsonify({"datasets": traffic.list_datasets(get_db())})
 
-        classification_rules = [
-            f"Likely fake if IP count >= {HIGH_TRAFFIC_THRESHOLD}",
-            f"Likely fake if subnet has > {SUBNET_IP_THRESHOLD} IPs and > {SUBNET_VIEW_THRESHOLD} total views",
-            "Otherwise likely real",
-        ]
 
-        df.drop(columns=['subnet_24'], inplace=True)
+@app.route('/traffic/<dataset>')
+def traffic_summary(dataset):
+    """Classify a dataset's rolling totals; thresholds can be overridden in the query string."""
+    try:
+        thresholds = classification_thresholds(request.args)
+    except ValueError:
+        return jsonify({"error": "Thresholds must be integers"}), 400
+    started = time.perf_counter()
+    dynamic_counts, subnets = traffic.summarize(get_db(), dataset, thresholds)
+    if not dynamic_counts:
+        return jsonify({"error": "Dataset not found"}), 404
+    return jsonify({
+        "dataset": dataset,
+        "thresholds": thresholds,
+        "dynamic_counts": dynamic_counts,
+        "classification_rules": classification_rules(thresholds),
+        "suspicious_subnets": subnets,
+        "seconds": round(time.perf_counter() - started, 4),
+    })
+
+
+@app.route('/traffic/<dataset>/ip/<ip>')
+def traffic_ip(dataset, ip):
+    try:
+        thresholds = classification_thresholds(request.args)
+    except ValueError:
+        return jsonify({"error": "Thresholds must be integers"}), 400
+    labels = traffic.classify_ips(get_db(), dataset, [ip], thresholds)
+    if ip not in labels:
+        return jsonify({"error": "IP not seen in this dataset"}), 404
+    label, views = labels[ip]
+    return jsonify({"dataset": dataset, "ip": ip, "views": views, "classification": label})
 
-    records = df.to_dict(orient='records')
-    columns = [c for c in df.columns if c != 'dynamic_classification']
 
-    return render_template(
-        'view.html',
-        filename=filename,
-        records=records,
-        columns=columns,
-        dynamic_counts=dynamic_counts,
-        classification_rules=classification_rules
-    )
+@app.route('/traffic/<dataset>/delete', methods=['POST'])
+def delete_traffic(dataset):
+    traffic.delete_dataset(get_db(), dataset)
+    return jsonify({"success": True})
 
 
 @app.route('/download/<filename>')
 def download_result(filename):
-    return send_file(os.path.join('results', filename), as_attachment=True)
+    filepath = os.path.join('results', filename)
+    if filename.endswith('.csv'):
+        return send_file(filepath, as_attachment=True)
+    if not is_result_file(filename) or not os.path.exists(filepath):
+        return 'File not found', 404
+
+    # Columnar results are converted to CSV batch by batch as they are sent
+    csv_name = os.path.splitext(filename)[0] + '.csv'
+    return Response(iter_csv(filepath), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{csv_name}"'})
 
 
 @app.route('/delete/<filename>', methods=['POST'])
@@ -546,6 +3507,7 @@ def delete_result(filename):
         filepath = os.path.join('results', filename)
         if os.path.exists(filepath):
             os.remove(filepath)
+            traffic.forget_result(get_db(), filename)
             return jsonify({"success": True})
         return jsonify({"error": "File not found"}), 404
     except Exception as e:
@@ -556,10 +3518,14 @@ def delete_result(filename):
 def delete_cache_ip(ip):
     """Delete a single IP entry from the cache."""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        conn.execute('DELETE FROM ip_cache WHERE ip = ?', (ip,))
-        conn.commit()
-        conn.close()
+        cache_writer.flush()
+        conn = get_db()
+        with conn:
+            conn.execute('DELETE FROM ip_rows WHERE key = ?', (ip_key(ip),))
+            conn.execute('DELETE FROM ip_prefix WHERE key = ?', (ip_key(ip),))
+        hot_cache.invalidate([ip])
+        prefix_cache.invalidate()
+        invalidate_facets()
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -568,10 +3534,14 @@ def delete_cache_ip(ip):
 @app.route('/clean-cache', methods=['POST'])
 def clean_cache():
     try:
-        conn = sqlite3.connect(DB_FILE)
-        conn.execute('DELETE FROM ip_cache')
-        conn.commit()
-        conn.close()
+        cache_writer.flush()
+        conn = get_db()
+        with conn:
+            conn.execute('DELETE FROM ip_rows')
+            conn.execute('DELETE FROM ip_prefix')
+        hot_cache.invalidate()
+        prefix_cache.invalidate()
+        invalidate_facets()
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -582,84 +3552,100 @@ def clean_results():
     try:
         if os.path.exists('results'):
             for filename in os.listdir('results'):
-                if filename.endswith('.csv'):
+                if is_result_file(filename):
                     os.remove(os.path.join('results', filename))
+                    traffic.forget_result(get_db(), filename)
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/prefix-cache')
+def prefix_cache_status():
+    """Prefix cache hit rates; ``?bits=24,20`` adds an accuracy check per length."""
+    stats = prefix_cache.stats()
+    if request.args.get('bits'):
+        try:
+            bits = [int(b) for b in request.args['bits'].split(',')]
+            sample = int(request.args.get('sample', 100000))
+        except ValueError:
+            return jsonify({"error": "bits and sample must be integers"}), 400
+        try:
+            stats['accuracy'] = prefix_accuracy(bits, sample)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    return jsonify(stats)
+
+
+@app.route('/refresh-cache', methods=['GET', 'POST'])
+def refresh_cache():
+    """Report the background refresh; POST starts a round right away."""
+    if request.method == 'POST':
+        refresh_scheduler.trigger()
+        return jsonify(refresh_scheduler.stats()), 202
+    return jsonify(refresh_scheduler.stats())
+
+
 @app.route('/fix-cache', methods=['POST'])
 def fix_cache():
     try:
-        conn = sqlite3.connect(DB_FILE)
+        body = request.get_json(silent=True)
+        filters = parse_repair_filters(request.form if body is None else body)
+    except ValueError as e:
+        return Response(f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n",
+                        mimetype='text/event-stream')
 
-        # Get IPs with Unknown or Error data
-        cursor = conn.execute(
-            "SELECT ip FROM ip_cache WHERE country IN ('Unknown', 'Error') OR region IN ('Unknown', 'Error') OR city IN ('Unknown', 'Error')")
-        problem_ips = [row[0] for row in cursor.fetchall()]
+    # Runs as a background job like uploads; this response just watches it
+    job_id = create_job([], {'kind': 'repair', 'filters': filters})
+    start_job(job_id)
 
-        fixed_count = 0
-        for ip in problem_ips:
-            try:
-                response = requests.get(f"http://ip-api.com/json/{ip}", timeout=5)
-                data = response.json()
-
-                if data.get("status") == "success":
-                    result = {
-                        "ip": ip,
-                        "status": data.get("status"),
-                        "continent": data.get("continent", "Unknown"),
-                        "continentCode": data.get("continentCode", "Unknown"),
-                        "country": data.get("country", "Unknown"),
-                        "countryCode": data.get("countryCode", "Unknown"),
-                        "region": data.get("regionName", "Unknown"),
-                        "regionCode": data.get("region", ""),
-                        "city": data.get("city", "Unknown"),
-                        "district": data.get("district", ""),
-                        "zip": data.get("zip", ""),
-                        "lat": data.get("lat"),
-                        "lon": data.get("lon"),
-                        "timezone": data.get("timezone", ""),
-                        "offset": data.get("offset"),
-                        "currency": data.get("currency", ""),
-                        "isp": data.get("isp", ""),
-                        "org": data.get("org", ""),
-                        "as": data.get("as", ""),
-                        "asname": data.get("asname", ""),
-                        "mobile": int(data.get("mobile", 0)),
-                        "proxy": int(data.get("proxy", 0)),
-                        "hosting": int(data.get("hosting", 0)),
-                    }
-
-                    # Only update if we got better data
-                    if result["country"] != "Unknown" or result["region"] != "Unknown" or result["city"] != "Unknown":
-                        conn.execute(
-                            """
-                            UPDATE ip_cache SET
-                                status=:status, continent=:continent, continentCode=:continentCode,
-                                country=:country, countryCode=:countryCode, region=:region,
-                                regionCode=:regionCode, city=:city, district=:district,
-                                zip=:zip, lat=:lat, lon=:lon, timezone=:timezone, offset=:offset,
-                                currency=:currency, isp=:isp, org=:org, "as"=:as, asname=:asname,
-                                mobile=:mobile, proxy=:proxy, hosting=:hosting
-                            WHERE ip=:ip
-                            """,
-                            result,
-                        )
-                        fixed_count += 1
-
-                time.sleep(0.1)  # Rate limiting
-            except:
-                continue
+    def generate():
+        yield f"data: {json.dumps({'type': 'job', 'job_id': job_id})}\n\n"
+        yield from follow_job(job_id)
 
-        conn.commit()
-        conn.close()
+    return Response(generate(), mimetype='text/plain')
 
-        return jsonify({"success": True, "fixed": fixed_count, "total": len(problem_ips)})
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+
+# State that already has its own counters is read at scrape time
+metrics.gauge("iplookup_hot_cache_entries", "Entries in the in-memory cache tier",
+              lambda: hot_cache.stats()["entries"])
+metrics.gauge("iplookup_hot_cache_events", "In-memory cache hits, misses, evictions and expirations",
+              lambda: {key: hot_cache.stats()[key] for key in ("hits", "misses", "evictions", "expirations")},
+              ["event"])
+metrics.gauge("iplookup_prefix_cache_events", "Prefix cache hits, misses and same-run reuse",
+              lambda: {key: prefix_cache.stats()[key] for key in ("memory_hits", "db_hits", "misses", "shared")},
+              ["event"])
+metrics.gauge("iplookup_lookups_in_flight", "Distinct single-IP lookups waiting on the upstream",
+              lambda: lookups.stats()["pending"])
+metrics.gauge("iplookup_lookup_events", "Single-IP lookups coalesced, rejected or timed out",
+              lambda: {key: lookups.stats()[key] for key in ("coalesced", "rejected", "timeouts")},
+              ["event"])
+metrics.gauge("iplookup_upstream_in_flight", "ip-api.com requests currently in flight", lambda: resolver.inflight)
+metrics.gauge("iplookup_cache_writer_queue", "Result sets waiting for the cache writer",
+              lambda: cache_writer.queue.qsize())
+metrics.gauge("iplookup_cache_expired", "Cached rows past their expiry", lambda: refresh_scheduler.stats()["due"])
+metrics.gauge("iplookup_jobs_running", "Upload jobs running in this process",
+              lambda: sum(1 for job in active_jobs.values() if not job.finished))
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics.enabled:
+        return 'Metrics are disabled', 404
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def create_app():
+    """Application factory for WSGI servers: ``gunicorn 'app:create_app()'``.
+
+    Importing this module does no I/O; the schema is checked on the first
+    database connection.  The factory does that check up front instead, so
+    a pending migration runs while the worker boots rather than inside its
+    first request.
+    """
+    init_db()
+    return app
 
 
 if __name__ == '__main__':
-    app.run(debug=DEBUG, port=PORT)
+    create_app().run(debug=DEBUG, port=PORT)
@@ -0,0 +1,94 @@
+"""Micro-benchmark for cache reads and writes against SQLite.
+
+Compares the old connect-per-call pattern with the pooled per-thread
+connections and the group-committing cache writer in ``app.py``.
+
+    python benchmarks/db_lookups.py --rows 50000 --lookups 20000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_ips(count, seed=1):
+    rng = random.Random(seed)
+    return [f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+            for _ in range(count)]
+
+
+def rate(count, seconds):
+    return count / seconds if seconds > 0 else float("inf")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000, help="rows preloaded into the cache")
+    parser.add_argument("--lookups", type=int, default=10000, help="cached lookups to time")
+    parser.add_argument("--writes", type=int, default=2000, help="single-row cache writes to time")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="ipcache-bench-")
+    os.environ["DB_FILE"] = os.path.join(workdir, "pooled.db")
+    sys.path.insert(0, ROOT)
+    import app
+
+    rows = [app.placeholder_result(ip, "success", "Bench") for ip in dict.fromkeys(make_ips(args.rows))]
+    app.save_results(rows).wait()
+    probes = [random.choice(rows)["ip"] for _ in range(args.lookups)]
+
+    # Connect-per-call baseline on a copy of the same data in rollback-journal mode
+    legacy_db = os.path.join(workdir, "legacy.db")
+    columns = app.CACHE_COLUMNS + app.CACHE_META_COLUMNS
+    column_sql = ', '.join(f'"{column}"' for column in columns)
+    conn = sqlite3.connect(legacy_db)
+    conn.execute(f"CREATE TABLE ip_cache ({column_sql}, PRIMARY KEY (ip))")
+    legacy_insert = f"INSERT OR REPLACE INTO ip_cache ({column_sql}) VALUES ({', '.join(f':{c}' for c in columns)})"
+    conn.executemany(legacy_insert, app.stamp_results(rows))
+    conn.commit()
+    conn.close()
+
+    start = time.perf_counter()
+    for ip in probes:
+        conn = sqlite3.connect(legacy_db)
+        conn.row_factory = sqlite3.Row
+        dict(conn.execute("SELECT * FROM ip_cache WHERE ip = ?", (ip,)).fetchone())
+        conn.close()
+    legacy_reads = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for ip in probes:
+        app.get_ip_location(ip)
+    pooled_reads = time.perf_counter() - start
+
+    writes = [app.placeholder_result(ip, "success", "Write") for ip in make_ips(args.writes, seed=2)]
+
+    start = time.perf_counter()
+    for row in writes:
+        conn = sqlite3.connect(legacy_db)
+        conn.execute(legacy_insert, app.stamp_results([row])[0])
+        conn.commit()
+        conn.close()
+    legacy_writes = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for row in writes:
+        app.save_results([row])
+    app.cache_writer.flush()
+    pooled_writes = time.perf_counter() - start
+
+    print(f"cached rows: {len(rows)}, lookups: {len(probes)}, writes: {len(writes)}")
+    print(f"{'':<10}{'connect per call':>20}{'pooled + WAL':>20}{'speedup':>10}")
+    print(f"{'reads/s':<10}{rate(len(probes), legacy_reads):>20,.0f}{rate(len(probes), pooled_reads):>20,.0f}"
+          f"{legacy_reads / pooled_reads:>9.1f}x")
+    print(f"{'writes/s':<10}{rate(len(writes), legacy_writes):>20,.0f}{rate(len(writes), pooled_writes):>20,.0f}"
+          f"{legacy_writes / pooled_writes:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
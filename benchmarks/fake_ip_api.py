@@ -0,0 +1,201 @@
+"""Local stand-in for ip-api.com with configurable latency and faults.
+
+Serves ``GET /json/<ip>`` and ``POST /batch`` with deterministic answers
+derived from the address (country per /8, region per /16, city per /24), so
+benchmark runs are repeatable and never touch the real service.  Private and
+reserved addresses get ``{"status": "fail"}`` like the real API.
+
+    python benchmarks/fake_ip_api.py --port 8099 --latency 0.05 --rate-limit 0.01 --fail-rate 0.01
+    IP_API_URL=http://127.0.0.1:8099 python app.py
+"""
+import argparse
+import ipaddress
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COUNTRIES = [
+    ("United States", "US", "North America", "NA"), ("Germany", "DE", "Europe", "EU"),
+    ("Japan", "JP", "Asia", "AS"), ("Brazil", "BR", "South America", "SA"),
+    ("India", "IN", "Asia", "AS"), ("France", "FR", "Europe", "EU"),
+    ("Australia", "AU", "Oceania", "OC"), ("Nigeria", "NG", "Africa", "AF"),
+    ("Canada", "CA", "North America", "NA"), ("Cambodia", "KH", "Asia", "AS"),
+]
+
+
+def answer(ip):
+    """The fake API's response object for ``ip``."""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return {"status": "fail", "message": "invalid query", "query": ip}
+    if not address.is_global:
+        return {"status": "fail", "message": "private range", "query": ip}
+
+    packed = address.packed
+    country, code, continent, continent_code = COUNTRIES[packed[0] % len(COUNTRIES)]
+    region = f"{code}-R{packed[1] % 20}"
+    city = f"{code} City {(packed[1] * 256 + packed[2]) % 500}"
+    asn = 1000 + packed[0] * 256 + packed[1]
+    return {
+        "status": "success", "query": ip,
+        "continent": continent, "continentCode": continent_code,
+        "country": country, "countryCode": code,
+        "region": region, "regionName": f"Region {region}", "city": city,
+        "district": "", "zip": f"{packed[2]:03d}{packed[-1] % 100:02d}",
+        "lat": round(-60 + packed[0] * 0.47 + packed[2] * 0.001, 4),
+        "lon": round(-170 + packed[1] * 1.3 + packed[2] * 0.001, 4),
+        "timezone": "UTC", "offset": 0, "currency": "USD",
+        "isp": f"ISP {asn}", "org": f"Org {asn}", "as": f"AS{asn} Net {asn}", "asname": f"NET{asn}",
+        "mobile": packed[-1] % 11 == 0, "proxy": packed[-1] % 37 == 0, "hosting": packed[-1] % 5 == 0,
+    }
+
+
+class FakeIpApi:
+    """Threaded HTTP server; start it, point IP_API_URL at ``url`` and read ``stats``.
+
+    ``latency`` seconds (plus up to ``jitter``) are slept before every
+    response.  ``rate_limit`` and ``fail_rate`` are the chances that a request
+    is answered with a 429 or a 500 instead.  ``quota`` mimics ip-api's
+    per-window request allowance through the ``X-Rl``/``X-Ttl`` headers;
+    0 (the default) reports an inexhaustible quota.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, rate_limit=0.0,
+                 fail_rate=0.0, quota=0, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.fail_rate = fail_rate
+        self.quota = quota
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "ips": 0, "rate_limited": 0, "failed": 0}
+        self.window = (time.monotonic(), 0)
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _decide(self, ips):
+        """Pick the outcome of one request and the quota headers to send."""
+        with self.lock:
+            self.stats["requests"] += 1
+            roll = self.random.random()
+            delay = self.latency + self.random.random() * self.jitter
+            started, used = self.window
+            now = time.monotonic()
+            if now - started >= 60:
+                started, used = now, 0
+            used += 1
+            self.window = (started, used)
+            remaining = max(self.quota - used, 0) if self.quota else 1000
+            ttl = max(int(60 - (now - started)), 0)
+
+            if roll < self.rate_limit or (self.quota and used > self.quota):
+                self.stats["rate_limited"] += 1
+                code = 429
+            elif roll < self.rate_limit + self.fail_rate:
+                self.stats["failed"] += 1
+                code = 500
+            else:
+                self.stats["ips"] += ips
+                code = 200
+        return code, delay, {"X-Rl": str(remaining), "X-Ttl": str(ttl if self.quota else 0)}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, code, body, headers):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _serve(self, ips, build):
+                code, delay, headers = fake._decide(len(ips))
+                if delay:
+                    time.sleep(delay)
+                if code == 429:
+                    self._reply(429, {"message": "too many requests"}, headers)
+                elif code == 500:
+                    self._reply(500, {"message": "internal error"}, headers)
+                else:
+                    self._reply(200, build(), headers)
+
+            def do_GET(self):
+                if not self.path.startswith("/json/"):
+                    return self._reply(404, {"message": "not found"}, {})
+                ip = self.path[len("/json/"):].split("?")[0]
+                self._serve([ip], lambda: answer(ip))
+
+            def do_POST(self):
+                if not self.path.startswith("/batch"):
+                    return self._reply(404, {"message": "not found"}, {})
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                try:
+                    items = json.loads(body)
+                except ValueError:
+                    return self._reply(400, {"message": "invalid body"}, {})
+                ips = [item if isinstance(item, str) else item.get("query", "") for item in items]
+                if len(ips) > 100:
+                    return self._reply(422, {"message": "too many items"}, {})
+                self._serve(ips, lambda: [answer(ip) for ip in ips])
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds slept before each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency, up to this many seconds")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--quota", type=int, default=0, help="requests allowed per minute (0 = unlimited)")
+    args = parser.parse_args()
+
+    fake = FakeIpApi(args.host, args.port, args.latency, args.jitter, args.rate_limit, args.fail_rate, args.quota)
+    print(f"Fake ip-api listening on {fake.url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(fake.stats))
+
+
+if __name__ == "__main__":
+    main()
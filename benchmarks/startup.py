@@ -0,0 +1,127 @@
+"""Cold-start benchmark: how long a fresh process takes to serve its first lookup.
+
+Each run starts a new interpreter (as a gunicorn worker or a CLI call
+would), imports the app, calls its factory and answers one cached /lookup
+through the test client, timing every step; ``ready`` is the sum, on top
+of the bare interpreter start-up reported as ``interpreter``.  The first
+run of each tree starts from an empty database, so it also shows what
+creating the schema costs; the rest reuse it, as recycled workers do.  Heavy modules that the
+process loaded along the way are listed, and the time the deferred pandas
+import takes on the first upload is reported separately.
+
+    python benchmarks/startup.py --runs 20
+    python benchmarks/startup.py --baseline HEAD~1 --output startup.json
+
+``--baseline`` runs the same probe against another git revision of the
+tree, for a before/after comparison.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_ip_api import FakeIpApi  # noqa: E402
+from suite import ROOT, git_revision, summarize  # noqa: E402
+
+HEAVY_MODULES = ("pandas", "numpy", "pyarrow", "requests", "tqdm")
+
+# Runs in the child; prints one JSON object of timings in seconds
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app
+imported = time.perf_counter()
+flask_app = app.create_app() if hasattr(app, "create_app") else app.app
+created = time.perf_counter()
+response = flask_app.test_client().post("/lookup", json={"ip": "1.1.1.1"})
+looked_up = time.perf_counter()
+modules = [name for name in sys.argv[2].split(",") if name in sys.modules]
+import pandas
+print(json.dumps({
+    "import": imported - started, "factory": created - imported, "first_lookup": looked_up - created,
+    "ready": looked_up - started, "pandas_import": time.perf_counter() - looked_up,
+    "status": response.status_code, "modules": modules,
+}))
+"""
+
+
+def run_probe(tree, env):
+    """Run PROBE in a fresh interpreter and return its timings."""
+    output = subprocess.run([sys.executable, "-c", PROBE, tree, ",".join(HEAVY_MODULES)], env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench_tree(tree, workdir, fake, runs):
+    """Time ``runs`` cold starts of the app in ``tree`` against one database."""
+    env = dict(os.environ, DB_FILE=os.path.join(workdir, "cache.db"), IP_API_URL=fake.url,
+               REFRESH_INTERVAL="0", UPLOAD_DIR=os.path.join(workdir, "uploads"))
+    first = run_probe(tree, env)
+    samples = [run_probe(tree, env) for _ in range(runs)]
+    steps = ("ready", "import", "factory", "first_lookup", "pandas_import")
+    return {
+        "empty_database_ms": {step: round(first[step] * 1000, 3) for step in steps},
+        "warm": {step: summarize([sample[step] for sample in samples]) for step in steps},
+        "heavy_modules_loaded": samples[-1]["modules"],
+        "statuses": sorted({sample["status"] for sample in [first] + samples}),
+    }
+
+
+def checkout(revision, workdir):
+    """Extract ``revision`` of the repository into ``workdir`` and return the path."""
+    path = os.path.join(workdir, "tree")
+    os.makedirs(path)
+    archive = subprocess.run(["git", "-C", ROOT, "archive", revision], capture_output=True, check=True).stdout
+    subprocess.run(["tar", "-x", "-C", path], input=archive, check=True)
+    return path
+
+
+def interpreter_baseline(runs):
+    """Wall time of ``python -c pass``, the floor under every process figure."""
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="cold starts timed per tree")
+    parser.add_argument("--baseline", help="git revision to compare the working tree against")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "interpreter": interpreter_baseline(args.runs),
+    }
+    with FakeIpApi() as fake:
+        report["current"] = bench_tree(ROOT, tempfile.mkdtemp(prefix="iplookup-startup-"), fake, args.runs)
+        if args.baseline:
+            workdir = tempfile.mkdtemp(prefix="iplookup-startup-")
+            report["baseline"] = bench_tree(checkout(args.baseline, workdir), workdir, fake, args.runs)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""End-to-end benchmark suite emitting machine-readable JSON.
+
+Runs the app in-process against a local fake ip-api (see fake_ip_api.py)
+and a throwaway database, then measures:
+
+- upload throughput for a synthetic access log, cold (every IP goes
+  upstream) and warm (everything cached)
+- /lookup latency for cached IPs and for misses that go upstream
+- /stats and /cache latency with the cache grown to each ``--sizes`` step
+- classification time for the uploaded result and /view latency
+
+    python benchmarks/suite.py --rows 100000 --sizes 1000,100000 --output bench.json
+    python benchmarks/suite.py --latency 0.05 --rate-limit 0.02 --fail-rate 0.01
+
+Latencies are reported in milliseconds.  Keep ``--seed`` fixed when
+comparing runs; the synthetic data and the fake API's faults are derived
+from it.  A 10,000,000-row ``--sizes`` step works but takes several
+minutes and a few GB of disk to build.
+"""
+import argparse
+import ipaddress
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_ip_api import FakeIpApi, answer  # noqa: E402
+
+
+def summarize(samples):
+    """Percentiles of a list of durations in seconds, reported in ms."""
+    values = np.array(samples) * 1000
+    return {
+        "count": len(values),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p90_ms": round(float(np.percentile(values, 90)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def int_to_ips(numbers):
+    numbers = np.asarray(numbers, dtype=np.int64)
+    octets = [pd.Series((numbers >> shift) & 255).astype(str) for shift in (24, 16, 8, 0)]
+    return octets[0] + '.' + octets[1] + '.' + octets[2] + '.' + octets[3]
+
+
+def make_access_log(path, rows, unique, seed):
+    """Write an aggregated access log with realistic skew.
+
+    IPs are drawn from /24 blocks whose sizes follow a Zipf distribution, so
+    a few blocks are dense (bot farms, carrier NAT) and most hold a handful
+    of addresses.  Rows repeat popular IPs Zipf-style as well, and view
+    counts are Pareto distributed.  Returns ``(rows, distinct_ips)``.
+    """
+    rng = np.random.default_rng(seed)
+    wanted = max(int(rows * unique), 1)
+    blocks = rng.integers(1 << 16, 224 << 16, max(wanted // 8, 1))
+    block_of = (rng.zipf(1.6, wanted) - 1) % len(blocks)
+    ips = np.unique((blocks[block_of] << 8) | rng.integers(1, 255, wanted))
+    # Dense blocks saturate at 254 hosts; make up the shortfall with scattered addresses
+    while len(ips) < wanted:
+        extra = (rng.integers(1 << 16, 224 << 16, wanted - len(ips)) << 8) | rng.integers(1, 255, wanted - len(ips))
+        ips = np.unique(np.concatenate([ips, extra]))
+    ips = ips[rng.permutation(len(ips))]
+
+    # The first pass guarantees every IP appears; the rest repeat popular ones
+    picks = np.concatenate([np.arange(min(len(ips), rows)),
+                            (rng.zipf(1.3, max(rows - len(ips), 0)) - 1) % len(ips)])
+    rng.shuffle(picks)
+    df = pd.DataFrame({
+        'client_ip': int_to_ips(ips[picks]),
+        'ip_count': np.minimum(rng.pareto(1.2, len(picks)) * 3 + 1, 100000).astype(np.int64),
+        'user_agent': np.array(['Mozilla/5.0', 'curl/8.0', 'python-requests/2.32', 'Googlebot/2.1'])[
+            rng.integers(0, 4, len(picks))],
+    })
+    df.to_csv(path, index=False)
+    return len(df), int(df['client_ip'].nunique())
+
+
+def run_upload(client, path):
+    """Upload ``path`` and follow the job; returns wall time and the last events."""
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        response = client.post('/upload', data={'files': [(f, os.path.basename(path))]},
+                               content_type='multipart/form-data')
+        body = response.get_data(as_text=True)
+    seconds = time.perf_counter() - start
+    events = [json.loads(line[6:]) for line in body.splitlines() if line.startswith('data: ')]
+    progress = [event for event in events if event.get('type') == 'progress']
+    return seconds, events[-1] if events else {}, progress[-1] if progress else {}
+
+
+def bench_upload(app, client, path, rows):
+    results = {}
+    for phase in ('cold', 'warm'):
+        seconds, last, progress = run_upload(client, path)
+        app.cache_writer.flush()
+        results[phase] = {
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(rows / seconds) if seconds > 0 else None,
+            "final_event": last.get('type'),
+            "timings": progress.get('timings', {}),
+        }
+    return results
+
+
+def bench_lookup(client, cached_ips, misses, seed):
+    rng = np.random.default_rng(seed + 1)
+
+    def lookup(ip):
+        response = client.post('/lookup', json={'ip': ip})
+        if response.status_code != 200:
+            errors.append(response.status_code)
+
+    errors = []
+    probes = rng.choice(cached_ips, misses * 10)
+    cached = []
+    for ip in probes:
+        start = time.perf_counter()
+        lookup(ip)
+        cached.append(time.perf_counter() - start)
+
+    # Misses come from 8.0.0.0/8; a few may already be cached by the upload,
+    # which only makes the miss figures slightly optimistic
+    fresh = int_to_ips(rng.choice(1 << 24, misses, replace=False) + (8 << 24))
+    missed = []
+    for ip in fresh:
+        start = time.perf_counter()
+        lookup(ip)
+        missed.append(time.perf_counter() - start)
+    return {"cached": summarize(cached), "miss": summarize(missed), "non_200": len(errors)}
+
+
+def grow_cache(app, target, batch=50000):
+    """Insert synthetic rows straight into SQLite until ip_cache holds ``target`` rows."""
+    conn = app.connect_db()
+    try:
+        have = conn.execute("SELECT COUNT(*) FROM ip_rows").fetchone()[0]
+        # Spread over 2.0.0.0 - 7.x so the fake answers vary by /8, /16 and /24
+        next_number = int(ipaddress.IPv4Address('2.0.0.0')) + have * 7
+        while have < target:
+            count = min(batch, target - have)
+            numbers = next_number + np.arange(count, dtype=np.int64) * 7
+            next_number = int(numbers[-1]) + 7
+            rows = app.stamp_results([app.build_result(ip, answer(ip)) for ip in int_to_ips(numbers)])
+            rows = app.encode_results(conn, rows)
+            with conn:
+                conn.executemany(app.INSERT_CACHE_SQL, rows)
+            have = conn.execute("SELECT COUNT(*) FROM ip_rows").fetchone()[0]
+        return have
+    finally:
+        conn.close()
+
+
+def bench_pages(app, client, sizes, repeat):
+    queries = {
+        "stats": "/stats",
+        "cache": "/cache",
+        "cache_last_page": "/cache?last=1",
+        "cache_country": "/cache?country=Germany",
+        "cache_search": "/cache?search=Ger",
+    }
+    # Start from an empty cache so the smallest step is not padded by the upload's rows
+    client.post('/clean-cache')
+    results = {}
+    for size in sizes:
+        rows = grow_cache(app, size)
+        app.invalidate_facets()
+        results[str(size)] = {"rows": rows}
+        for name, url in queries.items():
+            first = timed(lambda: client.get(url), 1)
+            samples = timed(lambda: client.get(url), repeat)
+            results[str(size)][name] = dict(summarize(samples), first_ms=round(first[0] * 1000, 3))
+    return results
+
+
+def bench_classification(app, client, filename, repeat):
+    path = os.path.join('results', filename)
+    df = app.open_result(path).read(['client_ip', 'ip_count'])
+    df['client_ip'] = df['client_ip'].astype(str)
+    classify = timed(lambda: app.classify_results(df.copy()), repeat)
+
+    def cold_view():
+        app._result_cache.clear()
+        client.get(f'/view/{filename}')
+
+    return {
+        "rows": len(df),
+        "classify": summarize(classify),
+        "view_cold": summarize(timed(cold_view, repeat)),
+        "view_warm": summarize(timed(lambda: client.get(f'/view/{filename}?page=2'), repeat)),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000, help="rows in the synthetic access log")
+    parser.add_argument("--unique", type=float, default=0.3, help="distinct IPs as a fraction of rows")
+    parser.add_argument("--sizes", default="1000,100000", help="cache sizes for the /stats and /cache runs")
+    parser.add_argument("--lookups", type=int, default=200, help="upstream misses timed (cached lookups: 10x)")
+    parser.add_argument("--repeat", type=int, default=20, help="requests timed per page and size")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake ip-api latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random fake ip-api latency")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="fraction of upstream requests given a 429")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of upstream requests given a 500")
+    parser.add_argument("--upstream-rate", type=int, default=1000000,
+                        help="IP_API_RATE / IP_API_BATCH_RATE for the app (per minute)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+    sizes = sorted(int(size) for size in args.sizes.split(',') if size.strip())
+
+    fake = FakeIpApi(latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit,
+                     fail_rate=args.fail_rate, seed=args.seed).start()
+
+    # The app reads its settings at import time and writes results/ relative to the cwd
+    output_path = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix="iplookup-bench-")
+    os.chdir(workdir)
+    os.environ.update(
+        IP_API_URL=fake.url,
+        DB_FILE=os.path.join(workdir, "cache.db"),
+        UPLOAD_DIR=os.path.join(workdir, "uploads"),
+        IP_API_RATE=str(args.upstream_rate),
+        IP_API_BATCH_RATE=str(args.upstream_rate),
+        REFRESH_INTERVAL="0",
+    )
+    sys.path.insert(0, ROOT)
+    import app
+
+    client = app.create_app().test_client()
+    log_path = os.path.join(workdir, "access_log.csv")
+    started = time.perf_counter()
+    rows, distinct = make_access_log(log_path, args.rows, args.unique, args.seed)
+    generate_seconds = time.perf_counter() - started
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pandas": pd.__version__,
+            "result_format": app.RESULT_FORMAT,
+        },
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "dataset": {"rows": rows, "distinct_ips": distinct, "generate_seconds": round(generate_seconds, 3)},
+    }
+
+    report["upload"] = bench_upload(app, client, log_path, rows)
+    cached_ips = pd.read_csv(log_path, usecols=['client_ip'])['client_ip'].unique()
+    report["lookup"] = bench_lookup(client, cached_ips, args.lookups, args.seed)
+    report["classification"] = bench_classification(
+        app, client, app.result_filename(os.path.basename(log_path), app.RESULT_FORMAT), max(args.repeat // 4, 3))
+    report["pages"] = bench_pages(app, client, sizes, args.repeat)
+    report["upstream"] = dict(fake.stats)
+    fake.stop()
+
+    output = json.dumps(report, indent=2)
+    if output_path:
+        with open(output_path, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
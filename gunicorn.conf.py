@@ -0,0 +1,31 @@
+"""Production server settings, read from .env like the app itself.
+
+    gunicorn
+
+Each worker is a separate process with threads for concurrent requests;
+long-running upload streams hold a thread, not a whole worker.  The app's
+upstream quotas are enforced per process, so they are split evenly between
+the workers here before any of them imports the app.
+"""
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', '8080')}")
+workers = int(os.getenv("WEB_WORKERS", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "16"))
+timeout = int(os.getenv("WEB_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+accesslog = os.getenv("WEB_ACCESS_LOG", "-")
+
+# Every worker opens its own SQLite connections and background threads after
+# the fork; preloading would share the parent's handles between processes
+preload_app = False
+wsgi_app = "app:create_app()"
+
+for name, default in (("IP_API_RATE", "45"), ("IP_API_BATCH_RATE", "15")):
+    os.environ[name] = str(max(int(os.getenv(name, default)) // workers, 1))
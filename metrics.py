@@ -0,0 +1,156 @@
+"""Minimal Prometheus-style metrics without extra dependencies.
+
+Counters and histograms keep one series per combination of label values
+and render in the Prometheus text exposition format.  Gauges are read from
+callbacks at scrape time, so existing ``stats()`` dictionaries can be
+exported without touching the code that maintains them.
+
+Every metric checks its registry's ``enabled`` flag first; when metrics are
+off, ``inc``/``observe`` return immediately and ``time()`` hands back a
+shared no-op context manager, so instrumented hot paths cost one attribute
+lookup.  Values are per process: under several workers each scrape reports
+the worker that served it.
+"""
+import bisect
+import threading
+import time
+from contextlib import nullcontext
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_NOOP = nullcontext()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(self, name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(self, name, documentation, labels, buckets))
+
+    def gauge(self, name, documentation, callback, labels=()):
+        """``callback`` returns a number, or ``{label values: number}`` when ``labels`` are given."""
+        return self.register(Gauge(name, documentation, callback, labels))
+
+    def render(self):
+        return ''.join(metric.render() for metric in self.metrics)
+
+
+class Counter:
+    def __init__(self, registry, name, documentation, labels):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{_labels(self.labels, labels)} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Histogram:
+    def __init__(self, registry, name, documentation, labels, buckets):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        if not self.registry.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *labels):
+        """Context manager observing the duration of its block."""
+        if not self.registry.enabled:
+            return _NOOP
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for labels, (counts, total, count) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{_labels(self.labels, labels, [("le", _number(bound))])} {cumulative}')
+                lines.append(f'{self.name}_sum{_labels(self.labels, labels)} {_number(total)}')
+                lines.append(f'{self.name}_count{_labels(self.labels, labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+class Gauge:
+    def __init__(self, name, documentation, callback, labels):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labels = tuple(labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        value = self.callback()
+        items = sorted(value.items()) if isinstance(value, dict) else [((), value)]
+        for labels, number in items:
+            labels = labels if isinstance(labels, tuple) else (labels,)
+            lines.append(f'{self.name}{_labels(self.labels, labels)} {_number(number or 0)}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,225 @@
+"""Offline IP range database resolved with binary search.
+
+Loads a CSV of IP ranges into sorted integer ``start``/``end`` arrays per
+address family and answers lookups with ``searchsorted``, without touching
+the network.  The CSV needs a header and either a ``network`` column (CIDR
+notation) or ``start`` and ``end`` columns (addresses or integers).  Any
+other column whose name matches a cache field (``country``, ``region``,
+``city``, ``lat``, ...) is returned with each match.  Overlapping ranges
+(a /24 inside a /16, say) are flattened at load time so the narrowest range
+covering an address wins.
+
+IPv4 ranges live in ``uint64`` arrays so a whole pandas column can be
+resolved with one vectorized ``searchsorted``.  IPv6 values do not fit a
+native dtype and are kept as Python integers in object arrays, which still
+bisect correctly but run at Python speed.
+"""
+import heapq
+import ipaddress
+
+import numpy as np
+import pandas as pd
+
+
+def ipv4_to_int(values):
+    """Vectorized dotted-quad to integer conversion.
+
+    Returns a float Series (NaN for anything that is not a valid IPv4
+    address) aligned with ``values``.  Like ``ipaddress``, octets with a
+    leading zero ("001.0.1.5") are not accepted.  The strings are laid out
+    as a fixed-width character matrix and parsed one column at a time, so
+    the cost is fifteen numpy passes rather than a Python call per address.
+    """
+    strings = pd.Series(values, dtype=str)
+    # One spare column: anything that still has a character there is too long
+    chars = np.ascontiguousarray(
+        strings.to_numpy(dtype='U16').view(np.uint32).reshape(len(strings), 16).T
+    ).astype(np.int64)
+
+    total = np.zeros(len(strings), dtype=np.int64)
+    octet = np.zeros(len(strings), dtype=np.int64)
+    digits = np.zeros(len(strings), dtype=np.int64)
+    dots = np.zeros(len(strings), dtype=np.int64)
+    valid = chars[15] == 0
+
+    for column in chars[:15]:
+        is_digit = (column >= 48) & (column <= 57)
+        is_dot = column == 46
+        valid &= is_digit | is_dot | (column == 0)
+        valid &= ~is_dot | ((digits > 0) & (digits <= 3) & (octet <= 255))
+        valid &= ~(is_digit & (digits == 1) & (octet == 0))
+
+        octet[is_digit] = octet[is_digit] * 10 + column[is_digit] - 48
+        digits += is_digit
+        total[is_dot] = total[is_dot] * 256 + octet[is_dot]
+        octet[is_dot] = 0
+        digits[is_dot] = 0
+        dots += is_dot
+
+    valid &= (dots == 3) & (digits > 0) & (digits <= 3) & (octet <= 255)
+    result = (total * 256 + octet).astype(float)
+    result[~valid] = np.nan
+    return pd.Series(result, index=strings.index)
+
+
+def parse_address(value):
+    """Return ``(version, integer)`` for an address or integer string, or None."""
+    value = str(value).strip()
+    if value.isdigit():
+        number = int(value)
+        return (4 if number < 2 ** 32 else 6), number
+    try:
+        address = ipaddress.ip_address(value)
+    except ValueError:
+        return None
+    return address.version, int(address)
+
+
+def flatten_ranges(starts, ends):
+    """Split sorted, possibly overlapping ranges into non-overlapping pieces.
+
+    ``starts`` and ``ends`` are inclusive bounds sorted by start.  Returns
+    ``(starts, ends, owners)`` where each piece is owned by the position of
+    the narrowest input range covering it (the earlier one on a tie), and
+    adjacent pieces with the same owner are merged back together.
+    """
+    points = sorted(set(starts) | {end + 1 for end in ends})
+    active = []
+    following = 0
+    pieces_start, pieces_end, owners = [], [], []
+    for point, stop in zip(points, points[1:]):
+        while following < len(starts) and starts[following] <= point:
+            heapq.heappush(active, (ends[following] - starts[following], following))
+            following += 1
+        while active and ends[active[0][1]] < point:
+            heapq.heappop(active)
+        if not active:
+            continue
+        owner = active[0][1]
+        if owners and owners[-1] == owner and pieces_end[-1] == point - 1:
+            pieces_end[-1] = stop - 1
+        else:
+            pieces_start.append(point)
+            pieces_end.append(stop - 1)
+            owners.append(owner)
+    return pieces_start, pieces_end, owners
+
+
+class RangeTable:
+    """Sorted, non-overlapping ranges for one address family."""
+
+    def __init__(self, starts, ends, records):
+        self.starts = starts
+        self.ends = ends
+        self.records = records.reset_index(drop=True)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def find(self, number):
+        """Return the record index covering ``number``, or -1."""
+        idx = int(np.searchsorted(self.starts, number, side='right')) - 1
+        if idx >= 0 and number <= self.ends[idx]:
+            return idx
+        return -1
+
+    def find_many(self, numbers):
+        """Vectorized ``find`` over an array of integers."""
+        if not len(self.starts):
+            return np.full(len(numbers), -1)
+        idx = np.searchsorted(self.starts, numbers, side='right') - 1
+        covered = (idx >= 0) & (numbers <= self.ends[np.maximum(idx, 0)])
+        return np.where(covered, idx, -1)
+
+
+class RangeDatabase:
+    """IPv4 and IPv6 range tables loaded from a CSV file."""
+
+    def __init__(self, v4, v6, columns):
+        self.v4 = v4
+        self.v6 = v6
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.v4) + len(self.v6)
+
+    @classmethod
+    def load(cls, path, fields):
+        """Load ranges from ``path``, keeping only columns listed in ``fields``."""
+        df = pd.read_csv(path, dtype=str, keep_default_na=False)
+        columns = [c for c in df.columns if c in fields]
+
+        if 'network' in df.columns:
+            networks = [ipaddress.ip_network(n.strip(), strict=False) for n in df['network']]
+            df['_version'] = [n.version for n in networks]
+            df['_start'] = [int(n.network_address) for n in networks]
+            df['_end'] = [int(n.broadcast_address) for n in networks]
+        elif {'start', 'end'}.issubset(df.columns):
+            starts = [parse_address(v) for v in df['start']]
+            ends = [parse_address(v) for v in df['end']]
+            keep = [s is not None and e is not None and s[0] == e[0] for s, e in zip(starts, ends)]
+            df = df[keep].copy()
+            df['_version'] = [s[0] for s, k in zip(starts, keep) if k]
+            df['_start'] = [s[1] for s, k in zip(starts, keep) if k]
+            df['_end'] = [e[1] for e, k in zip(ends, keep) if k]
+        else:
+            raise ValueError(f"{path} needs a 'network' column or 'start' and 'end' columns")
+
+        for column in ('lat', 'lon'):
+            if column in columns:
+                df[column] = pd.to_numeric(df[column], errors='coerce')
+
+        tables = {}
+        for version, dtype in ((4, np.uint64), (6, object)):
+            part = df[df['_version'] == version].sort_values('_start', kind='stable')
+            starts, ends = part['_start'].tolist(), part['_end'].tolist()
+            records = part[columns]
+            if any(start <= end for start, end in zip(starts[1:], ends)):
+                starts, ends, owners = flatten_ranges(starts, ends)
+                records = records.iloc[owners]
+            tables[version] = RangeTable(
+                np.array(starts, dtype=dtype),
+                np.array(ends, dtype=dtype),
+                records,
+            )
+        return cls(tables[4], tables[6], columns)
+
+    def lookup(self, ip):
+        """Return the fields for ``ip`` as a dict, or None when no range covers it."""
+        parsed = parse_address(ip)
+        if parsed is None:
+            return None
+        version, number = parsed
+        table = self.v4 if version == 4 else self.v6
+        idx = table.find(number)
+        if idx < 0:
+            return None
+        return table.records.iloc[idx].to_dict()
+
+    def lookup_series(self, ips):
+        """Resolve a column of IPs at once.
+
+        Returns a DataFrame indexed like ``ips`` holding the matched fields,
+        with NaN rows for addresses no range covers.
+        """
+        ips = pd.Series(ips)
+        result = pd.DataFrame(index=ips.index, columns=self.columns, dtype=object)
+
+        numbers = ipv4_to_int(ips.values)
+        is_v4 = numbers.notna().values
+        if is_v4.any():
+            idx = self.v4.find_many(numbers.values[is_v4].astype(np.uint64))
+            hit = idx >= 0
+            rows = ips.index[is_v4][hit]
+            result.loc[rows, self.columns] = self.v4.records.iloc[idx[hit]].values
+
+        # Everything that is not dotted IPv4 goes through the slower IPv6 path
+        if len(self.v6) and not is_v4.all():
+            for label, ip in ips[~is_v4].items():
+                parsed = parse_address(ip)
+                if parsed and parsed[0] == 6:
+                    idx = self.v6.find(parsed[1])
+                    if idx >= 0:
+                        result.loc[label, self.columns] = self.v6.records.iloc[idx].values
+
+        return result
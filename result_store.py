@@ -0,0 +1,230 @@
+"""Processed result files stored as CSV, Parquet or Arrow IPC.
+
+CSV stays the default and needs nothing beyond pandas.  The columnar
+formats need ``pyarrow``: Parquet (zstd compressed) is the smallest on disk,
+while uncompressed Arrow IPC can be memory-mapped and sliced without
+decoding anything.  In both, the location columns (and any other column
+written as a pandas categorical) are dictionary encoded so each distinct
+string is stored once per dictionary rather than once per row, and they
+come back as pandas categoricals.
+
+pandas and pyarrow are imported where they are used, so importing this
+module (to name or list results) stays cheap.
+
+Files are opened through ``open_result``, which returns an object exposing
+``num_rows``, ``columns``, ``read(columns)`` (a projection of whole
+columns), ``rows(start, stop)`` (one slice, for paging) and
+``batches(size)`` (for streaming the file out as CSV).
+"""
+import importlib.util
+import os
+
+FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+DICTIONARY_COLUMNS = ('country', 'region', 'city')
+
+
+def check_format(fmt):
+    """Raise if ``fmt`` is unknown or needs pyarrow and it is not installed."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown result format {fmt!r}; expected one of {', '.join(FORMATS)}")
+    if fmt != 'csv' and importlib.util.find_spec('pyarrow') is None:
+        raise RuntimeError(f"Result format {fmt!r} needs pyarrow (pip install pyarrow)")
+
+
+def result_filename(filename, fmt):
+    """Name of the processed output for an uploaded ``filename``."""
+    if fmt == 'csv':
+        return f"processed_{filename}"
+    return f"processed_{os.path.splitext(filename)[0]}{FORMATS[fmt]}"
+
+
+def is_result_file(filename):
+    return filename.endswith(tuple(FORMATS.values()))
+
+
+def format_of(path):
+    for fmt, ext in FORMATS.items():
+        if path.endswith(ext):
+            return fmt
+    raise ValueError(f"{path} is not a results file")
+
+
+class ResultWriter:
+    """Append DataFrame chunks to a results file.
+
+    The first chunk fixes the columnar schema; later chunks are converted to
+    it, so a column that only gains missing values further down the file
+    still keeps its type.  A column that is empty throughout the first chunk
+    is stored as string, so text showing up in it later still fits.
+    Dictionary columns grow a running category list so every chunk only
+    appends to the dictionary, which is what lets Arrow IPC files (one
+    dictionary per field) be written incrementally.
+    """
+
+    def __init__(self, path, fmt):
+        check_format(fmt)
+        self.path = path
+        self.fmt = fmt
+        self.rows = 0
+        self.schema = None
+        self.writer = None
+        self.categories = {}
+        self.dictionary_columns = []
+
+    def write(self, df):
+        if self.fmt == 'csv':
+            df.to_csv(self.path, mode='w' if self.rows == 0 else 'a', header=self.rows == 0, index=False)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = self._to_table(df)
+            if self.writer is None:
+                if self.fmt == 'parquet':
+                    self.writer = pq.ParquetWriter(self.path, self.schema, compression='zstd')
+                else:
+                    options = pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+                    self.writer = pa.ipc.new_file(self.path, self.schema, options=options)
+            self.writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _to_table(self, df):
+        import pandas as pd
+        import pyarrow as pa
+
+        df = df.copy()
+        if self.schema is None:
+            self.dictionary_columns = [name for name in df.columns if name in DICTIONARY_COLUMNS
+                                       or isinstance(df[name].dtype, pd.CategoricalDtype)]
+        for name in self.dictionary_columns:
+            if name in df.columns:
+                known = self.categories.get(name, pd.Index([], dtype=object))
+                values = df[name].astype(object).where(df[name].notna(), None)
+                seen = pd.Index(values.dropna().unique())
+                known = known.append(seen[~seen.isin(known)])
+                self.categories[name] = known
+                df[name] = pd.Categorical(values, categories=known)
+
+        if self.schema is None:
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+            for i, field in enumerate(schema):
+                if pa.types.is_null(field.type):
+                    schema = schema.set(i, field.with_type(pa.string()))
+            for name in self.dictionary_columns:
+                if name in df.columns:
+                    field = pa.field(name, pa.dictionary(pa.int32(), pa.string()))
+                    schema = schema.set(schema.get_field_index(name), field)
+            self.schema = schema
+        return pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+
+
+class CsvResult:
+    """A CSV result, parsed once into a DataFrame."""
+
+    def __init__(self, path):
+        import pandas as pd
+
+        self.df = pd.read_csv(path)
+        self.num_rows = len(self.df)
+        self.columns = list(self.df.columns)
+
+    def read(self, columns):
+        return self.df[columns].copy()
+
+    def rows(self, start, stop):
+        return self.df.iloc[start:stop]
+
+    def batches(self, size):
+        for start in range(0, self.num_rows, size):
+            yield self.df.iloc[start:start + size]
+
+
+class ArrowResult:
+    """An Arrow IPC result, memory-mapped; reads are zero-copy slices."""
+
+    def __init__(self, path):
+        import pyarrow as pa
+
+        self.table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        self.num_rows = self.table.num_rows
+        self.columns = self.table.column_names
+
+    def read(self, columns):
+        return self.table.select(columns).to_pandas()
+
+    def rows(self, start, stop):
+        return self.table.slice(start, max(stop - start, 0)).to_pandas()
+
+    def batches(self, size):
+        for batch in self.table.to_batches(max_chunksize=size):
+            yield batch.to_pandas()
+
+
+class ParquetResult:
+    """A Parquet result; only the footer is read up front.
+
+    Projections decode just the requested columns and page reads decode
+    just the row groups that overlap the page.
+    """
+
+    def __init__(self, path):
+        import pyarrow.parquet as pq
+
+        self.file = pq.ParquetFile(path, memory_map=True)
+        metadata = self.file.metadata
+        self.num_rows = metadata.num_rows
+        self.columns = self.file.schema_arrow.names
+        self.offsets = [0]
+        for i in range(metadata.num_row_groups):
+            self.offsets.append(self.offsets[-1] + metadata.row_group(i).num_rows)
+
+    def read(self, columns):
+        return self.file.read(columns=columns).to_pandas()
+
+    def rows(self, start, stop):
+        groups = [i for i in range(len(self.offsets) - 1)
+                  if self.offsets[i] < stop and self.offsets[i + 1] > start]
+        if not groups:
+            return self.file.schema_arrow.empty_table().to_pandas()
+        table = self.file.read_row_groups(groups)
+        first = self.offsets[groups[0]]
+        return table.slice(start - first, stop - start).to_pandas()
+
+    def batches(self, size):
+        for batch in self.file.iter_batches(batch_size=size):
+            yield batch.to_pandas()
+
+
+def open_result(path):
+    fmt = format_of(path)
+    check_format(fmt)
+    if fmt == 'parquet':
+        return ParquetResult(path)
+    if fmt == 'arrow':
+        return ArrowResult(path)
+    return CsvResult(path)
+
+
+def iter_csv(path, batch_rows=50000):
+    """Yield a results file as CSV text, one batch at a time."""
+    import pandas as pd
+
+    result = open_result(path)
+    if not result.num_rows:
+        yield pd.DataFrame(columns=result.columns).to_csv(index=False)
+        return
+    header = True
+    for df in result.batches(batch_rows):
+        yield df.to_csv(index=False, header=header)
+        header = False
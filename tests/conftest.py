@@ -0,0 +1,57 @@
+"""Shared fixtures: a throwaway database per test and a local ip-api.com.
+
+app reads its settings when it is imported, so the ones the tests rely on
+are set here first.  Per-test state (database file, upload directory,
+working directory) is patched onto the module by the ``app_module``
+fixture, and the in-process caches are emptied so no test sees another's
+rows.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
+
+# Writes that land after a test has finished (a lookup that outlived its
+# deadline, say) go to this scratch directory rather than the working tree
+SCRATCH = tempfile.mkdtemp(prefix="iplookup-tests-")
+os.environ.update(
+    DB_FILE=os.path.join(SCRATCH, "cache.db"),
+    UPLOAD_DIR=os.path.join(SCRATCH, "uploads"),
+    DEBUG="False",
+    REFRESH_INTERVAL="0",
+    HOT_CACHE_PRELOAD="0",
+    IP_API_RATE="6000",
+    IP_API_BATCH_RATE="6000",
+)
+
+from fake_ip_api import FakeIpApi  # noqa: E402
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """The app module pointed at an empty database under ``tmp_path``."""
+    import app
+
+    app.cache_writer.flush()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app, "DB_FILE", str(tmp_path / "cache.db"))
+    monkeypatch.setattr(app, "UPLOAD_DIR", str(tmp_path / "uploads"))
+    app.cache_strings.ids.clear()
+    app.hot_cache.invalidate()
+    app._facets.clear()
+    app._result_cache.clear()
+    yield app
+    app.cache_writer.flush()
+    app.hot_cache.invalidate()
+
+
+@pytest.fixture
+def fake_api(app_module, monkeypatch):
+    """A fake ip-api.com the app resolves against; tweak its fault settings per test."""
+    with FakeIpApi() as fake:
+        monkeypatch.setattr(app_module, "IP_API_URL", fake.url)
+        yield fake
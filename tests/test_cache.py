@@ -0,0 +1,64 @@
+def success(app_module, ip, country="Germany", region="Berlin", city="Berlin"):
+    result = app_module.placeholder_result(ip, "success", "Unknown")
+    result.update(country=country, region=region, city=city)
+    return result
+
+
+def test_writer_leaves_callers_results_alone(app_module):
+    result = success(app_module, "8.8.8.8")
+    before = dict(result)
+
+    app_module.save_results([result]).wait(5)
+
+    assert result == before
+    row = app_module.fetch_cached(["8.8.8.8"], columns=["ip", "fetched_at", "expires_at"])["8.8.8.8"]
+    assert row["fetched_at"] is not None
+    assert row["expires_at"] > row["fetched_at"]
+
+
+def write(app_module, results):
+    app_module.save_results(results).wait(5)
+
+
+def totals(app_module):
+    return dict(app_module.get_db().execute("SELECT name, count FROM stats_totals").fetchall())
+
+
+def test_stats_tables_follow_inserts_updates_and_deletes(app_module):
+    write(app_module, [success(app_module, "8.8.8.8"), success(app_module, "8.8.4.4", "Japan", "Tokyo", "Tokyo"),
+                       app_module.placeholder_result("10.0.0.1", "fail", "Unknown")])
+    assert app_module.check_stats() == []
+    assert totals(app_module) == {"total": 3, "unknown": 1, "error": 0}
+
+    # Re-resolving a row moves it between groups
+    write(app_module, [success(app_module, "8.8.4.4", "Germany", "Hamburg", "Hamburg")])
+    assert app_module.check_stats() == []
+    countries = dict(app_module.get_db().execute("SELECT country, count FROM stats_country").fetchall())
+    assert countries == {"Germany": 2, "Unknown": 1}
+
+    # Transient errors never replace a good row, but are counted for new IPs
+    write(app_module, [app_module.placeholder_result("8.8.8.8", "error", "Error"),
+                       app_module.placeholder_result("9.9.9.9", "error", "Error")])
+    assert app_module.check_stats() == []
+    assert totals(app_module)["error"] == 1
+
+    client = app_module.app.test_client()
+    assert client.post("/delete-cache/8.8.4.4").status_code == 200
+    assert app_module.check_stats() == []
+    assert totals(app_module)["total"] == 3
+
+    assert client.post("/clean-cache").status_code == 200
+    assert app_module.check_stats() == []
+    assert app_module.get_db().execute("SELECT count(*) FROM stats_country").fetchone()[0] == 0
+
+
+def test_rebuild_stats_repairs_drift(app_module):
+    write(app_module, [success(app_module, "8.8.8.8")])
+    conn = app_module.get_db()
+    with conn:
+        conn.execute("UPDATE stats_country SET count = 7")
+    assert app_module.check_stats()
+
+    app_module.rebuild_stats()
+
+    assert app_module.check_stats() == []
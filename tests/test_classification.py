@@ -0,0 +1,30 @@
+import ipaddress
+
+import pandas as pd
+
+from range_db import ipv4_to_int
+
+
+def test_ipv4_to_int_matches_ipaddress():
+    values = ["1.0.1.5", "0.0.0.0", "255.255.255.255", "10.0.0.10", "001.0.1.5", "1.00.1.5", "1.0.1.05",
+              "256.0.0.1", "1.2.3", "1.2.3.4.5", "", "::1", "1..2.3", "01.2.3.4", "100.200.0.1"]
+    expected = []
+    for value in values:
+        try:
+            expected.append(float(int(ipaddress.IPv4Address(value))))
+        except ValueError:
+            expected.append(None)
+
+    numbers = ipv4_to_int(values)
+
+    assert [None if pd.isna(n) else n for n in numbers] == expected
+
+
+def test_zero_padded_addresses_are_not_grouped_with_their_subnet(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "SUBNET_IP_THRESHOLD", 2)
+    monkeypatch.setattr(app_module, "SUBNET_VIEW_THRESHOLD", 0)
+    df = pd.DataFrame({"client_ip": ["1.0.1.5", "1.0.1.6", "001.0.1.7"], "ip_count": [1, 1, 1]})
+
+    app_module.classify_results(df)
+
+    assert df["dynamic_classification"].tolist() == ["likely_real"] * 3
@@ -0,0 +1,117 @@
+import io
+import json
+import os
+import time
+
+from werkzeug.datastructures import FileStorage
+
+LOG = "client_ip,page\n8.8.8.8,/a\n1.1.1.1,/b\n8.8.8.8,/c\n"
+
+
+def upload(name, data=LOG):
+    return FileStorage(io.BytesIO(data.encode()), filename=name)
+
+
+def wait_for(app_module, job_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = app_module.get_job(job_id)
+        if job["status"] not in ("queued", "running"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} still {job['status']}")
+
+
+def age(app_module, job_id, seconds):
+    conn = app_module.get_db()
+    with conn:
+        conn.execute("UPDATE jobs SET updated_at = updated_at - ? WHERE id = ?", (seconds, job_id))
+
+
+def test_upload_job_streams_to_completion(app_module, fake_api):
+    response = app_module.app.test_client().post("/upload", data={"files": [upload("log.csv")]})
+    events = [json.loads(line[len("data: "):]) for line in response.get_data(as_text=True).splitlines()
+              if line.startswith("data: ")]
+
+    assert events[0]["type"] == "job"
+    assert events[-1]["type"] == "complete"
+    assert [event["status"] for event in events if event["type"] == "file_complete"] == ["success"]
+    assert os.path.exists(os.path.join("results", "processed_log.csv"))
+    assert not os.path.exists(os.path.join(app_module.UPLOAD_DIR, events[0]["job_id"]))
+    assert app_module.get_job(events[0]["job_id"])["status"] == "completed"
+
+
+def test_cancelled_upload_resumes_after_its_last_file(app_module, fake_api, monkeypatch):
+    job_id = app_module.create_job([upload("one.csv"), upload("two.csv")])
+    process_upload = app_module.process_upload
+
+    def cancel_after_first_file(job_id):
+        for event in process_upload(job_id):
+            yield event
+            if event["type"] == "file_complete":
+                app_module.get_db().execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+                app_module.get_db().commit()
+
+    monkeypatch.setitem(app_module.JOB_PIPELINES, "upload", cancel_after_first_file)
+    app_module.active_jobs[job_id] = app_module.Job(job_id)
+    app_module.run_job(job_id)
+
+    job = app_module.get_job(job_id)
+    assert job["status"] == "cancelled" and job["resumable"]
+    assert [f["status"] for f in job["files"]] == ["done", "pending"]
+
+    monkeypatch.setitem(app_module.JOB_PIPELINES, "upload", process_upload)
+    assert app_module.app.test_client().post(f"/jobs/{job_id}/resume").status_code == 200
+    job = wait_for(app_module, job_id)
+
+    assert job["status"] == "completed"
+    assert [f["status"] for f in job["files"]] == ["done", "done"]
+    assert any("already processed" in event.get("message", "") for event in job["events"])
+    assert os.path.exists(os.path.join("results", "processed_two.csv"))
+
+
+def test_heartbeat_keeps_a_quiet_job_alive(app_module):
+    job_id = app_module.create_job([upload("log.csv")])
+    age(app_module, job_id, app_module.JOB_STALE_SECONDS + 60)
+    app_module.active_jobs[job_id] = app_module.Job(job_id)
+    try:
+        app_module.job_heartbeat.beat()
+    finally:
+        del app_module.active_jobs[job_id]
+
+    # As seen from another worker, which does not have the job in active_jobs
+    assert not app_module.get_job(job_id)["stale"]
+    age(app_module, job_id, app_module.JOB_STALE_SECONDS + 60)
+    assert app_module.get_job(job_id)["stale"]
+
+
+def test_resume_loses_to_a_concurrent_change(app_module, monkeypatch):
+    job_id = app_module.create_job([upload("log.csv")])
+    age(app_module, job_id, app_module.JOB_STALE_SECONDS + 60)
+    get_job = app_module.get_job
+
+    def read_then_heartbeat(job_id):
+        job = get_job(job_id)
+        age(app_module, job_id, -1)
+        return job
+
+    monkeypatch.setattr(app_module, "get_job", read_then_heartbeat)
+    response = app_module.app.test_client().post(f"/jobs/{job_id}/resume")
+
+    assert response.status_code == 409
+    assert job_id not in app_module.active_jobs
+
+
+def test_sweep_removes_old_spools_only(app_module):
+    old, recent = (app_module.create_job([upload("log.csv")]) for _ in range(2))
+    conn = app_module.get_db()
+    with conn:
+        conn.execute("UPDATE jobs SET status = 'cancelled'")
+    age(app_module, old, app_module.JOB_SPOOL_RETENTION + 60)
+
+    assert app_module.job_heartbeat.sweep() == 1
+
+    assert not os.path.exists(os.path.join(app_module.UPLOAD_DIR, old))
+    assert os.path.exists(os.path.join(app_module.UPLOAD_DIR, recent))
+    assert not app_module.get_job(old)["resumable"]
+    assert app_module.get_job(recent)["resumable"]
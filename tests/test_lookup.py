@@ -0,0 +1,75 @@
+import json
+import time
+
+import pytest
+
+import fake_ip_api
+
+
+def lookup(app_module, body):
+    return app_module.app.test_client().post("/lookup", json=body)
+
+
+def test_lookup_resolves_and_caches(app_module, fake_api):
+    response = lookup(app_module, {"ip": "8.8.8.8"})
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "success"
+
+    app_module.cache_writer.flush()
+    requests = fake_api.stats["requests"]
+    assert lookup(app_module, {"ip": "8.8.8.8"}).get_json()["country"] == response.get_json()["country"]
+    assert fake_api.stats["requests"] == requests
+
+
+@pytest.mark.parametrize("deadline", ["soon", None, [], 0, -1, "nan"])
+def test_bad_deadlines_are_rejected(app_module, fake_api, deadline):
+    response = lookup(app_module, {"ip": "8.8.8.8", "deadline": deadline})
+    assert response.status_code == 400
+    assert fake_api.stats["requests"] == 0
+
+
+def test_long_deadlines_are_capped(app_module, fake_api, monkeypatch):
+    fake_api.latency = 0.5
+    monkeypatch.setattr(app_module, "LOOKUP_DEADLINE", 0.1)
+
+    response = lookup(app_module, {"ip": "8.8.4.4", "deadline": 60})
+
+    assert response.status_code == 504
+
+
+@pytest.mark.parametrize("fields", [5, [1], ["country", None], {"country": True}])
+def test_batch_rejects_malformed_field_lists(app_module, fake_api, fields):
+    response = app_module.app.test_client().post("/lookup/batch", json={"ips": ["8.8.8.8"], "fields": fields})
+    assert response.status_code == 400
+    assert "fields" in response.get_json()["error"]
+    assert fake_api.stats["requests"] == 0
+
+
+def test_batch_accepts_field_strings_and_lists(app_module, fake_api):
+    client = app_module.app.test_client()
+    for fields in ("country,asn", ["country", "asn"]):
+        lines = client.post("/lookup/batch", json={"ips": ["8.8.8.8"], "fields": fields}).get_data(as_text=True)
+        first = json.loads(lines.splitlines()[0])
+        assert set(first) == {"ip", "status", "country", "as"}
+
+
+def test_expired_rows_are_served_and_refreshed(app_module, fake_api, monkeypatch):
+    monkeypatch.setattr(app_module, "REFRESH_INTERVAL", 0)
+    stale = app_module.placeholder_result("8.8.8.8", "success", "Unknown")
+    stale.update(country="Atlantis", region="Deep", city="Sunken")
+    app_module.save_results([stale]).wait(5)
+    conn = app_module.get_db()
+    with conn:
+        conn.execute("UPDATE ip_rows SET expires_at = 1 WHERE key = ?", (app_module.ip_key("8.8.8.8"),))
+
+    response = lookup(app_module, {"ip": "8.8.8.8"})
+    assert response.get_json()["country"] == "Atlantis"
+
+    deadline = time.time() + 5
+    while app_module.lookups.pending("8.8.8.8") and time.time() < deadline:
+        time.sleep(0.02)
+    app_module.cache_writer.flush()
+    assert fake_api.stats["requests"] == 1
+    assert lookup(app_module, {"ip": "8.8.8.8"}).get_json()["country"] == fake_ip_api.answer("8.8.8.8")["country"]
+    row = app_module.fetch_cached(["8.8.8.8"], columns=["ip", "expires_at"])["8.8.8.8"]
+    assert row["expires_at"] > time.time()
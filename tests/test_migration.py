@@ -0,0 +1,66 @@
+import sqlite3
+
+import pytest
+
+LEGACY_ROWS = [
+    ("8.8.8.8", "success", "United States", "California", "Mountain View"),
+    ("2001:DB8::1", "success", "Germany", "Berlin", "Berlin"),
+    ("10.0.0.1", "fail", "Unknown", "Unknown", "Unknown"),
+    ("9.9.9.9", "error", "Error", "Error", "Error"),
+    ("not-an-ip", "fail", "Unknown", "Unknown", "Unknown"),
+]
+
+
+def legacy_database(path):
+    """A cache as the text-keyed releases left it, before expiry tracking."""
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE ip_cache (ip TEXT PRIMARY KEY, status TEXT, country TEXT, region TEXT, city TEXT)")
+    conn.executemany("INSERT INTO ip_cache VALUES (?, ?, ?, ?, ?)", LEGACY_ROWS)
+    conn.commit()
+    conn.close()
+
+
+def assert_migrated(app_module):
+    conn = app_module.get_db()
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert "ip_cache_legacy" not in tables and "cache_migration" not in tables
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == app_module.SCHEMA_VERSION
+
+    cached = app_module.fetch_cached([row[0] for row in LEGACY_ROWS],
+                                     columns=["ip", "status", "country", "region", "city", "expires_at"])
+    assert {ip: (row["status"], row["country"], row["region"], row["city"]) for ip, row in cached.items()} \
+        == {row[0]: row[1:] for row in LEGACY_ROWS}
+    assert app_module.is_due(cached["9.9.9.9"])
+    assert not app_module.is_due(cached["8.8.8.8"])
+    assert app_module.check_stats() == []
+    assert dict(conn.execute("SELECT name, count FROM stats_totals").fetchall())["total"] == len(LEGACY_ROWS)
+
+
+def test_legacy_cache_is_migrated_in_batches(app_module, monkeypatch):
+    legacy_database(app_module.DB_FILE)
+    monkeypatch.setattr(app_module, "MIGRATION_BATCH", 2)
+
+    assert_migrated(app_module)
+
+
+def test_interrupted_migration_resumes(app_module, monkeypatch):
+    legacy_database(app_module.DB_FILE)
+    monkeypatch.setattr(app_module, "MIGRATION_BATCH", 2)
+
+    interrupted = []
+
+    def interrupt_once(message, *args):
+        if not interrupted:
+            interrupted.append(message)
+            raise KeyboardInterrupt
+
+    # The log line follows each committed batch, so this stops after the first one
+    monkeypatch.setattr(app_module.app.logger, "info", interrupt_once)
+    with pytest.raises(KeyboardInterrupt):
+        app_module.get_db()
+    conn = sqlite3.connect(app_module.DB_FILE)
+    assert conn.execute("SELECT last_rowid FROM cache_migration").fetchone()[0] == 2
+    assert conn.execute("SELECT count(*) FROM ip_rows").fetchone()[0] == 2
+    conn.close()
+
+    assert_migrated(app_module)
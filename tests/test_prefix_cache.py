@@ -0,0 +1,31 @@
+import pytest
+
+
+@pytest.mark.parametrize("query", ["bits=abc", "bits=24,x", "bits=0", "bits=40", "bits=24&sample=0",
+                                   "bits=24&sample=-5", "bits=24&sample=many"])
+def test_accuracy_check_rejects_bad_parameters(app_module, query):
+    response = app_module.app.test_client().get(f"/prefix-cache?{query}")
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def test_accuracy_check_compares_neighbours(app_module):
+    rows = []
+    for ip, city in (("8.8.8.1", "A"), ("8.8.8.2", "A"), ("8.8.8.3", "B"), ("9.9.9.9", "C")):
+        result = app_module.placeholder_result(ip, "success", "Unknown")
+        result.update(country="X", region="Y", city=city)
+        rows.append(result)
+    app_module.save_results(rows).wait(5)
+
+    response = app_module.app.test_client().get("/prefix-cache?bits=24,32&sample=10")
+
+    assert response.status_code == 200
+    by_bits = {row["bits"]: row for row in response.get_json()["accuracy"]}
+    assert by_bits[24]["compared"] == 2 and by_bits[24]["country_match"] == 100
+    assert by_bits[32]["compared"] == 0
+
+
+def test_cli_rejects_out_of_range_bits(app_module):
+    result = app_module.app.test_cli_runner().invoke(args=["prefix-accuracy", "-b", "40"])
+    assert result.exit_code != 0
+    assert "40" in result.output
@@ -0,0 +1,77 @@
+import ipaddress
+
+import numpy as np
+import pytest
+
+from range_db import RangeDatabase, flatten_ranges
+
+FIELDS = ["country", "city"]
+
+
+def load(tmp_path, text):
+    path = tmp_path / "ranges.csv"
+    path.write_text(text)
+    return RangeDatabase.load(path, FIELDS)
+
+
+def number(ip):
+    return int(ipaddress.ip_address(ip))
+
+
+def cities(db, ips):
+    idx = db.v4.find_many(np.array([number(ip) for ip in ips], dtype=np.uint64))
+    return [db.v4.records["city"].iloc[i] if i >= 0 else None for i in idx]
+
+
+def test_find_many_at_range_boundaries_and_in_gaps(tmp_path):
+    db = load(tmp_path, "start,end,country,city\n"
+                        "10.0.0.0,10.0.0.255,A,First\n"
+                        "10.0.1.0,10.0.1.255,A,Second\n"
+                        "10.0.3.0,10.0.3.255,A,Third\n")
+
+    ips = ["9.255.255.255", "10.0.0.0", "10.0.0.255", "10.0.1.0", "10.0.1.255",
+           "10.0.2.0", "10.0.2.255", "10.0.3.0", "10.0.3.255", "10.0.4.0"]
+    assert cities(db, ips) == [None, "First", "First", "Second", "Second",
+                               None, None, "Third", "Third", None]
+    assert [db.v4.find(number(ip)) for ip in ips] == [-1, 0, 0, 1, 1, -1, -1, 2, 2, -1]
+
+
+def test_nested_networks_resolve_to_the_narrowest_range(tmp_path):
+    db = load(tmp_path, "network,country,city\n"
+                        "10.0.0.0/8,A,Wide\n"
+                        "10.1.0.0/16,A,Middle\n"
+                        "10.1.2.0/24,A,Narrow\n"
+                        "10.2.0.0/16,A,Other\n")
+
+    ips = ["10.0.0.0", "10.1.0.0", "10.1.1.255", "10.1.2.0", "10.1.2.255", "10.1.3.0",
+           "10.1.255.255", "10.2.0.0", "10.2.255.255", "10.3.0.0", "10.255.255.255", "11.0.0.0"]
+    assert cities(db, ips) == ["Wide", "Middle", "Middle", "Narrow", "Narrow", "Middle",
+                               "Middle", "Other", "Other", "Wide", "Wide", None]
+    assert db.lookup("10.1.2.7")["city"] == "Narrow"
+    assert db.lookup_series(ips)["city"].tolist()[:4] == ["Wide", "Middle", "Middle", "Narrow"]
+
+
+def test_nested_ipv6_networks_resolve_to_the_narrowest_range(tmp_path):
+    db = load(tmp_path, "network,country,city\n"
+                        "2001:db8::/32,A,Wide\n"
+                        "2001:db8:1::/48,A,Narrow\n")
+
+    assert db.lookup("2001:db8::1")["city"] == "Wide"
+    assert db.lookup("2001:db8:1::1")["city"] == "Narrow"
+    assert db.lookup("2001:db8:2::")["city"] == "Wide"
+    assert db.lookup("2001:db9::") is None
+
+
+@pytest.mark.parametrize("starts, ends, expected", [
+    # Partial overlap: the shorter range takes the shared part
+    ([0, 5], [9, 20], ([0, 10], [9, 20], [0, 1])),
+    ([0, 5], [30, 20], ([0, 5, 21], [4, 20, 30], [0, 1, 0])),
+    # Same range twice: the first one listed wins
+    ([0, 0], [9, 9], ([0], [9], [0])),
+    # Already disjoint ranges come back unchanged
+    ([0, 10], [4, 19], ([0, 10], [4, 19], [0, 1])),
+    # A wide range around two narrow ones, touching its edges
+    ([0, 0, 15], [19, 4, 19], ([0, 5, 15], [4, 14, 19], [1, 0, 2])),
+])
+def test_flatten_ranges(starts, ends, expected):
+    assert flatten_ranges(starts, ends) == expected
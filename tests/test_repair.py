@@ -0,0 +1,95 @@
+import json
+
+import fake_ip_api
+
+ERRORS = [f"8.8.8.{i}" for i in range(1, 6)]
+
+
+def seed(app_module):
+    rows = [app_module.placeholder_result(ip, "error", "Error") for ip in ERRORS + ["10.0.0.1"]]
+    rows.append(app_module.placeholder_result("192.168.1.1", "fail", "Unknown"))
+    good = app_module.placeholder_result("1.1.1.1", "success", "Unknown")
+    good.update(country="Australia", region="Queensland", city="Brisbane")
+    rows.append(good)
+    app_module.save_results(rows).wait(5)
+
+
+def run_repair(app_module, body=None):
+    response = app_module.app.test_client().post("/fix-cache", json={} if body is None else body)
+    return [json.loads(line[len("data: "):]) for line in response.get_data(as_text=True).splitlines()
+            if line.startswith("data: ")]
+
+
+def cached(app_module, ip):
+    return app_module.fetch_cached([ip])[ip]
+
+
+def test_repair_fixes_errors_and_placeholders(app_module, fake_api):
+    seed(app_module)
+
+    events = run_repair(app_module)
+
+    start, complete = events[1], events[-1]
+    assert start["type"] == "start" and start["total_ips"] == 7
+    assert complete["type"] == "complete"
+    for ip in ERRORS:
+        assert cached(app_module, ip)["country"] == fake_ip_api.answer(ip)["country"]
+    # A definite "fail" replaces an error, but a fail row stays as it is
+    assert cached(app_module, "10.0.0.1")["status"] == "fail"
+    assert cached(app_module, "192.168.1.1")["status"] == "fail"
+    assert cached(app_module, "1.1.1.1")["city"] == "Brisbane"
+    assert app_module.check_stats() == []
+
+
+def test_repair_filters_narrow_the_sweep(app_module, fake_api):
+    seed(app_module)
+
+    events = run_repair(app_module, {"status": "fail"})
+
+    assert events[1]["total_ips"] == 1
+    assert cached(app_module, "8.8.8.1")["status"] == "error"
+
+
+def test_bad_filters_are_reported(app_module):
+    events = run_repair(app_module, {"status": "bogus"})
+    assert events == [{"type": "error", "message": "Unknown status: bogus"}]
+
+
+def test_non_object_bodies_are_reported(app_module):
+    for body in ([1], "status", 5):
+        events = run_repair(app_module, body)
+        assert events == [{"type": "error", "message": "Expected a JSON object of filters"}]
+
+
+def test_cancelled_repair_resumes_after_its_last_chunk(app_module, fake_api, monkeypatch):
+    seed(app_module)
+    monkeypatch.setattr(app_module, "REPAIR_CHUNK", 2)
+    process_repair = app_module.process_repair
+
+    def cancel_in_second_chunk(job_id):
+        for event in process_repair(job_id):
+            if event["type"] == "progress" and event["checked"] > 2:
+                app_module.get_db().execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+                app_module.get_db().commit()
+            yield event
+
+    monkeypatch.setitem(app_module.JOB_PIPELINES, "repair", cancel_in_second_chunk)
+    events = run_repair(app_module, {"status": "error"})
+    job_id = events[0]["job_id"]
+    assert events[-1]["type"] == "cancelled"
+    job = app_module.get_job(job_id)
+    assert job["cursor"] == ERRORS[1] and job["resumable"]
+    assert cached(app_module, ERRORS[1])["status"] == "success"
+    assert cached(app_module, ERRORS[2])["status"] == "error"
+
+    monkeypatch.setitem(app_module.JOB_PIPELINES, "repair", process_repair)
+    client = app_module.app.test_client()
+    assert client.post(f"/jobs/{job_id}/resume").status_code == 200
+    events = [json.loads(line[len("data: "):]) for line in
+              client.get(f"/jobs/{job_id}/events").get_data(as_text=True).splitlines() if line.startswith("data: ")]
+
+    assert events[0]["resumed"] and events[0]["total_ips"] == 4
+    assert events[-1]["type"] == "complete"
+    assert all(cached(app_module, ip)["status"] == "success" for ip in ERRORS)
+    # Two rows resolved before the cancel, two lost with the open chunk, four after the resume
+    assert fake_api.stats["ips"] == 8
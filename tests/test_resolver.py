@@ -0,0 +1,130 @@
+import ipaddress
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import fake_ip_api
+
+
+def ips(count, start="8.8.0.1"):
+    first = int(ipaddress.ip_address(start))
+    return [str(ipaddress.ip_address(first + i)) for i in range(count)]
+
+
+def response(code, rl=None, ttl=None):
+    headers = {}
+    if rl is not None:
+        headers["X-Rl"] = str(rl)
+    if ttl is not None:
+        headers["X-Ttl"] = str(ttl)
+    return SimpleNamespace(status_code=code, headers=headers)
+
+
+def new_resolver(app_module):
+    return app_module.Resolver(2, 6000, 6000)
+
+
+def test_batches_of_one_hundred(app_module, fake_api):
+    addresses = ips(250)
+    results = [result for batch in new_resolver(app_module).map_batches(addresses) for result in batch]
+
+    assert fake_api.stats["requests"] == 3
+    assert sorted(result["ip"] for result in results) == sorted(addresses)
+    by_ip = {result["ip"]: result for result in results}
+    for ip in addresses:
+        assert by_ip[ip]["status"] == "success"
+        assert by_ip[ip]["country"] == fake_ip_api.answer(ip)["country"]
+
+
+def test_resolved_batches_are_cached(app_module, fake_api):
+    addresses = ips(10)
+    list(app_module.resolve_uncached(addresses))
+    app_module.cache_writer.flush()
+
+    cached = app_module.fetch_cached(addresses)
+    assert set(cached) == set(addresses)
+    assert all(row["status"] == "success" for row in cached.values())
+
+
+def test_private_addresses_are_fail_answers(app_module, fake_api):
+    [result] = new_resolver(app_module).lookup_batch(["10.0.0.1"])
+    assert result["status"] == "fail"
+    assert result["country"] == "Unknown"
+
+
+def test_addresses_missing_from_the_response_are_errors(app_module, fake_api, monkeypatch):
+    real_answer = fake_ip_api.answer
+    monkeypatch.setattr(fake_ip_api, "answer",
+                        lambda ip: {"status": "success", "query": "0.0.0.0"} if ip == "8.8.0.2" else real_answer(ip))
+
+    results = new_resolver(app_module).lookup_batch(ips(3))
+
+    assert [result["ip"] for result in results] == ips(3)
+    assert [result["status"] for result in results] == ["success", "error", "success"]
+    assert results[1]["country"] == "Error"
+
+
+def test_server_errors_fail_the_batch_without_retrying(app_module, fake_api):
+    fake_api.fail_rate = 1.0
+    results = new_resolver(app_module).lookup_batch(ips(5))
+
+    assert fake_api.stats["requests"] == 1
+    assert {result["status"] for result in results} == {"error"}
+    assert {result["country"] for result in results} == {"Network Error"}
+
+
+def test_rate_limited_requests_back_off_and_give_up(app_module, fake_api, monkeypatch):
+    fake_api.rate_limit = 1.0
+    resolver = new_resolver(app_module)
+    pauses = []
+    monkeypatch.setattr(resolver.batch_bucket, "pause", pauses.append)
+
+    results = resolver.lookup_batch(ips(5))
+
+    assert fake_api.stats["requests"] == resolver.MAX_ATTEMPTS
+    assert pauses == [1, 2, 4]
+    assert {result["country"] for result in results} == {"Network Error"}
+
+
+def test_quota_headers_pause_the_bucket(app_module):
+    resolver = new_resolver(app_module)
+    pauses = []
+    resolver.single_bucket.pause = pauses.append
+
+    resolver._throttle(resolver.single_bucket, response(200, rl=5, ttl=30))
+    resolver._throttle(resolver.single_bucket, response(200, rl=0, ttl=30))
+    resolver._throttle(resolver.single_bucket, response(429, ttl=12))
+
+    assert pauses == [31, 13]
+
+
+def test_backoff_resets_after_a_success(app_module):
+    resolver = new_resolver(app_module)
+    pauses = []
+    resolver.batch_bucket.pause = pauses.append
+
+    for _ in range(3):
+        resolver._throttle(resolver.batch_bucket, response(429))
+    resolver._throttle(resolver.batch_bucket, response(200))
+    resolver._throttle(resolver.batch_bucket, response(429))
+
+    assert pauses == [1, 2, 4, 1]
+
+
+def test_token_bucket_rejects_non_positive_rates(app_module):
+    for rate in (0, -5):
+        with pytest.raises(ValueError):
+            app_module.TokenBucket(rate)
+
+
+def test_token_bucket_burst_is_one_second_of_quota(app_module):
+    bucket = app_module.TokenBucket(600)
+    started = time.monotonic()
+    for _ in range(10):
+        bucket.acquire()
+    assert time.monotonic() - started < 0.05
+    bucket.acquire()
+    assert time.monotonic() - started >= 0.09
+
+    assert app_module.TokenBucket(45).capacity == 1
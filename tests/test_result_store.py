@@ -0,0 +1,54 @@
+import pandas as pd
+import pytest
+
+from result_store import ResultWriter, open_result
+
+pytest.importorskip("pyarrow")
+
+COLUMNAR = ["parquet", "arrow"]
+
+
+@pytest.mark.parametrize("fmt", COLUMNAR)
+def test_column_empty_in_first_chunk_takes_text_later(tmp_path, fmt):
+    path = str(tmp_path / f"out.{fmt}")
+    with ResultWriter(path, fmt) as writer:
+        writer.write(pd.DataFrame({"client_ip": ["1.1.1.1"], "referrer": pd.Series([None], dtype=object)}))
+        writer.write(pd.DataFrame({"client_ip": ["2.2.2.2"], "referrer": ["http://x"]}))
+
+    df = open_result(path).read(["client_ip", "referrer"])
+    assert df["client_ip"].tolist() == ["1.1.1.1", "2.2.2.2"]
+    assert df["referrer"].isna().tolist() == [True, False]
+    assert df["referrer"].iloc[1] == "http://x"
+
+
+@pytest.mark.parametrize("fmt", COLUMNAR)
+def test_dictionary_columns_grow_across_chunks(tmp_path, fmt):
+    path = str(tmp_path / f"out.{fmt}")
+    with ResultWriter(path, fmt) as writer:
+        writer.write(pd.DataFrame({"client_ip": ["1.1.1.1"], "country": ["Germany"]}))
+        writer.write(pd.DataFrame({"client_ip": ["2.2.2.2", "3.3.3.3"], "country": ["Japan", None]}))
+
+    result = open_result(path)
+    assert result.num_rows == 3
+    df = result.read(["country"])
+    assert isinstance(df["country"].dtype, pd.CategoricalDtype)
+    assert df["country"].tolist()[:2] == ["Germany", "Japan"]
+    assert result.rows(1, 3)["client_ip"].tolist() == ["2.2.2.2", "3.3.3.3"]
+
+
+@pytest.mark.parametrize("fmt", COLUMNAR)
+def test_upload_with_late_text_in_optional_column(app_module, monkeypatch, fmt):
+    monkeypatch.setattr(app_module, "UPLOAD_CHUNK_ROWS", 50)
+    monkeypatch.setattr(app_module, "RESULT_FORMAT", fmt)
+    rows = [f"10.0.0.{i % 250},{'http://x' if i >= 60 else ''}" for i in range(120)]
+    with open("log.csv", "w") as f:
+        f.write("client_ip,referrer\n" + "\n".join(rows) + "\n")
+    locations = {ip: app_module.placeholder_result(ip, "fail", "Unknown") for ip in {row.split(",")[0] for row in rows}}
+
+    written = list(app_module.enrich_csv("log.csv", f"out.{fmt}", app_module.location_frame(locations)))
+
+    assert written[-1] == 120
+    df = open_result(f"out.{fmt}").read(["client_ip", "referrer", "country"])
+    assert pd.isna(df["referrer"].iloc[59])
+    assert df["referrer"].iloc[60] == "http://x"
+    assert (df["country"] == "Unknown").all()
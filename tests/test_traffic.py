@@ -0,0 +1,45 @@
+import io
+import json
+
+from werkzeug.datastructures import FileStorage
+
+import traffic
+
+LOG = "client_ip,page\n8.8.8.8,/a\n1.1.1.1,/b\n8.8.8.8,/c\n"
+
+
+def run_upload(app_module, name, **form):
+    files = [FileStorage(io.BytesIO(LOG.encode()), filename=name)]
+    response = app_module.app.test_client().post("/upload", data=dict(form, files=files))
+    events = [json.loads(line[len("data: "):]) for line in response.get_data(as_text=True).splitlines()
+              if line.startswith("data: ")]
+    assert events[-1]["type"] == "complete"
+    return events[0]["job_id"]
+
+
+def test_dataset_upload_is_labelled_from_the_dataset(app_module, fake_api):
+    run_upload(app_module, "log.csv", dataset="site")
+
+    assert traffic.dataset_for_result(app_module.get_db(), "processed_log.csv") == "site"
+    assert app_module.load_result("results/processed_log.csv")["dataset"] == "site"
+
+
+def test_rewriting_a_result_unlinks_it_from_its_dataset(app_module, fake_api):
+    run_upload(app_module, "log.csv", dataset="site")
+    run_upload(app_module, "log.csv")
+
+    assert traffic.dataset_for_result(app_module.get_db(), "processed_log.csv") is None
+    assert app_module.load_result("results/processed_log.csv")["dataset"] is None
+
+
+def test_merging_a_batch_again_keeps_totals_and_relinks(app_module):
+    import pandas as pd
+
+    conn = app_module.get_db()
+    views = pd.Series({"8.8.8.8": 2, "1.1.1.1": 1})
+    assert traffic.merge_batch(conn, "site", "job/0", views, result="processed_log.csv")
+    traffic.forget_result(conn, "processed_log.csv")
+
+    assert not traffic.merge_batch(conn, "site", "job/0", views, result="processed_log.csv")
+    assert traffic.dataset_for_result(conn, "processed_log.csv") == "site"
+    assert traffic.list_datasets(conn)[0]["views"] == 3
@@ -0,0 +1,55 @@
+import pandas as pd
+
+from result_store import open_result
+
+
+def write_log(path, ips, **columns):
+    pd.DataFrame({"client_ip": ips, **columns}).to_csv(path, index=False)
+
+
+def locations_for(app_module, ips):
+    results = {}
+    for ip in set(ips):
+        result = app_module.placeholder_result(ip, "success", "Unknown")
+        result["country"] = f"Country {ip.split('.')[0]}"
+        results[ip] = result
+    return app_module.location_frame(results)
+
+
+def test_join_matches_each_row_across_chunks(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "UPLOAD_CHUNK_ROWS", 7)
+    ips = [f"{i % 5 + 1}.0.0.1" for i in range(30)]
+    write_log("log.csv", ips, page=[f"/page/{i}" for i in range(30)])
+    location_df = locations_for(app_module, ips[:4])
+
+    list(app_module.enrich_csv("log.csv", "out.csv", location_df))
+
+    df = open_result("out.csv").read(["client_ip", "page", "country"])
+    assert df["page"].tolist() == [f"/page/{i}" for i in range(30)]
+    known = df["client_ip"] != "5.0.0.1"
+    assert (df.loc[known, "country"] == "Country " + df.loc[known, "client_ip"].str[0]).all()
+    assert df.loc[~known, "country"].isna().all()
+
+
+def test_aggregate_sums_views_per_ip(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "UPLOAD_CHUNK_ROWS", 4)
+    ips = ["1.0.0.1", "2.0.0.1", "1.0.0.1", "1.0.0.1", "2.0.0.1", "3.0.0.1"]
+    write_log("log.csv", ips, ip_count=[1, 2, 3, 4, 5, 6])
+    timings = app_module.StageTimings()
+
+    list(app_module.enrich_csv("log.csv", "out.csv", locations_for(app_module, ips), timings, aggregate=True))
+
+    df = open_result("out.csv").read(["client_ip", "ip_count", "country"]).set_index("client_ip")
+    assert df["ip_count"].to_dict() == {"1.0.0.1": 8, "2.0.0.1": 7, "3.0.0.1": 6}
+    assert df.loc["3.0.0.1", "country"] == "Country 3"
+    assert "aggregate" in timings
+
+
+def test_plain_upload_records_no_aggregate_stage(app_module):
+    ips = ["1.0.0.1", "2.0.0.1"]
+    write_log("log.csv", ips)
+    timings = app_module.StageTimings()
+
+    list(app_module.enrich_csv("log.csv", "out.csv", locations_for(app_module, ips), timings))
+
+    assert set(timings) == {"parse", "join", "write"}
@@ -0,0 +1,220 @@
+"""Rolling per-IP and per-subnet traffic totals for incremental classification.
+
+Each dataset (one stream of logs, uploaded batch by batch) keeps a row per
+client IP with its accumulated views, and a row per /24 subnet with the
+number of distinct IPs and views seen in it.  Merging a batch is a handful
+of set-based statements over the batch's distinct IPs, and classifying a
+dataset only reads the subnet table plus the index range of IPs above the
+high-traffic threshold, so neither depends on how many raw rows went in.
+
+Subnets are keyed by the /24 number for IPv4 addresses (and bare ``a.b.c``
+prefixes), and by the first three dot-separated parts as text for anything
+else, matching the grouping the per-file classification uses.  Batches are
+recorded by id, so a batch that is merged twice (say, by a resumed upload)
+is only counted once.
+"""
+import time
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS traffic_datasets (
+        dataset TEXT PRIMARY KEY,
+        ips INTEGER NOT NULL,
+        views INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS traffic_batches (
+        dataset TEXT NOT NULL,
+        batch TEXT NOT NULL,
+        result TEXT,
+        ips INTEGER NOT NULL,
+        views INTEGER NOT NULL,
+        added_at REAL NOT NULL,
+        PRIMARY KEY (dataset, batch)
+    );
+    CREATE INDEX IF NOT EXISTS traffic_batches_result ON traffic_batches (result, added_at);
+    CREATE TABLE IF NOT EXISTS traffic_ips (
+        dataset TEXT NOT NULL,
+        ip TEXT NOT NULL,
+        subnet NOT NULL,
+        views INTEGER NOT NULL,
+        first_seen REAL NOT NULL,
+        last_seen REAL NOT NULL,
+        PRIMARY KEY (dataset, ip)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS traffic_ips_views ON traffic_ips (dataset, views);
+    CREATE TABLE IF NOT EXISTS traffic_subnets (
+        dataset TEXT NOT NULL,
+        subnet NOT NULL,
+        ips INTEGER NOT NULL,
+        views INTEGER NOT NULL,
+        PRIMARY KEY (dataset, subnet)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS traffic_subnets_size ON traffic_subnets (dataset, ips, views);
+"""
+
+# Dataset and subnet totals first, while traffic_ips still tells which IPs are new
+MERGE_DATASET_SQL = """
+    INSERT INTO traffic_datasets (dataset, ips, views)
+    SELECT :dataset, sum(t.ip IS NULL), sum(b.views)
+    FROM temp.traffic_batch b LEFT JOIN traffic_ips t ON t.dataset = :dataset AND t.ip = b.ip
+    WHERE true
+    ON CONFLICT (dataset) DO UPDATE SET ips = ips + excluded.ips, views = views + excluded.views
+"""
+MERGE_SUBNETS_SQL = """
+    INSERT INTO traffic_subnets (dataset, subnet, ips, views)
+    SELECT :dataset, b.subnet, sum(t.ip IS NULL), sum(b.views)
+    FROM temp.traffic_batch b LEFT JOIN traffic_ips t ON t.dataset = :dataset AND t.ip = b.ip
+    GROUP BY b.subnet
+    ON CONFLICT (dataset, subnet) DO UPDATE SET ips = ips + excluded.ips, views = views + excluded.views
+"""
+MERGE_IPS_SQL = """
+    INSERT INTO traffic_ips (dataset, ip, subnet, views, first_seen, last_seen)
+    SELECT :dataset, ip, subnet, views, :now, :now FROM temp.traffic_batch WHERE true
+    ON CONFLICT (dataset, ip) DO UPDATE SET views = views + excluded.views, last_seen = excluded.last_seen
+"""
+
+# A subnet is suspicious with more than :subnet_ips IPs and more than :subnet_views views
+SUSPICIOUS = "s.ips > :subnet_ips AND s.views > :subnet_views"
+
+
+def subnet_keys(ips):
+    """Stable subnet key per IP: the /24 number for IPv4, a text prefix otherwise."""
+    import numpy as np
+    import pandas as pd
+
+    from range_db import ipv4_to_int
+
+    ips = pd.Series(ips, dtype=str).reset_index(drop=True)
+    numbers = ipv4_to_int(ips.values)
+    keys = pd.Series((numbers.fillna(0).values.astype(np.int64) >> 8).tolist(), dtype=object)
+    other = numbers.isna().values
+    if other.any():
+        # A bare "a.b.c" prefix shares the key of its /24
+        prefixes = ips[other].str.split('.').str[:3].str.join('.')
+        prefix_numbers = ipv4_to_int((prefixes + '.0').values)
+        keys[other] = [int(n) >> 8 if n == n else p for n, p in zip(prefix_numbers, prefixes)]
+    return keys
+
+
+def ip_views(df):
+    """Views per client_ip in ``df``: its summed ip_count, or its row count."""
+    if 'ip_count' in df.columns:
+        return df.groupby('client_ip', sort=False)['ip_count'].sum()
+    return df.groupby('client_ip', sort=False).size()
+
+
+def merge_batch(conn, dataset, batch, views, result=None, now=None):
+    """Add a batch's views (a Series indexed by IP) to ``dataset``.
+
+    ``batch`` identifies the batch; merging the same one again only points
+    it at ``result`` and returns False.  ``result`` is the results file it
+    produced, which lets /view classify that file from the dataset.
+    """
+    now = time.time() if now is None else now
+    views = views[views.index.notna()]
+    rows = list(zip(views.index.astype(str), subnet_keys(views.index).tolist(), views.astype('int64').tolist()))
+    params = {"dataset": dataset, "now": now}
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS traffic_batch (ip TEXT PRIMARY KEY, subnet, views INTEGER)")
+    with conn:
+        added = conn.execute(
+            "INSERT OR IGNORE INTO traffic_batches (dataset, batch, result, ips, views, added_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (dataset, batch, result, len(rows), int(views.sum()), now)).rowcount
+        if not added:
+            # A resumed upload rewrote the file after merging; the totals are already in
+            if result is not None:
+                conn.execute("UPDATE traffic_batches SET result = ? WHERE dataset = ? AND batch = ?",
+                             (result, dataset, batch))
+            return False
+        conn.execute("DELETE FROM temp.traffic_batch")
+        conn.executemany("INSERT INTO temp.traffic_batch VALUES (?, ?, ?)", rows)
+        conn.execute(MERGE_DATASET_SQL, params)
+        conn.execute(MERGE_SUBNETS_SQL, params)
+        conn.execute(MERGE_IPS_SQL, params)
+        conn.execute("DELETE FROM temp.traffic_batch")
+    return True
+
+
+def dataset_for_result(conn, result):
+    """The dataset the results file ``result`` was last merged into, or None."""
+    row = conn.execute("SELECT dataset FROM traffic_batches WHERE result = ? ORDER BY added_at DESC LIMIT 1",
+                       (result,)).fetchone()
+    return row[0] if row else None
+
+
+def forget_result(conn, result):
+    """Unlink the results file ``result`` from every batch, e.g. because it was rewritten."""
+    with conn:
+        conn.execute("UPDATE traffic_batches SET result = NULL WHERE result = ?", (result,))
+
+
+def list_datasets(conn):
+    return [dict(zip(("dataset", "ips", "views", "batches", "first_added", "last_added"), row)) for row in conn.execute("""
+        SELECT d.dataset, d.ips, d.views, count(*), min(b.added_at), max(b.added_at)
+        FROM traffic_datasets d JOIN traffic_batches b ON b.dataset = d.dataset
+        GROUP BY d.dataset ORDER BY max(b.added_at) DESC
+    """)]
+
+
+def delete_dataset(conn, dataset):
+    with conn:
+        for table in ("traffic_datasets", "traffic_batches", "traffic_ips", "traffic_subnets"):
+            conn.execute(f"DELETE FROM {table} WHERE dataset = ?", (dataset,))
+
+
+def summarize(conn, dataset, thresholds, top=20):
+    """Classification counts for ``dataset`` under ``thresholds``.
+
+    ``thresholds`` has ``high_traffic``, ``subnet_ips`` and ``subnet_views``.
+    Returns ``{likely_fake|likely_real: {ip_address_count, total_views}}``
+    and the ``top`` suspicious subnets by views.  The suspicious subnets are
+    a range of the (ips, views) index and the heavy hitters a range of the
+    views index, so the cost follows how many match, not the dataset size.
+    """
+    params = dict(thresholds, dataset=dataset)
+    totals = conn.execute("SELECT ips, views FROM traffic_datasets WHERE dataset = :dataset", params).fetchone()
+    total_ips, total_views = totals if totals else (0, 0)
+    subnet_ips, subnet_views = conn.execute(
+        f"SELECT coalesce(sum(s.ips), 0), coalesce(sum(s.views), 0) FROM traffic_subnets s "
+        f"WHERE s.dataset = :dataset AND {SUSPICIOUS}", params).fetchone()
+    # High-traffic IPs outside the suspicious subnets, read off the views index
+    heavy_ips, heavy_views = conn.execute(f"""
+        SELECT count(*), coalesce(sum(t.views), 0) FROM traffic_ips t
+        JOIN traffic_subnets s ON s.dataset = t.dataset AND s.subnet = t.subnet
+        WHERE t.dataset = :dataset AND t.views >= :high_traffic AND NOT ({SUSPICIOUS})
+    """, params).fetchone()
+
+    fake_ips, fake_views = subnet_ips + heavy_ips, subnet_views + heavy_views
+    counts = {}
+    if fake_ips:
+        counts["likely_fake"] = {"ip_address_count": fake_ips, "total_views": fake_views}
+    if total_ips - fake_ips:
+        counts["likely_real"] = {"ip_address_count": total_ips - fake_ips, "total_views": total_views - fake_views}
+
+    subnets = [{"subnet": subnet_label(row[0]), "ips": row[1], "views": row[2]} for row in conn.execute(
+        f"SELECT s.subnet, s.ips, s.views FROM traffic_subnets s WHERE s.dataset = :dataset AND {SUSPICIOUS} "
+        f"ORDER BY s.views DESC LIMIT :top", dict(params, top=top))]
+    return counts, subnets
+
+
+def classify_ips(conn, dataset, ips, thresholds, chunk_size=900):
+    """Return ``{ip: (label, views)}`` for the ``ips`` that ``dataset`` has seen."""
+    labels = {}
+    ips = list(dict.fromkeys(str(ip) for ip in ips))
+    for i in range(0, len(ips), chunk_size):
+        chunk = ips[i:i + chunk_size]
+        params = dict(thresholds, dataset=dataset)
+        params.update({f"ip{j}": ip for j, ip in enumerate(chunk)})
+        placeholders = ', '.join(f":ip{j}" for j in range(len(chunk)))
+        for ip, views, suspicious in conn.execute(f"""
+            SELECT t.ip, t.views, {SUSPICIOUS} FROM traffic_ips t
+            JOIN traffic_subnets s ON s.dataset = t.dataset AND s.subnet = t.subnet
+            WHERE t.dataset = :dataset AND t.ip IN ({placeholders})
+        """, params):
+            fake = views >= thresholds["high_traffic"] or suspicious
+            labels[ip] = ("likely_fake" if fake else "likely_real", views)
+    return labels
+
+
+def subnet_label(key):
+    if isinstance(key, int):
+        return f"{key >> 16}.{(key >> 8) & 255}.{key & 255}.0/24"
+    return key